@@ -103,5 +103,7 @@ setup(name=name,
       install_requires=install_requires,
       package_data=package_data,
       cmdclass=cmdclass,
-      ext_modules=ext_modules)
+      ext_modules=ext_modules,
+      entry_points={'console_scripts': ['svmbir-precompute = svmbir.precompute:main',
+                                          'svmbir-worker = svmbir.distributed:main']})
 
@@ -1,4 +1,5 @@
 __version__ = '0.4.0'
 from .svmbir import *
+from .svmbir import _clear_cache, _set_cache_limit, _cache_stats, _svmbir_lib_path
 from .phantom import *
-__all__ = ['recon','project','backproject','sino_sort','calc_weights','auto_sigma_x','auto_sigma_y','auto_sigma_p','_clear_cache','_svmbir_lib_path']
+__all__ = ['Geometry','Projector','ProxSession','recon','recon_slabs','project','backproject','sino_sort','calc_weights','auto_sigma_x','auto_sigma_y','auto_sigma_p','precompute_sysmatrix','_clear_cache','_set_cache_limit','_cache_stats','_svmbir_lib_path']
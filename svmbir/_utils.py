@@ -5,6 +5,15 @@
 import numpy as np
 import warnings
 import hashlib
+import mmap
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from psutil import pid_exists
 from PIL import Image
 
 
@@ -69,6 +78,23 @@ def test_args_image(image):
     return image
 
 
+def test_args_out(out, shape, contiguous=True):
+    "Test for valid 'out' buffer: a writeable float32 array with the shape of the result"
+
+    if not isinstance(out,np.ndarray):
+        raise Exception("Error: 'out' input is not a numpy array")
+    if out.shape != tuple(shape):
+        raise Exception("Error: 'out' has shape {} but the result has shape {}".format(out.shape, tuple(shape)))
+    if out.dtype != np.float32:
+        raise Exception("Error: 'out' must have dtype float32")
+    if not out.flags['WRITEABLE']:
+        raise Exception("Error: 'out' is not writeable")
+    if contiguous and not out.flags['C_CONTIGUOUS']:
+        raise Exception("Error: 'out' must be C-contiguous")
+
+    return out
+
+
 def test_args_geom(num_rows, num_cols, delta_pixel, roi_radius, delta_channel, center_offset):
 
     if not num_rows is None:
@@ -137,6 +163,47 @@ def test_args_recon(sharpness, positivity, relax_factor, max_resolutions, stop_t
     return sharpness, positivity, relax_factor, max_resolutions, stop_threshold, max_iterations
 
 
+def test_args_schedule(schedule):
+    "Test for valid multi-resolution 'schedule' and return its resolutions sorted from finest to coarsest"
+
+    if schedule is None:
+        return None
+    if not (isinstance(schedule, (list, tuple)) and (len(schedule) > 0) and
+            all(isinstance(settings, dict) for settings in schedule)):
+        raise Exception("Error: 'schedule' must be a non-empty list of dicts")
+
+    for settings in schedule:
+        unknown = set(settings) - {'scale', 'slice_scale', 'stop_threshold', 'max_iterations', 'relax_factor',
+                                   'decimate'}
+        if unknown:
+            raise Exception("Error: unknown 'schedule' settings {}".format(sorted(unknown)))
+        if not (isinstance(settings.get('scale'), (int, float)) and (settings['scale'] >= 1)):
+            raise Exception("Error: every resolution of 'schedule' needs a 'scale' >= 1")
+        if not (isinstance(settings.get('slice_scale', 1), int) and (settings.get('slice_scale', 1) >= 1)):
+            raise Exception("Error: 'slice_scale' of 'schedule' must be a positive int")
+        if not (isinstance(settings.get('stop_threshold', 0.0), (int, float)) and
+                (settings.get('stop_threshold', 0.0) >= 0)):
+            raise Exception("Error: 'stop_threshold' of 'schedule' must be a non-negative float")
+        if not (isinstance(settings.get('max_iterations', 1), int) and (settings.get('max_iterations', 1) > 0)):
+            raise Exception("Error: 'max_iterations' of 'schedule' must be a positive int")
+        if not (isinstance(settings.get('relax_factor', 1.0), (int, float)) and
+                (0 < settings.get('relax_factor', 1.0) <= 2)):
+            raise Exception("Error: 'relax_factor' of 'schedule' must be in (0,2]")
+        if not isinstance(settings.get('decimate', True), bool):
+            raise Exception("Error: 'decimate' of 'schedule' must be a bool")
+
+    schedule = sorted(schedule, key=lambda settings: settings['scale'])
+    scales = [settings['scale'] for settings in schedule]
+    if scales[0] != 1:
+        raise Exception("Error: 'schedule' must include the full resolution, 'scale' 1")
+    if schedule[0].get('slice_scale', 1) != 1:
+        raise Exception("Error: the full resolution of 'schedule' must have 'slice_scale' 1")
+    if len(set(scales)) != len(scales):
+        raise Exception("Error: the resolutions of 'schedule' must have different scales")
+
+    return [dict(settings) for settings in schedule]
+
+
 def test_args_inits(init_image, prox_image, init_proj, weights, weight_type):
 
     init_image = int_to_float(init_image)
@@ -151,14 +218,6 @@ def test_args_inits(init_image, prox_image, init_proj, weights, weight_type):
         warnings.warn("Parameter init_proj is not a valid 3D ndarray; Setting init_proj = None.")
         init_proj = None
 
-    if not ((weights is None) or (isinstance(weights, np.ndarray) and (weights.ndim == 3))):
-        warnings.warn("Parameter weights is not valid 3D np array; Setting weights = None.")
-        weights = None
-
-    if not ((weights is None) or (np.amin(weights) >= 0.0)):
-        warnings.warn("Parameter weights contains negative values; Setting weights = None.")
-        weights = None
-
     list_of_weights = ['unweighted', 'transmission', 'transmission_root', 'emission']
     if not (isinstance(weight_type, str) and (weight_type in list_of_weights)):
         warnings.warn("Parameter weight_type is not valid string; Setting roi_radius = 'unweighted'")
@@ -167,6 +226,82 @@ def test_args_inits(init_image, prox_image, init_proj, weights, weight_type):
     return init_image, prox_image, init_proj, weights, weight_type
 
 
+def test_args_weights(weights, sino_shape):
+    """Test for valid 'weights' and return them as a tuple of 3D factors that broadcast to sino_shape.
+
+    Each factor is an array that is either 3D and broadcasts to (num_views,num_slices,num_channels),
+    2D with shape (num_views,num_channels), or 1D with length num_views or num_channels. The weights are
+    the product of the factors. Returns None if weights is None or not valid.
+    """
+    if weights is None:
+        return None
+
+    (num_views, num_slices, num_channels) = sino_shape
+    factors = weights if isinstance(weights, (tuple, list)) else (weights,)
+
+    weight_factors = []
+    for factor in factors:
+        if not (isinstance(factor, np.ndarray) and (1 <= factor.ndim <= 3)):
+            warnings.warn("Parameter weights is not a valid np array or tuple of np arrays; Setting weights = None.")
+            return None
+
+        if factor.ndim == 2:
+            if factor.shape != (num_views, num_channels):
+                raise Exception("Error: 2D weights must have shape (num_views,num_channels)")
+            factor = factor[:, np.newaxis, :]
+        elif factor.ndim == 1:
+            if num_views == num_channels:
+                raise Exception("Error: 1D weights are ambiguous when num_views == num_channels; "
+                                "use shape (num_views,1,1) or (1,1,num_channels)")
+            if factor.size == num_views:
+                factor = factor[:, np.newaxis, np.newaxis]
+            elif factor.size == num_channels:
+                factor = factor[np.newaxis, np.newaxis, :]
+            else:
+                raise Exception("Error: 1D weights must have length num_views or num_channels")
+        elif np.broadcast_shapes(factor.shape, sino_shape) != tuple(sino_shape):
+            raise Exception("Error: weights of shape {} do not broadcast to the sinogram shape {}".format(
+                            factor.shape, tuple(sino_shape)))
+
+        if np.amin(factor) < 0.0:
+            warnings.warn("Parameter weights contains negative values; Setting weights = None.")
+            return None
+        weight_factors.append(factor)
+
+    return tuple(weight_factors)
+
+
+def nonzero_weight_views(weight_factors, num_views):
+    "Return a boolean array that is False for the views whose weights are all zero"
+    view_mask = np.ones(num_views, dtype=bool)
+    for factor in weight_factors:
+        factor_mask = np.count_nonzero(factor.reshape(factor.shape[0], -1), axis=1) > 0
+        view_mask &= factor_mask if factor.shape[0] > 1 else factor_mask[0]
+    return view_mask
+
+
+def weights_view(weight_factors, view, out):
+    "Evaluate the weights of one view, with shape (num_slices,num_channels), from a tuple of weight factors"
+    out.fill(1.0)
+    for factor in weight_factors:
+        out *= factor[view if factor.shape[0] > 1 else 0]
+    return out
+
+
+def weights_array(weight_factors, shape, scale=1.0, out=None):
+    """Evaluate a tuple of weight factors as a float32 array of the given shape, multiplied by scale.
+
+    The factors are given in the same axis order as shape, and out can be a view with any memory layout,
+    so the weights can be written transposed into the buffer of the C library without temporaries.
+    """
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    np.multiply(weight_factors[0], scale, out=out, casting='unsafe')
+    for factor in weight_factors[1:]:
+        np.multiply(out, factor, out=out, casting='unsafe')
+    return out
+
+
 def test_args_noise(sigma_y, snr_db, sigma_x, sigma_p):
 
     sigma_y = int_to_float(sigma_y)
@@ -241,6 +376,16 @@ def test_args_sys(num_threads, delete_temps, verbose):
     return num_threads, delete_temps, verbose
 
 
+def test_args_num_processes(num_processes):
+
+    if not ((num_processes is None) or (num_processes == 'auto') or
+            (isinstance(num_processes, int) and (num_processes > 0))):
+        warnings.warn("Parameter num_processes is not a valid int or 'auto'. Setting num_processes = None.")
+        num_processes = None
+
+    return num_processes
+
+
 def hash_params(angles, **kwargs):
     relevant_params = dict()
     relevant_params['geometry'] = kwargs['geometry']
@@ -304,8 +449,38 @@ def get_params_dicts(angles, num_channels, num_views, num_slices, num_rows, num_
 
     return sinoparams, imgparams, settings
 
+def calc_weights_into(sino, weight_type, out):
+    """Evaluate the weights of weight_type for sino in the preallocated array out, without temporaries.
+
+    Args:
+        sino (ndarray): Sinogram data, in any layout.
+        weight_type (string): Type of noise model, as in svmbir.calc_weights().
+        out (ndarray): Array with the shape of sino that receives the weights.
+
+    Returns:
+        ndarray: out
+    """
+    if weight_type == 'unweighted' :
+        out.fill(1.0)
+    elif weight_type == 'transmission' :
+        np.negative(sino, out=out)
+        np.exp(out, out=out)
+    elif weight_type == 'transmission_root' :
+        np.multiply(sino, -0.5, out=out)
+        np.exp(out, out=out)
+    elif weight_type == 'emission' :
+        np.absolute(sino, out=out)
+        out += 0.1
+        np.reciprocal(out, out=out)
+    else :
+        raise Exception("calc_weights: undefined weight_type {}".format(weight_type))
+
+    return out
+
+
 def get_reconparams_dicts(sigma_y, positivity, relax_factor, sigma_x, p, q, T, b_interslice,
-                            stop_threshold, max_iterations,init_image_value=0, interface = 'Cython'):
+                            stop_threshold, max_iterations,init_image_value=0, interface = 'Cython',
+                            weight_type = 'unweighted'):
     reconparams = dict()
     if interface == 'Command Line':
         reconparams['prior_model'] = 'QGGMRF'
@@ -325,31 +500,764 @@ def get_reconparams_dicts(sigma_y, positivity, relax_factor, sigma_x, p, q, T, b
     reconparams['positivity'] = int(positivity)
     reconparams['relax_factor'] = relax_factor
 
+    # The command line program computes the weights of weight_type when no weights file is given. Its emission
+    # weights are 1/(y+0.1) rather than 1/(|y|+0.1), so emission weights are always given as a file. The Cython
+    # interface always passes a weights buffer, which the C library must use as given.
     if interface == 'Command Line':
-        reconparams['weight_type'] = 'unweighted'  # constant weights
+        reconparams['weight_type'] = {'unweighted': 1, 'transmission': 2, 'transmission_root': 3}[weight_type]
     else:
         reconparams['weight_type'] = 1 # How to compute weights if internal, 1: uniform, 2: exp(-y); 3: exp(-y/2), 4: 1/(y+0.1)
 
     return reconparams
 
 
-def recon_resize(recon, output_shape):
+def multires_levels(num_rows, num_cols, delta_pixel, max_resolutions):
+    """List the image grids visited by the multi-resolution reconstruction, from finest to coarsest.
+
+    Args:
+        num_rows (int): Number of rows at full resolution.
+        num_cols (int): Number of columns at full resolution.
+        delta_pixel (float): Pixel pitch at full resolution.
+        max_resolutions (int): Maximum number of lower resolutions.
+
+    Returns:
+        list: Tuples (num_rows, num_cols, delta_pixel) for each resolution.
+    """
+    levels = [(num_rows, num_cols, delta_pixel)]
+    while (max_resolutions > 0) and (min(num_rows, num_cols) > 16):
+        max_resolutions = max_resolutions-1
+        delta_pixel = 2 * delta_pixel
+        num_rows = int(np.ceil(num_rows / 2))
+        num_cols = int(np.ceil(num_cols / 2))
+        levels.append((num_rows, num_cols, delta_pixel))
+
+    return levels
+
+
+def multires_schedule(num_slices, num_rows, num_cols, delta_pixel, max_resolutions, stop_threshold, max_iterations,
+                      relax_factor, schedule=None, multires_slices=False):
+    """List the resolutions of the multi-resolution reconstruction with the settings of each one, from finest to coarsest.
+
+    Args:
+        num_slices (int): Number of slices at full resolution.
+        num_rows (int): Number of rows at full resolution.
+        num_cols (int): Number of columns at full resolution.
+        delta_pixel (float): Pixel pitch at full resolution.
+        max_resolutions (int): Maximum number of lower resolutions. Used if schedule is None.
+        stop_threshold (float): Stopping threshold of the resolutions that do not set their own.
+        max_iterations (int): Maximum number of iterations of the resolutions that do not set their own.
+        relax_factor (float): Relaxation factor of the resolutions that do not set their own.
+        schedule (list, optional): [Default=None] Resolutions as returned by test_args_schedule().
+            If None, the resolution is halved max_resolutions times as in multires_levels().
+        multires_slices (bool, optional): [Default=False] If True, the number of slices of the resolutions that
+            do not set their own 'slice_scale' is reduced by the integer part of their scale.
+
+    Returns:
+        list: Dicts with the keys 'level', 'scale', 'slice_scale', 'num_slices', 'num_rows', 'num_cols',
+        'delta_pixel', 'stop_threshold', 'max_iterations', 'relax_factor' and 'decimate' of each resolution.
+        Level 0 is the full resolution.
+    """
+    if schedule is None:
+        levels = multires_levels(num_rows, num_cols, delta_pixel, max_resolutions)
+        schedule = [dict(scale=2**level) for level in range(len(levels))]
+
+    resolved = []
+    for (level, settings) in enumerate(schedule):
+        scale = settings['scale']
+        slice_scale = settings.get('slice_scale', int(scale) if multires_slices else 1)
+        resolved.append(dict(level=level, scale=scale, slice_scale=slice_scale,
+                             num_slices=-(-num_slices // slice_scale),
+                             num_rows=int(np.ceil(num_rows / scale)), num_cols=int(np.ceil(num_cols / scale)),
+                             delta_pixel=scale * delta_pixel,
+                             stop_threshold=settings.get('stop_threshold', stop_threshold),
+                             max_iterations=settings.get('max_iterations', max_iterations),
+                             relax_factor=settings.get('relax_factor', relax_factor),
+                             decimate=settings.get('decimate', True)))
+
+    return resolved
+
+
+def sino_decimation(settings, angles, num_channels, delta_channel, magnification):
+    """Choose how much the sinogram is reduced for a resolution of the multi-resolution reconstruction.
+
+    The views are subsampled as long as about num_rows/2 views per radian remain, and the channels are binned
+    as long as the binned channel pitch at the isocenter is at most the pixel pitch. Neither factor exceeds the
+    scale of the resolution, so the full resolution always uses the whole sinogram. The channel bin is such that
+    the channels can be padded to a multiple of it with the same number of channels on both sides.
+
+    Args:
+        settings (dict): Resolution as returned by multires_schedule().
+        angles (ndarray): View angles in radians.
+        num_channels (int): Number of channels.
+        delta_channel (float): Detector channel spacing.
+        magnification (float): Magnification of the geometry, 1.0 for parallel beam.
+
+    Returns:
+        tuple: (view_step, channel_bin) numbers of views and channels that are combined into one.
+    """
+    max_factor = int(np.floor(settings['scale']))
+    if not settings['decimate'] or (max_factor <= 1):
+        return 1, 1
+
+    num_views = len(angles)
+    angle_span = np.ptp(angles) * num_views / max(num_views - 1, 1)
+    needed_views = max(settings['num_rows'], settings['num_cols']) / 2 * angle_span
+    view_step = max(1, min(max_factor, int(num_views / needed_views))) if needed_views > 0 else 1
+
+    channel_bin = max(1, min(max_factor, int(settings['delta_pixel'] * magnification / delta_channel + 1e-6)))
+    while ((-num_channels) % channel_bin) % 2 != 0:
+        channel_bin -= 1
+
+    return view_step, channel_bin
+
+
+def decimate_sino(sino, weights, angles, center_offset, view_step, channel_bin, slice_bin=1):
+    """Reduce a sinogram and its weights for a coarse resolution of the multi-resolution reconstruction.
+
+    The views are sorted by angle and combined in groups of view_step, and the channels in groups of channel_bin,
+    after padding both sides with channels of zero weight to a multiple of channel_bin. The slices are combined
+    in groups of slice_bin, the last of which may be smaller. The data of a group is
+    the weighted mean of its members, at their mean angle, and its weight is the sum of their weights. So for an
+    image whose projection is nearly constant across each group, the weighted squared error changes only by a
+    constant, and sigma_y keeps its meaning.
+
+    Args:
+        sino (ndarray): Sinogram with shape (num_views, num_slices, num_channels), in any memory layout.
+        weights (ndarray): Weights with the shape of sino, in any memory layout.
+        angles (ndarray): View angles in radians.
+        center_offset (float): Offset of the center of rotation in channels.
+        view_step (int): Number of views combined into one.
+        channel_bin (int): Number of channels combined into one. The padding (-num_channels) % channel_bin
+            must be even.
+        slice_bin (int, optional): [Default=1] Number of slices combined into one.
+
+    Returns:
+        tuple: (sino, weights, angles, center_offset) of the reduced sinogram. The arrays are float32.
+    """
+    (num_views, num_slices, num_channels) = sino.shape
+    pad = (-num_channels) % channel_bin
+    lr_num_channels = (num_channels + pad) // channel_bin
+    channels = slice(pad // 2, pad // 2 + num_channels)
+
+    slice_groups = np.arange(0, num_slices, slice_bin)
+
+    order = np.argsort(angles, kind='stable')
+    view_groups = [order[first:first + view_step] for first in range(0, num_views, view_step)]
+    lr_sino = np.zeros((len(view_groups), len(slice_groups), lr_num_channels), dtype=np.float32)
+    lr_weights = np.zeros_like(lr_sino)
+
+    # Weighted sums of each group of views, accumulated in double precision
+    group_weights = np.zeros((num_slices, num_channels + pad))
+    group_data = np.zeros((num_slices, num_channels + pad))
+    for (k, views) in enumerate(view_groups):
+        group_weights.fill(0.0)
+        group_data.fill(0.0)
+        for view in views:
+            group_weights[:, channels] += weights[view]
+            group_data[:, channels] += weights[view] * sino[view]
+        total_weights = np.add.reduceat(group_weights.reshape(num_slices, lr_num_channels, channel_bin).sum(axis=2),
+                                        slice_groups, axis=0)
+        total_data = np.add.reduceat(group_data.reshape(num_slices, lr_num_channels, channel_bin).sum(axis=2),
+                                     slice_groups, axis=0)
+        np.divide(total_data, total_weights, out=lr_sino[k], where=total_weights > 0, casting='same_kind')
+        lr_weights[k] = total_weights
+
+    return lr_sino, lr_weights, decimate_angles(angles, view_step), center_offset / channel_bin
+
+
+def decimate_angles(angles, view_step):
+    "Return the mean angle of each group of view_step views in the order of increasing angle, as in decimate_sino()"
+    order = np.argsort(angles, kind='stable')
+    lr_angles = np.empty(-(-len(angles) // view_step))
+    for (k, first) in enumerate(range(0, len(angles), view_step)):
+        lr_angles[k] = np.mean(angles[order[first:first + view_step]])
+    return lr_angles
+
+
+def multires_sino_geometry(settings, angles, num_channels, delta_channel, center_offset, magnification):
+    """Return the sinogram geometry that a resolution of the multi-resolution reconstruction is reconstructed from.
+
+    Both backends of svmbir.recon() and svmbir.precompute_sysmatrix() use this, so that they set up the same
+    system matrix for each resolution.
+
+    Args:
+        settings (dict): Resolution as returned by multires_schedule().
+        angles (ndarray): View angles of the full sinogram in radians.
+        num_channels (int): Number of channels of the full sinogram.
+        delta_channel (float): Detector channel spacing of the full sinogram.
+        center_offset (float): Offset of the center of rotation in channels of the full sinogram.
+        magnification (float): Magnification of the geometry, 1.0 for parallel beam.
+
+    Returns:
+        dict: 'decimate' is True if the sinogram is reduced by decimate_sino() with 'view_step', 'channel_bin' and
+        'slice_bin'. 'angles', 'num_views', 'num_channels', 'delta_channel' and 'center_offset' are those of the
+        sinogram of the resolution.
+    """
+    view_step, channel_bin = sino_decimation(settings, angles, num_channels, delta_channel, magnification)
+    slice_bin = settings['slice_scale']
+    decimate = (view_step, channel_bin, slice_bin) != (1, 1, 1)
+    if decimate:
+        angles = decimate_angles(angles, view_step)
+        num_channels = -(-num_channels // channel_bin)
+        delta_channel = channel_bin * delta_channel
+        center_offset = center_offset / channel_bin
+
+    return dict(decimate=decimate, view_step=view_step, channel_bin=channel_bin, slice_bin=slice_bin, angles=angles,
+                num_views=len(angles), num_channels=num_channels, delta_channel=delta_channel,
+                center_offset=center_offset)
+
+
+def recon_resize(recon, output_shape, out = None, num_threads = None):
     """Resizes a reconstruction by performing 2D resizing along the slices dimension
 
+    The result is the same as bilinear resizing of each slice with PIL, which resamples the columns and then the rows
+    in two separable passes. Each pass is applied to a whole chunk of slices at once: the column pass to the chunk
+    viewed as one image with num_slices*num_rows rows, and the row pass to the transposed chunk viewed as one image
+    with num_slices*num_cols columns. PIL skips the pass of an axis whose size is unchanged, so every row and column
+    is resampled exactly as for a single slice. The chunks are processed by a pool of threads, since PIL releases
+    the GIL while it resamples.
+
+    If output_shape also gives the number of slices, the slice axis is then resampled in the same way, by a row pass
+    over chunks of the columns of the reconstruction viewed as one image with num_slices rows.
+
     Args:
         recon (ndarray): 3D numpy array containing reconstruction with shape (slices, rows, cols)
-        output_shape (tuple): (num_rows, num_cols) shape of resized output
+        output_shape (tuple): (num_rows, num_cols) or (num_slices, num_rows, num_cols) shape of resized output
+        out (ndarray, optional): [Default=None] C-contiguous array of the output shape to write the result to.
+        num_threads (int, optional): [Default=None] Number of threads. If None, the number of CPUs.
 
     Returns:
         ndarray: 3D numpy array containing interpolated reconstruction with shape (num_slices, num_rows, num_cols).
     """
+    (num_slices, num_rows, num_cols) = recon.shape
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if (len(output_shape) == 3) and (output_shape[0] != num_slices):
+        recon = recon_resize(recon, output_shape[1:], num_threads=num_threads)
+        return _resize_slices(recon, output_shape[0], out, num_threads)
+
+    (out_rows, out_cols) = output_shape[-2:]
+    if out is None:
+        out = np.empty((num_slices,out_rows,out_cols), dtype=recon.dtype)
+
+    def resize_chunk(first, last):
+        x = np.ascontiguousarray(recon[first:last], dtype=np.float32)
+        n = last - first
+        if out_cols != num_cols:
+            x = np.asarray(Image.fromarray(x.reshape(n * num_rows, num_cols)).resize(
+                (out_cols, n * num_rows), resample=Image.Resampling.BILINEAR)).reshape(n, num_rows, out_cols)
+        if out_rows != num_rows:
+            x = np.ascontiguousarray(x.transpose(1, 0, 2)).reshape(num_rows, n * out_cols)
+            x = np.asarray(Image.fromarray(x).resize(
+                (n * out_cols, out_rows), resample=Image.Resampling.BILINEAR)).reshape(out_rows, n, out_cols)
+            x = x.transpose(1, 0, 2)
+        out[first:last] = x
+
+    # Chunks of at most about 1M voxels, so that the temporary images stay small
+    voxels_per_slice = max(num_rows, out_rows) * max(num_cols, out_cols)
+    _resize_chunks(resize_chunk, num_slices, max(1, min(-(-num_slices // num_threads), 2**20 // voxels_per_slice)),
+                   num_threads)
+
+    return out
+
+
+def _resize_slices(recon, out_slices, out, num_threads):
+    "Resample the slice axis of recon as in recon_resize(), in chunks of columns"
+    (num_slices, num_rows, num_cols) = recon.shape
+    if out is None:
+        out = np.empty((out_slices,num_rows,num_cols), dtype=recon.dtype)
+    columns = recon.reshape(num_slices, num_rows * num_cols)
+    out_columns = out.reshape(out_slices, num_rows * num_cols)
+
+    def resize_chunk(first, last):
+        x = np.ascontiguousarray(columns[:, first:last], dtype=np.float32)
+        out_columns[:, first:last] = np.asarray(Image.fromarray(x).resize(
+            (last - first, out_slices), resample=Image.Resampling.BILINEAR))
+
+    num_columns = num_rows * num_cols
+    _resize_chunks(resize_chunk, num_columns,
+                   max(1, min(-(-num_columns // num_threads), 2**20 // max(num_slices, out_slices))), num_threads)
+
+    return out
+
+
+def _resize_chunks(resize_chunk, size, chunk_size, num_threads):
+    "Call resize_chunk(first, last) for the chunks of range(size), in a pool of threads if there are several"
+    chunks = [(first, min(first + chunk_size, size)) for first in range(0, size, chunk_size)]
+    if len(chunks) == 1 or num_threads == 1:
+        for (first, last) in chunks:
+            resize_chunk(first, last)
+    else:
+        with ThreadPoolExecutor(max_workers=min(num_threads, len(chunks))) as pool:
+            for future in [pool.submit(resize_chunk, first, last) for (first, last) in chunks]:
+                future.result()
+
+
+def image_change(image, prev_image, num_iterations = 1):
+    """Return the change per iteration from prev_image to image after num_iterations iterations.
+
+    This is the stop criterion of the C library evaluated over whole iterations: the mean absolute change of the
+    voxels in percent of their mean absolute value in prev_image, or the mean absolute change if prev_image is zero.
+    """
+    change = np.sum(np.fabs(image - prev_image), dtype=np.float64) / num_iterations
+    prev_norm = np.sum(np.fabs(prev_image), dtype=np.float64) * (np.size(image) if np.isscalar(prev_image) else 1)
+    if prev_norm == 0:
+        return float(change / np.size(image))
+    return float(100.0 * change / prev_norm)
+
+
+def forward_cost(sino, proj, weight_factors, weight_type, sigma_y):
+    "Return the forward model term (1/2 sigma_y^2) ||y - Ax||^2_Lambda, evaluated one view at a time"
+    view_weights = np.empty(sino.shape[1:], dtype=np.float32)
+    cost = 0.0
+    for view in range(sino.shape[0]):
+        if weight_factors is None:
+            calc_weights_into(sino[view], weight_type, view_weights)
+        else:
+            weights_view(weight_factors, view, view_weights)
+        cost += np.sum(view_weights * (sino[view] - proj[view]) ** 2, dtype=np.float64)
+    return float(cost / (2 * sigma_y ** 2))
+
+
+def qggmrf_cost(image, sigma_x, p, q, T, b_interslice, b_nearest = 1.0, b_diag = 0.707):
+    """Return the qGGMRF prior term of an image, evaluated one slice at a time.
+
+    The neighbor weights are normalized to sum to 1 over the 8 in-plane and 2 interslice neighbors, as in the C library.
+    """
+    b_sum = 4 * b_nearest + 4 * b_diag + 2 * b_interslice
+
+    def rho_sum(delta):
+        delta = np.fabs(delta, dtype=np.float64)
+        ratio = (delta / (T * sigma_x)) ** (q - p)
+        return np.sum(delta ** p / (p * sigma_x ** p) * ratio / (1 + ratio))
+
+    cost = 0.0
+    for i in range(image.shape[0]):
+        x = image[i]
+        cost += b_nearest * (rho_sum(x[:, 1:] - x[:, :-1]) + rho_sum(x[1:, :] - x[:-1, :]))
+        cost += b_diag * (rho_sum(x[1:, 1:] - x[:-1, :-1]) + rho_sum(x[1:, :-1] - x[:-1, 1:]))
+        if (i > 0) and (b_interslice > 0):
+            cost += b_interslice * rho_sum(x - image[i - 1])
+    return float(cost / b_sum)
+
+
+def save_checkpoint(fname, image, level, iteration, converged, num_levels):
+    """Write a reconstruction checkpoint as an uncompressed .npz file.
+
+    The file is written under a temporary name and renamed, so that an interrupted write leaves the previous
+    checkpoint intact.
+    """
+    tmp_name = fname + '_pid' + str(os.getpid()) + '.tmp'
+    with open(tmp_name, 'wb') as fileID:
+        np.savez(fileID, image=image, level=level, iteration=iteration, converged=converged, num_levels=num_levels)
+    os.replace(tmp_name, fname)
+
+
+def load_checkpoint(fname):
+    "Read a checkpoint written by save_checkpoint(). Returns a dict, or None if the file does not exist."
+    try:
+        with np.load(fname) as checkpoint:
+            return dict(image=checkpoint['image'], level=int(checkpoint['level']),
+                        iteration=int(checkpoint['iteration']), converged=bool(checkpoint['converged']),
+                        num_levels=int(checkpoint['num_levels']))
+    except FileNotFoundError:
+        return None
+
+
+###########################
+## System Matrix Caching ##
+###########################
+
+_sysmatrix_suffix = '.2Dsvmatrix'
+
+_byte_units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_bytes(size):
+    "Convert a byte count given as an int or a string such as '500M' or '2G' to an int"
+    if size is None or isinstance(size, int):
+        return size
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in _byte_units:
+        return int(float(size[:-1]) * _byte_units[size[-1]])
+    return int(float(size))
+
+
+# Byte budget of the system matrix directory; None means the cache is unbounded
+_sysmatrix_cache_limit = parse_bytes(os.environ.get('SVMBIR_CACHE_LIMIT'))
+
+_sysmatrix_cache_stats = {'hits': 0, 'misses': 0, 'waits': 0, 'evictions': 0, 'evicted_bytes': 0}
+
+
+def set_sysmatrix_cache_limit(max_bytes):
+    "Set the byte budget of the system matrix cache. None disables eviction."
+    global _sysmatrix_cache_limit
+    max_bytes = parse_bytes(max_bytes)
+    if not (max_bytes is None or max_bytes >= 0):
+        raise Exception("Error: system matrix cache limit must be None or a non-negative number of bytes")
+    _sysmatrix_cache_limit = max_bytes
+
+
+def get_sysmatrix_cache_limit():
+    "Return the byte budget of the system matrix cache"
+    return _sysmatrix_cache_limit
+
+
+def _list_sysmatrix_files(sysmatrix_dir):
+    "Return (mtime, size, path) of the completed system matrix files in sysmatrix_dir"
+    entries = []
+    if not os.path.isdir(sysmatrix_dir):
+        return entries
+    for entry in os.scandir(sysmatrix_dir):
+        # skip partially written '_pid..._rndnum...' files of matrices still being computed
+        if not entry.name.endswith(_sysmatrix_suffix) or '_pid' in entry.name:
+            continue
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, entry.path))
+    return entries
+
+
+def sysmatrix_cache_size(sysmatrix_dir):
+    "Return the total number of bytes used by system matrix files in sysmatrix_dir"
+    return sum(size for _, size, _ in _list_sysmatrix_files(sysmatrix_dir))
+
+
+def evict_sysmatrix_cache(sysmatrix_dir, max_bytes, keep=(), stats=None):
+    """Delete least recently used system matrix files until sysmatrix_dir holds at most max_bytes.
+
+    Recency is the file modification time, which is refreshed with ``os.utime`` on every cache hit.
+
+    Args:
+        sysmatrix_dir (string): Directory containing the '.2Dsvmatrix' files.
+        max_bytes (int): Byte budget of the directory.
+        keep (list of string, optional): Paths that are never evicted, e.g. the matrix about to be used.
+        stats (dict, optional): Counters updated with the evictions. Defaults to the disk cache counters.
+
+    Returns:
+        list: Paths of the deleted files.
+    """
+    if stats is None:
+        stats = _sysmatrix_cache_stats
+
+    entries = sorted(_list_sysmatrix_files(sysmatrix_dir))
+    total_bytes = sum(size for _, size, _ in entries)
+    keep = set(os.path.abspath(path) for path in keep)
+
+    evicted = []
+    for _, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another process evicted it first
+            pass
+        else:
+            stats['evictions'] += 1
+            stats['evicted_bytes'] += size
+            evicted.append(path)
+        total_bytes -= size
+
+    return evicted
+
+
+# Seconds a process waits for another process to finish computing a system matrix before computing it itself
+_sysmatrix_lock_timeout = float(os.environ.get('SVMBIR_LOCK_TIMEOUT', 3600))
+
+# Seconds without a heartbeat after which a lock is considered abandoned
+_sysmatrix_stale_lock_age = float(os.environ.get('SVMBIR_STALE_LOCK_AGE', 120))
+_sysmatrix_heartbeat_interval = 10.0
+_sysmatrix_poll_interval = 0.5
+
+
+def _acquire_sysmatrix_lock(lock_file):
+    "Atomically create lock_file holding the host name and pid of this process. Returns False if it exists."
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as fileID:
+        fileID.write('{} {}\n'.format(socket.gethostname(), os.getpid()))
+    return True
+
+
+def _sysmatrix_lock_is_stale(lock_file):
+    """A lock is stale if its owner on this host has exited, or if its heartbeat is older than the stale age.
+
+    Returns the os.stat_result of the stale lock, which identifies it for _remove_stale_sysmatrix_lock(),
+    or None if the lock is held or does not exist.
+    """
+    try:
+        with open(lock_file, 'r') as fileID:
+            lock_stat = os.fstat(fileID.fileno())
+            owner = fileID.read().split()
+    except FileNotFoundError:
+        return None
+
+    if len(owner) == 2 and owner[0] == socket.gethostname() and owner[1].isdigit():
+        if not pid_exists(int(owner[1])):
+            return lock_stat
+    if time.time() - lock_stat.st_mtime > _sysmatrix_stale_lock_age:
+        return lock_stat
+    return None
+
+
+def _same_file_state(stat_a, stat_b):
+    return (stat_a.st_dev, stat_a.st_ino, stat_a.st_mtime_ns) == (stat_b.st_dev, stat_b.st_ino, stat_b.st_mtime_ns)
+
+
+def _remove_stale_sysmatrix_lock(lock_file, lock_stat):
+    """Remove the abandoned lock identified by lock_stat.
+
+    The lock is renamed to a name unique to this process, so only one waiting process removes it. If the renamed
+    file is not the lock that was found stale, because it was replaced or its heartbeat refreshed in the meantime,
+    it is linked back unless another lock has been created since.
+    """
+    stale_name = '{}_{}_pid{}_rndnum{}.stale'.format(lock_file, socket.gethostname(), os.getpid(), random.randint(0,1000))
+    try:
+        os.rename(lock_file, stale_name)
+    except FileNotFoundError:
+        return
+
+    if not _same_file_state(os.stat(stale_name), lock_stat):
+        try:
+            os.link(stale_name, lock_file)
+        except FileExistsError:
+            pass
+    os.remove(stale_name)
+
+
+def _heartbeat(lock_file, stop_event):
+    "Refresh the modification time of lock_file until stop_event is set"
+    while not stop_event.wait(_sysmatrix_heartbeat_interval):
+        try:
+            os.utime(lock_file)
+        except FileNotFoundError:
+            # a waiting process may have moved the lock aside briefly to check it
+            pass
+
+
+def _compute_sysmatrix_file(sysmatrix_name, compute_sysmatrix):
+    "Compute a system matrix into a temporary file and rename it to its cache file"
+    Amatrix_file = sysmatrix_name + _sysmatrix_suffix
+    _sysmatrix_cache_stats['misses'] += 1
+    tmp_name = sysmatrix_name + '_pid' + str(os.getpid()) + '_rndnum' + str(random.randint(0,1000))
+    compute_sysmatrix(tmp_name)
+    os.rename(tmp_name + _sysmatrix_suffix, Amatrix_file)
+
+    if _sysmatrix_cache_limit is not None:
+        evict_sysmatrix_cache(os.path.dirname(Amatrix_file), _sysmatrix_cache_limit, keep=[Amatrix_file])
+
+
+def get_sysmatrix(sysmatrix_name, compute_sysmatrix, verbose=0):
+    """Return the file name of a cached system matrix, computing it on a cache miss.
+
+    Processes that miss on the same matrix at the same time cooperate through a lock file next to the
+    matrix: one process computes the matrix while the others wait for it. A waiting process removes
+    the lock if its owner has died or stopped refreshing it, and computes the matrix itself if the wait
+    exceeds the lock timeout.
+
+    Args:
+        sysmatrix_name (string): Path of the cached matrix without the '.2Dsvmatrix' suffix.
+        compute_sysmatrix (callable): Called as ``compute_sysmatrix(name)`` to write a new matrix
+            to ``name + '.2Dsvmatrix'``.
+        verbose (int, optional): [Default=0] Level of printed status output.
+
+    Returns:
+        string: Path of the '.2Dsvmatrix' file.
+    """
+    Amatrix_file = sysmatrix_name + _sysmatrix_suffix
+    lock_file = sysmatrix_name + '.lock'
+    deadline = time.time() + _sysmatrix_lock_timeout
+    waiting = False
+
+    while not os.path.exists(Amatrix_file):
+        if _acquire_sysmatrix_lock(lock_file):
+            stop_event = threading.Event()
+            heartbeat = threading.Thread(target=_heartbeat, args=(lock_file, stop_event), daemon=True)
+            heartbeat.start()
+            try:
+                # the matrix may have been completed between the existence test and acquiring the lock
+                if not os.path.exists(Amatrix_file):
+                    _compute_sysmatrix_file(sysmatrix_name, compute_sysmatrix)
+                    return Amatrix_file
+            finally:
+                stop_event.set()
+                heartbeat.join()
+                try:
+                    os.remove(lock_file)
+                except FileNotFoundError:
+                    pass
+            break
+
+        lock_stat = _sysmatrix_lock_is_stale(lock_file)
+        if lock_stat is not None:
+            if verbose > 0:
+                print('Removing abandoned system matrix lock: {}'.format(lock_file))
+            _remove_stale_sysmatrix_lock(lock_file, lock_stat)
+            continue
+
+        if time.time() > deadline:
+            warnings.warn("Timed out waiting for {}; computing the system matrix in this process.".format(lock_file))
+            _compute_sysmatrix_file(sysmatrix_name, compute_sysmatrix)
+            return Amatrix_file
+
+        if not waiting:
+            _sysmatrix_cache_stats['waits'] += 1
+            if verbose > 0:
+                print('Waiting for another process to compute system matrix: {}'.format(Amatrix_file))
+            waiting = True
+        time.sleep(_sysmatrix_poll_interval)
+
+    _sysmatrix_cache_stats['hits'] += 1
+    if verbose > 0:
+        print('Found system matrix: {}'.format(Amatrix_file))
+    if os.access(Amatrix_file, os.W_OK):
+        os.utime(Amatrix_file)  # update file modified time
+
+    return Amatrix_file
+
+
+# Seconds between refreshes of the LRU time of a matrix whose cache lookup is skipped
+_sysmatrix_touch_interval = 60.0
+_sysmatrix_last_touch = dict()
+
+
+def touch_sysmatrix(sysmatrix_name):
+    """Refresh the LRU time of a cached matrix in use, at most once per _sysmatrix_touch_interval seconds.
+
+    Returns:
+        bool: False if the matrix file has been evicted from the cache.
+    """
+    now = time.monotonic()
+    if now - _sysmatrix_last_touch.get(sysmatrix_name, -np.inf) < _sysmatrix_touch_interval:
+        return True
+
+    Amatrix_file = sysmatrix_name + _sysmatrix_suffix
+    if not os.path.exists(Amatrix_file):
+        return False
+    if os.access(Amatrix_file, os.W_OK):
+        os.utime(Amatrix_file)
+    _sysmatrix_last_touch[sysmatrix_name] = now
+    return True
+
+
+def sysmatrix_cache_stats(sysmatrix_dir):
+    "Return the hit, miss and eviction counters of this process together with the current cache size"
+    stats = dict(_sysmatrix_cache_stats)
+    stats['size'] = sysmatrix_cache_size(sysmatrix_dir)
+    stats['limit'] = _sysmatrix_cache_limit
+    return stats
+
+
+# Long-lived objects pin their system matrix with an open file descriptor. The path /proc/self/fd/N refers
+# to the open file, so the C library can still read it after the cache file is evicted by another call.
+_fd_path_supported = os.path.isdir('/proc/self/fd')
+
+
+def pin_sysmatrix(sysmatrix_name):
+    """Open a cached system matrix so that it stays readable until the returned file descriptor is closed.
+
+    The matrix is not copied. If descriptor paths are not supported, the descriptor is None and the path
+    of the '.2Dsvmatrix' file is returned.
+
+    Args:
+        sysmatrix_name (string): Path of the cached matrix without the '.2Dsvmatrix' suffix.
+
+    Returns:
+        tuple: (fd, path) where path is the file the C library should read, or None if the matrix file
+        has been evicted from the cache.
+    """
+    Amatrix_file = sysmatrix_name + _sysmatrix_suffix
+    if not _fd_path_supported:
+        return None, (Amatrix_file if os.path.exists(Amatrix_file) else None)
+    try:
+        fd = os.open(Amatrix_file, os.O_RDONLY)
+    except FileNotFoundError:
+        return None, None
+    return fd, '/proc/self/fd/{}'.format(fd)
 
-    recon_resized = np.empty((recon.shape[0],output_shape[0],output_shape[1]), dtype=recon.dtype)
-    for i in range(recon.shape[0]):
-        PIL_image = Image.fromarray(recon[i])
-        PIL_image_resized = PIL_image.resize((output_shape[1],output_shape[0]), resample=Image.Resampling.BILINEAR)
-        recon_resized[i] = np.array(PIL_image_resized)
 
-    return recon_resized
+#######################################
+## Multi-Process Slab Reconstruction ##
+#######################################
 
+def share_array(x, copy=True, writable=False):
+    """Make an array available to worker processes without pickling its contents.
 
+    A ``numpy.memmap`` of a whole file region is shared by its file name. Any other array is copied into a new
+    shared memory block, which the caller must close and unlink when the workers are done.
+
+    Args:
+        x (array-like): Array to share.
+        copy (bool, optional): If False, a new shared memory block is left uninitialized instead of copying x.
+        writable (bool, optional): If True, the workers open the array for writing; otherwise it is read-only.
+
+    Returns:
+        tuple: (descriptor, shm) where descriptor is passed to attach_array() and shm is the SharedMemory block or None.
+    """
+    # views of a memmap do not record their own file offset, so only the memmap itself is shared by name
+    if isinstance(x, np.memmap) and isinstance(x.base, mmap.mmap) and (x.filename is not None):
+        return ('memmap', x.filename, x.offset, x.shape, x.dtype.str, 'r+' if writable else 'r'), None
+
+    shape = tuple(x.shape)
+    dtype = np.dtype(x.dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    if copy:
+        shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # copy one index of the first axis at a time so that lazy array-likes are read in pieces
+        for index in range(shape[0]):
+            shared[index] = x[index]
+        del shared
+    return ('shm', shm.name, shape, dtype.str, writable), shm
+
+
+def attach_array(descriptor):
+    """Open an array shared by share_array() in a worker process, read-only unless it was shared as writable.
+
+    Returns:
+        tuple: (array, handle) where handle must be kept alive while the array is used and closed afterwards.
+    """
+    if descriptor[0] == 'memmap':
+        _, filename, offset, shape, dtype, mode = descriptor
+        x = np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=shape)
+        return x, None
+
+    _, name, shape, dtype, writable = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    x = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    x.flags.writeable = writable
+    return x, shm
+
+
+def numa_node_cpus():
+    "Return a list with the set of logical CPUs of each NUMA node of this process, or a single set without NUMA"
+    cpus = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else set(range(os.cpu_count()))
+    node_dir = '/sys/devices/system/node'
+    nodes = []
+    if os.path.isdir(node_dir):
+        for name in sorted(os.listdir(node_dir)):
+            if not (name.startswith('node') and name[4:].isdigit()):
+                continue
+            with open(os.path.join(node_dir, name, 'cpulist'), 'r') as fileID:
+                node_cpus = _parse_cpulist(fileID.read()) & cpus
+            if node_cpus:
+                nodes.append(node_cpus)
+    return nodes if nodes else [cpus]
+
+
+def _parse_cpulist(cpulist):
+    "Parse a Linux cpulist string such as '0-3,8-11'"
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2020-2024 by SVMBIR Developers
+# All rights reserved. BSD 3-clause License.
+
+"""
+Filesystem work queue for running reconstructions on several nodes that share a file system.
+
+A coordinator splits a reconstruction into tasks in a queue directory, either by slab with
+``submit_recon_slabs`` or one task per scan with ``submit_recon``. Worker processes on any node that can see
+the directory run ``run_worker``, or the command line interface::
+
+    svmbir-worker /shared/queue [--idle-timeout 600] [--num-threads 32]
+
+A worker claims a task by renaming its file from ``pending/`` to ``claimed/``, which succeeds for exactly one
+worker, runs ``svmbir.recon`` with an ``object_name`` of its own, and writes the result to ``results/``.
+While a task runs, its worker refreshes the modification time of the claimed file. A claimed task whose file
+has not been refreshed for ``heartbeat_timeout`` seconds belongs to a worker that died, and is moved back to
+``pending/`` by the next worker or coordinator that looks for work. The clocks of the nodes must therefore
+agree to well within ``heartbeat_timeout``. Tasks that raise an exception are moved to ``failed/`` together
+with the traceback.
+
+The coordinator collects the results with ``gather_recon_slabs`` or ``TaskQueue.wait``.
+Task files are pickled, so the queue directory must only be writable by trusted users.
+"""
+
+import argparse
+import os
+import pickle
+import socket
+import threading
+import time
+import traceback
+import numpy as np
+import svmbir
+from svmbir.svmbir import _plan_slabs
+
+# Seconds without a heartbeat after which a claimed task is requeued
+_heartbeat_timeout = float(os.environ.get('SVMBIR_HEARTBEAT_TIMEOUT', 120))
+
+_task_suffix = '.task'
+_result_suffix = '.npy'
+
+
+class TaskQueue:
+    """TaskQueue(queue_dir, heartbeat_timeout = None)
+
+    Work queue of tasks stored in a directory of a shared file system.
+
+    Each task is a dict with the entries ``function``, a picklable callable that returns a numpy array,
+    ``args`` and ``kwargs``. A task with the entry ``object_name`` set to True is run with the keyword argument
+    ``object_name`` made unique to the worker and task. A task with the entry ``crop`` set to (first, last)
+    keeps only the slices first:last of its result.
+
+    Args:
+        queue_dir (string): Path of the queue directory, which is created if it does not exist.
+        heartbeat_timeout (float, optional): [Default=None] Seconds without a heartbeat after which a claimed
+            task is requeued. If None, the ``SVMBIR_HEARTBEAT_TIMEOUT`` environment variable or 120 seconds.
+    """
+
+    def __init__(self, queue_dir, heartbeat_timeout = None):
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.heartbeat_timeout = _heartbeat_timeout if heartbeat_timeout is None else float(heartbeat_timeout)
+        for state in ['tmp', 'pending', 'claimed', 'done', 'failed', 'results']:
+            os.makedirs(os.path.join(self.queue_dir, state), exist_ok=True)
+
+    def _path(self, state, task_id, suffix = _task_suffix):
+        return os.path.join(self.queue_dir, state, task_id + suffix)
+
+    def _list(self, state, suffix = _task_suffix):
+        return sorted(fname[:-len(suffix)] for fname in os.listdir(os.path.join(self.queue_dir, state))
+                      if fname.endswith(suffix))
+
+    def _write_atomic(self, fname, write):
+        "Write a file under a temporary name and rename it, so that readers never see a partial file"
+        tmp_name = os.path.join(self.queue_dir, 'tmp', '{}_{}_{}'.format(socket.gethostname(), os.getpid(),
+                                                                         os.path.basename(fname)))
+        with open(tmp_name, 'wb') as fileID:
+            write(fileID)
+        os.replace(tmp_name, fname)
+
+    def submit(self, task_id, task):
+        """Add a task to the queue.
+
+        Args:
+            task_id (string): Unique name of the task, which is used in file names.
+            task (dict): Task with the entries described in the class documentation.
+        """
+        self._write_atomic(self._path('pending', task_id), lambda fileID: pickle.dump(task, fileID, protocol=5))
+
+    def claim(self):
+        """Claim the next pending task.
+
+        Returns:
+            A tuple (task_id, task), or None if no task is pending.
+        """
+        for task_id in self._list('pending'):
+            claimed_file = self._path('claimed', task_id)
+            try:
+                os.rename(self._path('pending', task_id), claimed_file)
+                # renaming keeps the submission time, so start the heartbeat before anyone else checks it
+                os.utime(claimed_file)
+                with open(claimed_file, 'rb') as fileID:
+                    return task_id, pickle.load(fileID)
+            except FileNotFoundError:
+                continue  # claimed by another worker, or requeued before this worker refreshed it
+        return None
+
+    def heartbeat(self, task_id):
+        """Refresh the heartbeat of a claimed task.
+
+        Returns:
+            bool: False if the task is no longer claimed, because it was requeued.
+        """
+        try:
+            os.utime(self._path('claimed', task_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, task_id, result):
+        """Store the result of a claimed task and mark it done.
+
+        Tasks are expected to be deterministic, so a worker whose task was requeued in the meantime
+        still stores its result, and the worker that runs the task again overwrites it with the same values.
+        """
+        self._write_atomic(self._path('results', task_id, _result_suffix), lambda fileID: np.save(fileID, result))
+        try:
+            os.replace(self._path('claimed', task_id), self._path('done', task_id))
+        except FileNotFoundError:
+            pass
+
+    def fail(self, task_id, message):
+        "Move a claimed task to failed/, next to a file holding the error message"
+        self._write_atomic(self._path('failed', task_id, '.err'), lambda fileID: fileID.write(message.encode()))
+        try:
+            os.replace(self._path('claimed', task_id), self._path('failed', task_id))
+        except FileNotFoundError:
+            pass
+
+    def requeue_stale(self):
+        """Move the claimed tasks whose heartbeat is older than heartbeat_timeout back to pending/.
+
+        Returns:
+            list: Ids of the requeued tasks.
+        """
+        requeued = []
+        for task_id in self._list('claimed'):
+            claimed_file = self._path('claimed', task_id)
+            try:
+                if time.time() - os.path.getmtime(claimed_file) > self.heartbeat_timeout:
+                    os.rename(claimed_file, self._path('pending', task_id))
+                    requeued.append(task_id)
+            except FileNotFoundError:
+                pass  # completed, or requeued by another process
+        return requeued
+
+    def status(self):
+        """Return the ids of the tasks in each state.
+
+        Returns:
+            dict: Lists of task ids under the keys 'pending', 'claimed', 'done' and 'failed'.
+        """
+        return {state: self._list(state) for state in ['pending', 'claimed', 'done', 'failed']}
+
+    def result(self, task_id):
+        "Return the result of a done task, or None if it is not available"
+        try:
+            return np.load(self._path('results', task_id, _result_suffix))
+        except FileNotFoundError:
+            return None
+
+    def error(self, task_id):
+        "Return the error message of a failed task, or None if it has not failed"
+        try:
+            with open(self._path('failed', task_id, '.err'), 'r') as fileID:
+                return fileID.read()
+        except FileNotFoundError:
+            return None
+
+    def remove(self, task_id):
+        "Delete all files of a task"
+        for (state, suffix) in [('pending', _task_suffix), ('claimed', _task_suffix), ('done', _task_suffix),
+                                ('failed', _task_suffix), ('failed', '.err'), ('results', _result_suffix)]:
+            try:
+                os.remove(self._path(state, task_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def wait(self, task_ids, timeout = None, poll_interval = 1.0):
+        """Wait until all the given tasks are done, requeueing the tasks of dead workers meanwhile.
+
+        Args:
+            task_ids (list): Ids of the tasks.
+            timeout (float, optional): [Default=None] Seconds to wait. If None, wait indefinitely.
+            poll_interval (float, optional): [Default=1.0] Seconds between checks of the queue directory.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        remaining = set(task_ids)
+        while True:
+            for task_id in list(remaining):
+                if os.path.exists(self._path('results', task_id, _result_suffix)):
+                    remaining.discard(task_id)
+                elif os.path.exists(self._path('failed', task_id)):
+                    raise Exception("svmbir task {} failed:\n{}".format(task_id, self.error(task_id)))
+            if not remaining:
+                return
+            self.requeue_stale()
+            if (deadline is not None) and (time.time() > deadline):
+                raise TimeoutError("{} svmbir tasks are not done, including {}".format(len(remaining), min(remaining)))
+            time.sleep(poll_interval)
+
+
+def _heartbeat(queue, task_id, stop_event):
+    "Refresh the heartbeat of a claimed task until stop_event is set"
+    while not stop_event.wait(queue.heartbeat_timeout / 4):
+        if not queue.heartbeat(task_id):
+            return
+
+
+def _run_task(task, worker_id, task_id):
+    "Run a task and return its result"
+    kwargs = dict(task.get('kwargs', {}))
+    if task.get('object_name'):
+        kwargs['object_name'] = '{}_{}_{}'.format(kwargs.get('object_name', 'object'), worker_id, task_id)
+    result = task['function'](*task.get('args', ()), **kwargs)
+    if task.get('crop') is not None:
+        (first, last) = task['crop']
+        result = result[first:last]
+    return result
+
+
+def run_worker(queue_dir, worker_id = None, heartbeat_timeout = None, poll_interval = 1.0, idle_timeout = None,
+               max_tasks = None, verbose = 1, **kwargs):
+    """run_worker(queue_dir, worker_id = None, idle_timeout = None, **kwargs)
+
+    Claim and run the tasks of a queue directory until there is no work left.
+
+    Args:
+        queue_dir (string): Path of the queue directory.
+        worker_id (string, optional): [Default=None] Name of the worker, used in the ``object_name`` of its
+            reconstructions. If None, the host name and process id.
+        heartbeat_timeout (float, optional): [Default=None] Heartbeat timeout of the queue, see ``TaskQueue``.
+        poll_interval (float, optional): [Default=1.0] Seconds between checks for new tasks.
+        idle_timeout (float, optional): [Default=None] Return after this many seconds without a pending task.
+            If None, wait for tasks indefinitely.
+        max_tasks (int, optional): [Default=None] Return after running this many tasks.
+        verbose (int, optional): [Default=1] Level of printed status output.
+        **kwargs: Keyword arguments added to the arguments of every task, such as ``num_threads``.
+
+    Returns:
+        int: Number of tasks run.
+    """
+    queue = TaskQueue(queue_dir, heartbeat_timeout)
+    if worker_id is None:
+        worker_id = '{}_{}'.format(socket.gethostname(), os.getpid())
+
+    num_tasks = 0
+    idle_since = time.time()
+    while (max_tasks is None) or (num_tasks < max_tasks):
+        claimed = queue.claim()
+        if claimed is None:
+            if not queue.requeue_stale():
+                if (idle_timeout is not None) and (time.time() - idle_since > idle_timeout):
+                    break
+                time.sleep(poll_interval)
+            continue
+
+        (task_id, task) = claimed
+        if verbose >= 1:
+            print('Worker {} running task {}.'.format(worker_id, task_id))
+        task['kwargs'] = dict(task.get('kwargs', {}), **kwargs)
+
+        stop_event = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(queue, task_id, stop_event), daemon=True)
+        heartbeat.start()
+        try:
+            result = _run_task(task, worker_id, task_id)
+        except Exception:
+            if verbose >= 1:
+                print('Worker {} task {} failed.'.format(worker_id, task_id))
+            queue.fail(task_id, traceback.format_exc())
+        else:
+            queue.complete(task_id, result)
+        finally:
+            stop_event.set()
+            heartbeat.join()
+        num_tasks += 1
+        idle_since = time.time()
+
+    return num_tasks
+
+
+def submit_recon(queue_dir, task_id, sino, angles, **kwargs):
+    """submit_recon(queue_dir, task_id, sino, angles, **kwargs)
+
+    Add the reconstruction of one scan to a queue directory.
+
+    Args:
+        queue_dir (string): Path of the queue directory.
+        task_id (string): Unique name of the task. The reconstruction is returned by
+            ``TaskQueue(queue_dir).result(task_id)`` once the task is done.
+        sino (ndarray): 3D sinogram array with shape (num_views, num_slices, num_channels).
+        angles (ndarray or svmbir.Geometry): 1D view angles array in radians, or a ``svmbir.Geometry``.
+        **kwargs: Other arguments of ``svmbir.recon``.
+    """
+    TaskQueue(queue_dir).submit(task_id, dict(function=svmbir.recon, args=(sino, angles), kwargs=kwargs,
+                                              object_name=True))
+
+
+def submit_recon_slabs(queue_dir, sino, angles, slab_size, slab_halo = 4, name = 'recon',
+                       weights = None, weight_type = 'unweighted', init_image = 0.0, prox_image = None,
+                       init_proj = None, sigma_y = None, snr_db = 30.0, sigma_x = None, sigma_p = None,
+                       sharpness = 0.0, verbose = 1, **kwargs):
+    """submit_recon_slabs(queue_dir, sino, angles, slab_size, slab_halo = 4, name = 'recon', **kwargs)
+
+    Split a reconstruction into slab tasks in a queue directory, as in ``svmbir.recon_slabs``.
+
+    The regularization is computed from the whole sinogram before the tasks are written, so that all slabs use
+    the same values. The sinogram is read one slab at a time, so it can be a ``numpy.memmap``.
+
+    Args:
+        queue_dir (string): Path of the queue directory.
+        sino (array-like): 3D sinogram array with shape (num_views, num_slices, num_channels).
+        angles (ndarray or svmbir.Geometry): 1D view angles array in radians, or a ``svmbir.Geometry``.
+        slab_size (int): Number of slices reconstructed in each slab.
+        slab_halo (int, optional): [Default=4] Number of slices added on each side of a slab and discarded.
+        name (string, optional): [Default='recon'] Name of the reconstruction, used to gather its slabs.
+        verbose (int, optional): [Default=1] Level of printed status output of the workers.
+        **kwargs: Other arguments of ``svmbir.recon_slabs``, except ``num_workers`` and ``out``.
+
+    Returns:
+        list: Ids of the submitted tasks.
+    """
+    queue = TaskQueue(queue_dir)
+    num_slices = sino.shape[1]
+    slab_bounds, slab_inputs, recon_args = _plan_slabs(sino, angles, slab_size, slab_halo, weights, weight_type,
+                                                       init_image, prox_image, init_proj, sigma_y, snr_db, sigma_x,
+                                                       sigma_p, sharpness, verbose, kwargs)
+
+    task_ids = []
+    for (first, last, lo, hi) in slab_bounds:
+        task_id = '{}_slab{:06d}'.format(name, first)
+        queue.submit(task_id, dict(function=svmbir.recon, args=(np.asarray(sino[:, lo:hi]), angles),
+                                   kwargs=dict(recon_args, **slab_inputs(lo, hi)), object_name=True,
+                                   crop=(first - lo, last - lo)))
+        task_ids.append(task_id)
+
+    with open(os.path.join(queue.queue_dir, name + '.slabs'), 'wb') as fileID:
+        pickle.dump(dict(num_slices=num_slices, slabs=[(task_id, first, last) for (task_id, (first, last, lo, hi))
+                                                       in zip(task_ids, slab_bounds)]), fileID)
+    return task_ids
+
+
+def gather_recon_slabs(queue_dir, name = 'recon', out = None, timeout = None, poll_interval = 1.0, remove = True):
+    """gather_recon_slabs(queue_dir, name = 'recon', out = None, timeout = None)
+
+    Wait for the slab tasks of ``submit_recon_slabs`` and assemble the reconstruction.
+
+    While waiting, the tasks of workers that stopped sending heartbeats are requeued.
+
+    Args:
+        queue_dir (string): Path of the queue directory.
+        name (string, optional): [Default='recon'] Name of the reconstruction.
+        out (array-like, optional): [Default=None] Array of shape (num_slices,num_rows,num_cols), such as a
+            ``numpy.memmap``, that the slabs are written to. If None, a float32 array is allocated.
+        timeout (float, optional): [Default=None] Seconds to wait. If None, wait indefinitely.
+        poll_interval (float, optional): [Default=1.0] Seconds between checks of the queue directory.
+        remove (bool, optional): [Default=True] Delete the task files and results after assembly.
+
+    Returns:
+        3D array: Reconstruction with shape (num_slices,num_rows,num_cols). If ``out`` is given, it is returned.
+    """
+    queue = TaskQueue(queue_dir)
+    slabs_file = os.path.join(queue.queue_dir, name + '.slabs')
+    with open(slabs_file, 'rb') as fileID:
+        manifest = pickle.load(fileID)
+
+    queue.wait([task_id for (task_id, first, last) in manifest['slabs']], timeout, poll_interval)
+    for (task_id, first, last) in manifest['slabs']:
+        slab_recon = queue.result(task_id)
+        if out is None:
+            out = np.empty((manifest['num_slices'],) + slab_recon.shape[1:], dtype=np.float32)
+        out[first:last] = slab_recon
+    if isinstance(out, np.memmap):
+        out.flush()
+
+    if remove:
+        for (task_id, first, last) in manifest['slabs']:
+            queue.remove(task_id)
+        os.remove(slabs_file)
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='svmbir-worker',
+                                     description='Run the svmbir reconstruction tasks of a shared queue directory.')
+    parser.add_argument('queue_dir', help='queue directory shared by the coordinator and the workers')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='exit after this many seconds without a pending task (default: never)')
+    parser.add_argument('--max-tasks', type=int, default=None, help='exit after running this many tasks')
+    parser.add_argument('--num-threads', type=int, default=None,
+                        help='number of compute threads of each reconstruction (default: number of cores)')
+    parser.add_argument('--worker-id', default=None, help='worker name (default: host name and process id)')
+    parser.add_argument('--verbose', type=int, default=1, help='level of printed status output')
+    args = parser.parse_args(argv)
+
+    worker_kwargs = dict() if args.num_threads is None else dict(num_threads=args.num_threads)
+    run_worker(args.queue_dir, worker_id=args.worker_id, idle_timeout=args.idle_timeout, max_tasks=args.max_tasks,
+               verbose=args.verbose, **worker_kwargs)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,8 @@ cimport cython          # Import cython package
 cimport numpy as cnp    # Import specialized cython support for numpy
 cimport openmp
 import os
-import random
+import time
+import functools
 import svmbir._utils as utils
 
 __svmbir_lib_path = os.path.join(os.path.expanduser('~'), '.cache', 'svmbir', 'parbeam')
@@ -70,7 +71,7 @@ cdef extern from "./sv-mbirct/src/A_comp.h":
         ImageParams3D imgparams,
         SinoParams3DParallel sinoparams,
         char *Amatrix_fname,
-        char verboseLevel);
+        char verboseLevel) nogil;
 
 # Import a c function to project a 3D object to sinogram with a computed A matrix.
 cdef extern from "./sv-mbirct/src/recon3d.h":
@@ -81,7 +82,7 @@ cdef extern from "./sv-mbirct/src/recon3d.h":
         SinoParams3DParallel sinoparams,
         char *Amatrix_fname,
         char backproject_flag,
-        char verboseLevel);
+        char verboseLevel) nogil;
 
     void MBIRReconstruct(
         float *image,
@@ -93,7 +94,7 @@ cdef extern from "./sv-mbirct/src/recon3d.h":
         SinoParams3DParallel sinoparams,
         ReconParams reconparams,
         char *Amatrix_fname,
-        char verboseLevel);
+        char verboseLevel) nogil;
 
 
 cdef convert_py2c_ImageParams3D(ImageParams3D* imgparams,
@@ -180,6 +181,28 @@ def _gen_paths(svmbir_lib_path = __svmbir_lib_path, object_name = 'object', sysm
     return paths
 
 
+def _compute_sysmatrix(imgparams, sinoparams, verbose, sysmatrix_name):
+    """Compute the system matrix with the C library and write it to sysmatrix_name + '.2Dsvmatrix'.
+    """
+    cdef ImageParams3D imgparams_c
+    cdef SinoParams3DParallel sinoparams_c
+    cdef cnp.ndarray[char, ndim=1, mode="c"] Amatrix_fname
+    cdef cnp.ndarray[float, ndim=1, mode="c"] cy_angles = sinoparams['view_angle_list']
+    cdef char *Amatrix_fname_c
+    cdef char verbose_c = verbose
+
+    # Convert parameter python dictionaries to c structures based on given py parameter List.
+    convert_py2c_ImageParams3D(&imgparams_c, imgparams)
+    convert_py2c_SinoParams3D(&sinoparams_c, sinoparams, cy_angles)
+
+    Amatrix_fname = string_to_char_array(sysmatrix_name + '.2Dsvmatrix')
+    Amatrix_fname_c = &Amatrix_fname[0]
+
+    # Release the GIL so the lock heartbeat thread keeps running during the computation
+    with nogil:
+        AmatrixComputeToFile(imgparams_c, sinoparams_c, Amatrix_fname_c, verbose_c)
+
+
 ##################################################################
 # Items that could be converted to typed cython for interface to c
 ##################################################################
@@ -194,35 +217,44 @@ def _init_geometry( angles, num_channels, num_views, num_slices, num_rows, num_c
                 delta_channel, delta_pixel, roi_radius, center_offset, verbose,
                 svmbir_lib_path, object_name, interface='Cython')
 
-    # Declare image and sinogram Parameter structures.
-    cdef ImageParams3D imgparams_c
-    cdef SinoParams3DParallel sinoparams_c
-    cdef cnp.ndarray[char, ndim=1, mode="c"] Amatrix_fname
-    cdef cnp.ndarray[char, ndim=1, mode="c"] Amatrix_fname_tmp
-    cdef cnp.ndarray[float, ndim=1, mode="c"] cy_angles = angles.astype(np.single)
-
-    # Convert parameter python dictionaries to c structures based on given py parameter List.
-    convert_py2c_ImageParams3D(&imgparams_c, imgparams)
-    convert_py2c_SinoParams3D(&sinoparams_c, sinoparams, cy_angles)
-
     # Get info needed for c
     hash_val, relevant_params = utils.hash_params(angles.astype(np.single), **{**sinoparams, **imgparams})
     paths = _gen_paths(svmbir_lib_path, object_name=object_name, sysmatrix_name=hash_val[:__namelen_sysmatrix])
 
     # Then call cython function to get the system matrix - the output dict can be used to pass the matrix itself
     # and/or to pass path information to a file containing the matrix
-    Amatrix_file = paths['sysmatrix_name'] + '.2Dsvmatrix'
-    if os.path.exists(Amatrix_file) :
-        if verbose > 0:
-            print('Found system matrix: {}'.format(Amatrix_file))
-        if os.access(Amatrix_file, os.W_OK):
-            os.utime(Amatrix_file)  # update file modified time
-    # if matrix file does not exist, then write to tmp file and rename
-    else :
-        Amatrix_file_tmp = paths['sysmatrix_name'] + '_pid' + str(os.getpid()) + '_rndnum' + str(random.randint(0,1000)) + '.2Dsvmatrix'
-        Amatrix_fname_tmp = string_to_char_array(Amatrix_file_tmp)
-        AmatrixComputeToFile(imgparams_c,sinoparams_c,&Amatrix_fname_tmp[0],verbose)
-        os.rename(Amatrix_file_tmp,Amatrix_file)
+    utils.get_sysmatrix(paths['sysmatrix_name'],
+                        functools.partial(_compute_sysmatrix, imgparams, sinoparams, verbose), verbose)
+
+    return paths, sinoparams, imgparams
+
+
+def _get_geometry(geometry_levels, angles, num_channels, num_views, num_slices, num_rows, num_cols,
+                  geometry, dist_source_detector, magnification,
+                  delta_channel, delta_pixel, roi_radius, center_offset, verbose,
+                  svmbir_lib_path = __svmbir_lib_path, object_name = 'object'):
+    """Same as _init_geometry(), but reuses the result stored in the dict geometry_levels for this grid if there is one.
+
+    This skips hashing the geometry and testing for the system matrix file on repeated calls.
+    """
+    key = (num_rows, num_cols, delta_pixel, num_views, num_channels, delta_channel, center_offset)
+    if (geometry_levels is not None) and (key in geometry_levels):
+        paths, sinoparams, imgparams = geometry_levels[key]
+        # refresh the LRU time of the matrix once in a while, and recompute it if it was evicted
+        if utils.touch_sysmatrix(paths['sysmatrix_name']):
+            return paths, dict(sinoparams, num_slices=num_slices), dict(imgparams, Nz=num_slices)
+
+    paths, sinoparams, imgparams = _init_geometry(angles, center_offset=center_offset,
+                                                  geometry=geometry, dist_source_detector=dist_source_detector,
+                                                  magnification=magnification,
+                                                  num_channels=num_channels, num_views=num_views, num_slices=num_slices,
+                                                 num_rows=num_rows, num_cols=num_cols,
+                                                 delta_channel=delta_channel, delta_pixel=delta_pixel,
+                                                 roi_radius=roi_radius,
+                                                 svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                                                 verbose=verbose)
+    if geometry_levels is not None:
+        geometry_levels[key] = (paths, sinoparams, imgparams)
 
     return paths, sinoparams, imgparams
 
@@ -260,8 +292,14 @@ def project(image, settings):
     cdef cnp.ndarray[float, ndim=3, mode="c"] cy_image = image
     cdef cnp.ndarray[float, ndim=1, mode="c"] cy_angles = sinoparams['view_angle_list']
 
-    # Allocates memory, without initialization, for matrix to be passed back from C subroutine
-    cdef cnp.ndarray[float, ndim=3, mode="c"] proj = np.empty((nslices, nviews, nchannels), dtype=ctypes.c_float)
+    # Allocates memory, without initialization, for matrix to be passed back from C subroutine.
+    # The C routine writes (Nslices,Nangles,Nchannels), so out is used directly only if it has that memory layout.
+    out = settings.get('out')
+    cdef cnp.ndarray[float, ndim=3, mode="c"] proj
+    if (out is not None) and np.swapaxes(out, 0, 1).flags["C_CONTIGUOUS"]:
+        proj = np.swapaxes(out, 0, 1)
+    else:
+        proj = np.empty((nslices, nviews, nchannels), dtype=ctypes.c_float)
 
     # Write parameter to c structures based on given py parameter List.
     cdef ImageParams3D imgparams_c
@@ -270,10 +308,21 @@ def project(image, settings):
     convert_py2c_SinoParams3D(&sinoparams_c, sinoparams, cy_angles)
 
     cdef cnp.ndarray[char, ndim=1, mode="c"] Amatrix_fname
-    Amatrix_fname = string_to_char_array(paths['sysmatrix_name']+ '.2Dsvmatrix')
+    Amatrix_fname = string_to_char_array(settings.get('sysmatrix_file') or (paths['sysmatrix_name'] + '.2Dsvmatrix'))
+
+    cdef float *proj_c = &proj[0,0,0]
+    cdef float *image_c = &cy_image[0,0,0]
+    cdef char *Amatrix_fname_c = &Amatrix_fname[0]
+    cdef char verbose_c = verbose
+
+    # Forward projection by calling C subroutine, without the GIL so other Python threads keep running
+    with nogil:
+        forwardProject(proj_c, image_c, imgparams_c, sinoparams_c, Amatrix_fname_c, 0, verbose_c)
 
-    # Forward projection by calling C subroutine
-    forwardProject(&proj[0,0,0], &cy_image[0,0,0], imgparams_c, sinoparams_c, &Amatrix_fname[0], 0, verbose)
+    if out is not None:
+        if not np.shares_memory(out, proj):
+            np.copyto(out, np.swapaxes(proj,0,1))
+        return out
 
     # Return cython ndarray
     return np.swapaxes(proj,0,1)
@@ -314,7 +363,11 @@ def backproject(sino, settings):
     cdef cnp.ndarray[float, ndim=1, mode="c"] cy_angles = sinoparams['view_angle_list']
 
     # Allocates memory, without initialization, for matrix to be passed back from C subroutine
-    cdef cnp.ndarray[float, ndim=3, mode="c"] image = np.empty((nslices,nrows,ncols), dtype=ctypes.c_float)
+    cdef cnp.ndarray[float, ndim=3, mode="c"] image
+    if settings.get('out') is not None:
+        image = settings['out']
+    else:
+        image = np.empty((nslices,nrows,ncols), dtype=ctypes.c_float)
 
     # Write parameters to c structures
     cdef ImageParams3D imgparams_c
@@ -323,10 +376,16 @@ def backproject(sino, settings):
     convert_py2c_SinoParams3D(&sinoparams_c, sinoparams, cy_angles)
 
     cdef cnp.ndarray[char, ndim=1, mode="c"] Amatrix_fname
-    Amatrix_fname = string_to_char_array(paths['sysmatrix_name']+ '.2Dsvmatrix')
+    Amatrix_fname = string_to_char_array(settings.get('sysmatrix_file') or (paths['sysmatrix_name'] + '.2Dsvmatrix'))
+
+    cdef float *sino_c = &cy_sino[0,0,0]
+    cdef float *image_c = &image[0,0,0]
+    cdef char *Amatrix_fname_c = &Amatrix_fname[0]
+    cdef char verbose_c = verbose
 
-    # Back project by calling C subroutine
-    forwardProject(&cy_sino[0,0,0], &image[0,0,0], imgparams_c, sinoparams_c, &Amatrix_fname[0], 1, verbose)
+    # Back project by calling C subroutine, without the GIL so other Python threads keep running
+    with nogil:
+        forwardProject(sino_c, image_c, imgparams_c, sinoparams_c, Amatrix_fname_c, 1, verbose_c)
 
     return image
 
@@ -336,119 +395,267 @@ def multires_recon(sino, angles, weights, weight_type, init_image, prox_image, i
                    num_rows, num_cols, roi_radius, delta_channel, delta_pixel, center_offset,
                    sigma_y, sigma_x, p, q, T, b_interslice,
                    positivity, relax_factor, max_resolutions, stop_threshold, max_iterations,
-                   num_threads, delete_temps, svmbir_lib_path, object_name, verbose):
+                   num_threads, delete_temps, svmbir_lib_path, object_name, verbose, geometry_levels=None, out=None,
+                   proj_out=None, schedule=None, level_stats=None, segment_state=None):
     """Multi-resolution SVMBIR reconstruction used by svmbir.recon().
 
+    The sinogram, weights and initial projection are converted once to the (num_slices, num_views, num_channels)
+    float32 layout of the C library, and the same buffers are used at every resolution.
+    If segment_state is a dict, the call is one segment of a reconstruction that svmbir.recon() splits into
+    segments of a single resolution each. The C layout sinogram and weights, the reduced sinogram of the resolution
+    and the projection of the image are then kept in segment_state, and the next segment reuses them if it continues
+    from the image returned by this one, so that only the first segment of a resolution projects its initial image.
+    MBIRReconstruct does not return its projection, so if proj_out is given, the projection of the
+    reconstruction is computed with the system matrix of the finest resolution and written to proj_out.
+    The resolutions are those of schedule, a list as returned by utils.multires_schedule(), or if schedule is None,
+    max_resolutions halvings of the resolution. The coarse resolutions are reconstructed from a sinogram with
+    fewer views and binned channels as chosen by utils.multires_sino_geometry(). If level_stats is a list, the settings,
+    the sinogram size and the wall time of each resolution are appended to it, from coarsest to finest.
+
     Args: See svmbir.recon() for argument structure
     """
 
-    # Declare cython image array here so we can initialize in recursion block
-    cdef cnp.ndarray[float, ndim=3, mode="c"] py_image
-
-    # Determine if it the algorithm should reduce resolution further
-    go_to_lower_resolution = (max_resolutions > 0) and (min(num_rows, num_cols) > 16)
+    # Image grids from finest to coarsest, and the matching noise level: sigma_y grows with the square root of the scale
+    levels = schedule
+    if levels is None:
+        levels = utils.multires_schedule(sino.shape[1], num_rows, num_cols, delta_pixel, max_resolutions,
+                                         stop_threshold, max_iterations, relax_factor)
+    sigma_y_levels = [sigma_y * settings['scale']**0.5 for settings in levels]
+
+    # Reduce resolution of the initialization and proximal images if there are any
+    init_image_levels = [init_image]
+    prox_image_levels = [prox_image]
+    for settings in levels[1:]:
+        lr_shape = (settings['num_slices'], settings['num_rows'], settings['num_cols'])
+        (lr_num_rows, lr_num_cols) = lr_shape[1:]
+        lr_init_image = init_image_levels[-1]
+        if isinstance(lr_init_image, np.ndarray) and (lr_init_image.ndim == 3):
+            lr_init_image = utils.recon_resize(lr_init_image, lr_shape, num_threads=num_threads)
+        init_image_levels.append(lr_init_image)
+
+        lr_prox_image = prox_image_levels[-1]
+        if isinstance(lr_prox_image, np.ndarray) and (lr_prox_image.ndim == 3):
+            lr_prox_image = utils.recon_resize(lr_prox_image, lr_shape, num_threads=num_threads)
+        prox_image_levels.append(lr_prox_image)
 
-    # If resolution is too high, then do recursive call to lower resolutions
-    if go_to_lower_resolution:
-        new_max_resolutions = max_resolutions-1;
+        if verbose >= 1:
+            print(f'Calling multires_recon for axial size (rows,cols)=({lr_num_rows},{lr_num_cols}).')
 
-        # Set the pixel pitch, num_rows, and num_cols for the next lower resolution
-        lr_delta_pixel = 2 * delta_pixel
-        lr_num_rows = int(np.ceil(num_rows / 2))
-        lr_num_cols = int(np.ceil(num_cols / 2))
+    # Weights of the coarsest resolution; they are rescaled in place when moving to the next finer resolution.
+    if (segment_state is not None) and ('c_sino' in segment_state):
+        c_sino, c_weights = segment_state['c_sino'], segment_state['c_weights']
+        if segment_state['sigma_y'] != sigma_y_levels[-1]:
+            c_weights *= (segment_state['sigma_y'] / sigma_y_levels[-1])**2
+    else:
+        c_sino, c_weights = _c_sino_weights(sino, weights, weight_type, 1.0 / sigma_y_levels[-1]**2)
 
-        # Rescale sigma_y for lower resolution
-        lr_sigma_y = 2.0**0.5 * sigma_y
+    # Geometry setup of each resolution, shared by the reconstruction and the final projection
+    if geometry_levels is None:
+        geometry_levels = segment_state.setdefault('geometry_levels', dict()) if segment_state is not None else dict()
 
-        # Reduce resolution of initialization image if there is one
-        if isinstance(init_image, np.ndarray) and (init_image.ndim == 3):
-            lr_init_image = utils.recon_resize(init_image, (lr_num_rows, lr_num_cols))
+    c_proj_init = None
+    if init_proj is not None:
+        c_proj_init = np.ascontiguousarray(np.swapaxes(init_proj, 0, 1), dtype=np.single)
+
+    image = None
+    for level in reversed(range(len(levels))):
+        settings = levels[level]
+        (lr_num_rows, lr_num_cols, lr_delta_pixel) = (settings['num_rows'], settings['num_cols'], settings['delta_pixel'])
+        start_time = time.time()
+
+        # Interpolate the reconstruction of the previous resolution to initialize this one
+        if image is not None:
+            image = utils.recon_resize(image, (settings['num_slices'], lr_num_rows, lr_num_cols),
+                                       num_threads=num_threads)
+            c_weights *= levels[level + 1]['scale'] / settings['scale']
+            lr_init_image = image
         else:
-            lr_init_image = init_image
+            lr_init_image = init_image_levels[level]
+
+        # Fewer views, binned channels and, if the slices are coarsened, binned slices at coarse resolutions
+        lr_c_sino, lr_c_weights, lr_c_proj_init = c_sino, c_weights, c_proj_init
+        sino_geometry = utils.multires_sino_geometry(settings, angles, c_sino.shape[2], delta_channel, center_offset,
+                                                     magnification)
+        level_key = (settings['scale'], settings['slice_scale'])
+        if (segment_state is not None) and (segment_state.get('level_key') == level_key) and \
+           (segment_state.get('image') is lr_init_image):
+            # Next segment of the same resolution: the reduced sinogram and the projection of the image are kept
+            lr_c_sino, lr_c_weights, lr_c_proj_init = segment_state['level_data']
+        elif sino_geometry['decimate']:
+            lr_sino, lr_weights, _, _ = utils.decimate_sino(
+                np.swapaxes(c_sino, 0, 1), np.swapaxes(c_weights, 0, 1), angles, center_offset,
+                sino_geometry['view_step'], sino_geometry['channel_bin'], sino_geometry['slice_bin'])
+            lr_c_sino = np.ascontiguousarray(np.swapaxes(lr_sino, 0, 1))
+            lr_c_weights = np.ascontiguousarray(np.swapaxes(lr_weights, 0, 1))
+            lr_c_proj_init = None
+            del lr_sino, lr_weights
+
+        # The C library updates an initial projection in place to the projection of its result
+        if (segment_state is not None) and (lr_c_proj_init is None):
+            lr_c_proj_init = _c_proj_level(lr_init_image, lr_c_sino.shape, sino_geometry, geometry_levels,
+                                           geometry=geometry, dist_source_detector=dist_source_detector,
+                                           magnification=magnification, num_rows=lr_num_rows,
+                                           num_cols=lr_num_cols, roi_radius=roi_radius, delta_pixel=lr_delta_pixel,
+                                           num_threads=num_threads, svmbir_lib_path=svmbir_lib_path,
+                                           object_name=object_name, verbose=verbose)
+
+        image = _recon_level(lr_c_sino, lr_c_weights, lr_c_proj_init, sino_geometry['angles'], lr_init_image,
+                             prox_image_levels[level],
+                             init_image_value=init_image if np.isscalar(init_image) else 0, weight_type=weight_type,
+                             geometry=geometry, dist_source_detector=dist_source_detector,
+                             magnification=magnification, num_rows=lr_num_rows, num_cols=lr_num_cols,
+                             roi_radius=roi_radius, delta_channel=sino_geometry['delta_channel'],
+                             delta_pixel=lr_delta_pixel, center_offset=sino_geometry['center_offset'],
+                             sigma_y=sigma_y_levels[level], sigma_x=sigma_x,
+                             p=p, q=q, T=T, b_interslice=b_interslice, positivity=positivity,
+                             relax_factor=settings['relax_factor'], stop_threshold=settings['stop_threshold'],
+                             max_iterations=settings['max_iterations'], num_threads=num_threads,
+                             svmbir_lib_path=svmbir_lib_path, object_name=object_name, verbose=verbose,
+                             geometry_levels=geometry_levels, out=out if level == 0 else None)
+
+        if level_stats is not None:
+            level_stats.append(dict(settings, num_views=lr_c_sino.shape[1], num_channels=lr_c_sino.shape[2],
+                                    time=time.time() - start_time))
+        if segment_state is not None:
+            segment_state.update(level_key=level_key, level_data=(lr_c_sino, lr_c_weights, lr_c_proj_init),
+                                 image=image)
+        del lr_c_sino, lr_c_weights
+
+    if proj_out is not None:
+        (num_views, num_slices, num_channels) = sino.shape
+        paths, sinoparams, imgparams = _get_geometry(geometry_levels, angles, center_offset=center_offset,
+                                                     geometry=geometry, dist_source_detector=dist_source_detector,
+                                                     magnification=magnification, num_channels=num_channels,
+                                                     num_views=num_views, num_slices=num_slices,
+                                                     num_rows=num_rows, num_cols=num_cols,
+                                                     delta_channel=delta_channel, delta_pixel=delta_pixel,
+                                                     roi_radius=roi_radius, svmbir_lib_path=svmbir_lib_path,
+                                                     object_name=object_name, verbose=verbose)
+        project(image, dict(paths=paths, sinoparams=sinoparams, imgparams=imgparams, verbose=verbose,
+                            num_threads=num_threads, out=proj_out))
+
+    if segment_state is not None:
+        segment_state.update(c_sino=c_sino, c_weights=c_weights, sigma_y=sigma_y_levels[0])
+    return image
 
-        # Reduce resolution of proximal image if there is one
-        if isinstance(prox_image, np.ndarray) and (prox_image.ndim == 3):
-            lr_prox_image = utils.recon_resize(prox_image, (lr_num_rows, lr_num_cols))
-        else:
-            lr_prox_image = prox_image
 
-        if verbose >= 1:
-            print(f'Calling multires_recon for axial size (rows,cols)=({lr_num_rows},{lr_num_cols}).')
+def _c_proj_level(image, c_shape, sino_geometry, geometry_levels, geometry, dist_source_detector, magnification,
+                  num_rows, num_cols, roi_radius, delta_pixel, num_threads, svmbir_lib_path, object_name, verbose):
+    """Return the projection of an image or initial value in the C layout c_shape of the sinogram of a resolution.
+    """
+    (num_slices, num_views, num_channels) = c_shape
+    c_proj = np.empty(c_shape, dtype=np.single)
+    if np.isscalar(image) and (image == 0):
+        c_proj.fill(0.0)
+        return c_proj
+    if np.isscalar(image):
+        image = np.full((num_slices, num_rows, num_cols), image, dtype=np.single)
+    paths, sinoparams, imgparams = _get_geometry(geometry_levels, sino_geometry['angles'],
+                                                 center_offset=sino_geometry['center_offset'], geometry=geometry,
+                                                 dist_source_detector=dist_source_detector,
+                                                 magnification=magnification, num_channels=num_channels,
+                                                 num_views=num_views, num_slices=num_slices,
+                                                 num_rows=num_rows, num_cols=num_cols,
+                                                 delta_channel=sino_geometry['delta_channel'],
+                                                 delta_pixel=delta_pixel, roi_radius=roi_radius,
+                                                 svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                                                 verbose=verbose)
+    project(image, dict(paths=paths, sinoparams=sinoparams, imgparams=imgparams, verbose=verbose,
+                        num_threads=num_threads, out=np.swapaxes(c_proj, 0, 1)))
+    return c_proj
+
+
+def _c_sino_weights(sino, weights, weight_type, weight_scale):
+    """Convert a sinogram and its weights to the float32 (num_slices, num_views, num_channels) layout of the C library.
+
+    The weights are scaled by weight_scale, normally 1/sigma_y**2, in the same pass as the transpose.
+    Without a weights array, the weights of weight_type are computed directly in the C layout buffer.
 
-        lr_recon = multires_recon(sino=sino, angles=angles, weights=weights, weight_type=weight_type,
-                        geometry=geometry, dist_source_detector=dist_source_detector, magnification=magnification,
-                        init_image=lr_init_image, prox_image=lr_prox_image, init_proj=init_proj,
-                        num_rows=lr_num_rows, num_cols=lr_num_cols, roi_radius=roi_radius,
-                        delta_channel=delta_channel, delta_pixel=lr_delta_pixel, center_offset=center_offset,
-                        sigma_y=lr_sigma_y, sigma_x=sigma_x, p=p,q=q,T=T,b_interslice=b_interslice,
-                        positivity=positivity, relax_factor=relax_factor, max_resolutions=new_max_resolutions,
-                        stop_threshold=stop_threshold, max_iterations=max_iterations, num_threads=num_threads,
-                        delete_temps=delete_temps, svmbir_lib_path=svmbir_lib_path, object_name=object_name,
-                        verbose=verbose)
-
-        # Interpolate resolution of reconstruction
-        new_init_image = utils.recon_resize(lr_recon, (num_rows, num_cols))
-        del lr_recon
-
-        # Initialize cython image array and de-allocate
-        if not new_init_image.flags["C_CONTIGUOUS"]:
-            new_init_image = np.ascontiguousarray(new_init_image, dtype=np.single)
-        else:
-            new_init_image = new_init_image.astype(np.single, copy=False)
-        py_image = new_init_image
+    Returns:
+        A tuple (c_sino, c_weights).
+    """
+    c_sino = np.ascontiguousarray(np.swapaxes(sino, 0, 1), dtype=np.single)
+    c_weights = np.empty(c_sino.shape, dtype=np.single)
+    if weights is None:
+        utils.calc_weights_into(c_sino, weight_type, c_weights)
+        c_weights *= weight_scale
+    else:
+        utils.weights_array(weights, sino.shape, weight_scale, out=np.swapaxes(c_weights, 0, 1))
+    return c_sino, c_weights
+
+
+def _recon_level(c_sino, c_weights, c_proj_init, angles, init_image, prox_image, init_image_value, weight_type,
+                 geometry, dist_source_detector, magnification,
+                 num_rows, num_cols, roi_radius, delta_channel, delta_pixel, center_offset,
+                 sigma_y, sigma_x, p, q, T, b_interslice, positivity, relax_factor, stop_threshold, max_iterations,
+                 num_threads, svmbir_lib_path, object_name, verbose, geometry_levels=None, out=None,
+                 sysmatrix_file=None):
+    """Reconstruct at a single resolution with the C library.
+
+    Args:
+        c_sino (ndarray): float32 sinogram in C layout (num_slices, num_views, num_channels).
+        c_weights (ndarray): float32 weights in C layout, already divided by sigma_y**2.
+        c_proj_init (ndarray): float32 initial projection in C layout, or None.
+        init_image_value (float): Value of the initial image passed to the C library as InitImageValue.
+        weight_type (string): Noise model the weights were computed with. The weights are always read from c_weights.
+        sysmatrix_file (string): Path of a pinned system matrix file to use, or None.
+        Other args: See svmbir.recon() for argument structure
+
+    Returns:
+        ndarray: Reconstruction at this resolution. If out is given, it is returned.
+    """
 
     # Perform reconstruction at current resolution
     if verbose >= 1 :
         print(f'Reconstructing axial size (rows,cols)=({num_rows},{num_cols}).')
 
     # Collect parameters to pass to C
-    (num_views, num_slices, num_channels) = sino.shape
+    (num_slices, num_views, num_channels) = c_sino.shape
 
     reconparams = utils.get_reconparams_dicts(sigma_y, positivity, relax_factor, sigma_x, p, q, T, b_interslice,
                         stop_threshold, max_iterations, interface = 'Cython')
 
-    paths, sinoparams, imgparams = _init_geometry(angles, center_offset=center_offset,
-                                                  geometry=geometry, dist_source_detector=dist_source_detector,
-                                                  magnification=magnification,
-                                                  num_channels=num_channels, num_views=num_views, num_slices=num_slices,
-                                                  num_rows=num_rows, num_cols=num_cols,
-                                                  delta_channel=delta_channel, delta_pixel=delta_pixel,
-                                                  roi_radius=roi_radius,
-                                                  svmbir_lib_path=svmbir_lib_path, object_name=object_name,
-                                                  verbose=verbose)
+    paths, sinoparams, imgparams = _get_geometry(geometry_levels, angles, center_offset=center_offset,
+                                                 geometry=geometry, dist_source_detector=dist_source_detector,
+                                                 magnification=magnification,
+                                                 num_channels=num_channels, num_views=num_views, num_slices=num_slices,
+                                                 num_rows=num_rows, num_cols=num_cols,
+                                                 delta_channel=delta_channel, delta_pixel=delta_pixel,
+                                                 roi_radius=roi_radius,
+                                                 svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                                                 verbose=verbose)
     # Collect data and settings to pass to c
     cdef int nrows = imgparams['Ny']
     cdef int ncols = imgparams['Nx']
-    py_sino = np.swapaxes(sino, 0, 1)
-    py_sino = np.ascontiguousarray(py_sino, dtype=np.single)
-    py_weight = np.swapaxes(weights, 0, 1)/sigma_y**2
-    py_weight = np.ascontiguousarray(py_weight, dtype=np.single)
 
-    cdef cnp.ndarray[float, ndim=3, mode="c"] cy_sino = py_sino
-    cdef cnp.ndarray[float, ndim=3, mode="c"] cy_weight = py_weight
+    cdef cnp.ndarray[float, ndim=3, mode="c"] cy_sino = c_sino
+    cdef cnp.ndarray[float, ndim=3, mode="c"] cy_weight = c_weights
     cdef cnp.ndarray[float, ndim=3, mode="c"] cy_proj_init
     cdef cnp.ndarray[float, ndim=3, mode="c"] cy_prox_image
-    #cdef cnp.ndarray[float, ndim=3, mode="c"] py_image
+    cdef cnp.ndarray[float, ndim=3, mode="c"] py_image
     cdef cnp.ndarray[char, ndim=1, mode="c"] Amatrix_fname
 
-    if 'py_image' not in locals():
-        if np.isscalar(init_image):
+    if np.isscalar(init_image):
+        if out is not None:
+            out.fill(init_image)
+            py_image = out
+        else:
             py_image = np.zeros((num_slices, nrows, ncols), dtype=ctypes.c_float) + init_image
+    else:
+        if not init_image.flags["C_CONTIGUOUS"]:
+            init_image = np.ascontiguousarray(init_image, dtype=np.single)
         else:
-            if not init_image.flags["C_CONTIGUOUS"]:
-                init_image = np.ascontiguousarray(init_image, dtype=np.single)
-            else:
-                init_image = init_image.astype(np.single, copy=False)
-            py_image = init_image
+            init_image = init_image.astype(np.single, copy=False)
+        py_image = init_image
+    reconparams['init_image_value'] = init_image_value
 
-    if np.isscalar(init_image):
-        reconparams['init_image_value'] = init_image
-    else:
-        reconparams['init_image_value'] = 0
+    # Reconstruct in the caller's buffer
+    if (out is not None) and (py_image is not out):
+        np.copyto(out, py_image)
+        py_image = out
 
-    if init_proj is not None:
-        cy_proj_init = np.swapaxes(init_proj, 0, 1)
-        cy_proj_init = np.ascontiguousarray(cy_proj_init, dtype=np.single)
+    if c_proj_init is not None:
+        cy_proj_init = c_proj_init
 
     if prox_image is not None:
         if not prox_image.flags["C_CONTIGUOUS"]:
@@ -467,21 +674,30 @@ def multires_recon(sino, angles, weights, weight_type, init_image, prox_image, i
     convert_py2c_SinoParams3D(&sinoparams_c, sinoparams, cy_angles)
     convert_py2c_ReconParams3D(&reconparams_c, reconparams)
 
-    Amatrix_fname = string_to_char_array(paths['sysmatrix_name']+ '.2Dsvmatrix')
+    Amatrix_fname = string_to_char_array(sysmatrix_file or (paths['sysmatrix_name'] + '.2Dsvmatrix'))
 
     openmp.omp_set_num_threads(num_threads)
 
-    # Reconstruct by calling C subroutine
-    MBIRReconstruct(&py_image[0,0,0],
-                    &cy_sino[0,0,0],
-                    &cy_weight[0,0,0],
-                    &cy_proj_init[0,0,0] if init_proj is not None else NULL,
-                    &cy_prox_image[0,0,0] if prox_image is not None else NULL,
-                    imgparams_c,
-                    sinoparams_c,
-                    reconparams_c,
-                    &Amatrix_fname[0],
-                    verbose)
+    cdef float *image_c = &py_image[0,0,0]
+    cdef float *sino_c = &cy_sino[0,0,0]
+    cdef float *weight_c = &cy_weight[0,0,0]
+    cdef float *proj_init_c = &cy_proj_init[0,0,0] if c_proj_init is not None else NULL
+    cdef float *prox_image_c = &cy_prox_image[0,0,0] if prox_image is not None else NULL
+    cdef char *Amatrix_fname_c = &Amatrix_fname[0]
+    cdef char verbose_c = verbose
+
+    # Reconstruct by calling C subroutine, without the GIL so other Python threads keep running
+    with nogil:
+        MBIRReconstruct(image_c,
+                        sino_c,
+                        weight_c,
+                        proj_init_c,
+                        prox_image_c,
+                        imgparams_c,
+                        sinoparams_c,
+                        reconparams_c,
+                        Amatrix_fname_c,
+                        verbose_c)
 
     # Return cython ndarray
     return py_image
@@ -5,6 +5,7 @@
 # These imports are needed only for read/write and command line interfaces
 import subprocess
 import os
+import time
 import numpy as np
 import svmbir._utils as utils
 from ruamel.yaml import YAML
@@ -126,14 +127,8 @@ def _gen_sysmatrix_c(sinoparams, imgparams, angles, settings):
 
     # Calculate the system matrix (or use existing if one exists)
     # In this version the matrix is saved to disk
-    Amatrix_file = paths['sysmatrix_name'] + '.2Dsvmatrix'
-    if os.path.exists(Amatrix_file) :
-        if verbose > 0:
-            print('Found system matrix: {}'.format(sysmatrix_name + '.2Dsvmatrix'))
-        if os.access(Amatrix_file, os.W_OK):
-            os.utime(Amatrix_file)  # update file modified time
-    else :
-        _cmd_exec(i=param_name, j=param_name, m=sysmatrix_name, v=str(verbose))
+    utils.get_sysmatrix(sysmatrix_name,
+                        lambda tmp_name: _cmd_exec(i=param_name, j=param_name, m=tmp_name, v=str(verbose)), verbose)
 
     # Return the sysmatrix (or info to get it in this case)
     return paths
@@ -182,41 +177,74 @@ def _init_geometry( angles, num_channels, num_views, num_slices, num_rows, num_c
     return paths, sinoparams, imgparams
 
 
+def _get_geometry(geometry_levels, angles, num_channels, num_views, num_slices, num_rows, num_cols,
+                  geometry, dist_source_detector, magnification,
+                  delta_channel, delta_pixel, roi_radius, center_offset, verbose,
+                  svmbir_lib_path = __svmbir_lib_path, object_name = 'object'):
+    """Same as _init_geometry(). The parameter files read by the command line program are written on
+    every call, so the results stored in geometry_levels by the Cython interface are not used here.
+    """
+    return _init_geometry(angles, center_offset=center_offset,
+                          geometry=geometry, dist_source_detector=dist_source_detector,
+                          magnification=magnification,
+                          num_channels=num_channels, num_views=num_views, num_slices=num_slices,
+                          num_rows=num_rows, num_cols=num_cols,
+                          delta_channel=delta_channel, delta_pixel=delta_pixel,
+                          roi_radius=roi_radius,
+                          svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                          verbose=verbose)
+
+
 def multires_recon(sino, angles, weights, weight_type, init_image, prox_image, init_proj,
                    geometry, dist_source_detector, magnification,
                    num_rows, num_cols, roi_radius, delta_channel, delta_pixel, center_offset,
                    sigma_y, sigma_x, p, q, T, b_interslice,
                    positivity, relax_factor, max_resolutions, stop_threshold, max_iterations,
-                   num_threads, delete_temps, svmbir_lib_path, object_name, verbose):
+                   num_threads, delete_temps, svmbir_lib_path, object_name, verbose, geometry_levels=None, out=None,
+                   proj_out=None, schedule=None, level_stats=None, segment_state=None):
     """Multi-resolution SVMBIR reconstruction used by svmbir.recon().
 
+    If proj_out is given, the projection of the reconstruction that the executable computes is written to proj_out.
+    segment_state is accepted for compatibility with the Cython interface: the executable reads all of its inputs
+    from files at every call, so every segment of a reconstruction starts with a forward projection.
+    The resolutions are those of schedule, a list as returned by utils.multires_schedule(), or if schedule is None,
+    max_resolutions halvings of the resolution. The coarse resolutions are reconstructed from a sinogram with
+    fewer views and binned channels as chosen by utils.multires_sino_geometry(). If level_stats is a list, the settings,
+    the sinogram size and the wall time of each resolution are appended to it, from coarsest to finest.
+
     Args: See svmbir.recon() for argument structure
     """
 
+    # Resolutions from the current one to the coarsest
+    if schedule is None:
+        schedule = utils.multires_schedule(sino.shape[1], num_rows, num_cols, delta_pixel, max_resolutions,
+                                           stop_threshold, max_iterations, relax_factor)
+    settings = schedule[0]
+
     # Determine if it the algorithm should reduce resolution further
-    go_to_lower_resolution = (max_resolutions > 0) and (min(num_rows, num_cols) > 16)
+    go_to_lower_resolution = len(schedule) > 1
 
     # If resolution is too high, then do recursive call to lower resolutions
     if go_to_lower_resolution:
-        new_max_resolutions = max_resolutions-1;
-
-        # Set the pixel pitch, num_rows, and num_cols for the next lower resolution
-        lr_delta_pixel = 2 * delta_pixel
-        lr_num_rows = int(np.ceil(num_rows / 2))
-        lr_num_cols = int(np.ceil(num_cols / 2))
+        lr_settings = schedule[1]
 
-        # Rescale sigma_y for lower resolution
-        lr_sigma_y = 2.0**0.5 * sigma_y
+        # Set the pixel pitch, num_slices, num_rows, and num_cols for the next lower resolution
+        lr_delta_pixel = lr_settings['delta_pixel']
+        lr_num_slices = lr_settings['num_slices']
+        lr_num_rows = lr_settings['num_rows']
+        lr_num_cols = lr_settings['num_cols']
 
         # Reduce resolution of initialization image if there is one
         if isinstance(init_image, np.ndarray) and (init_image.ndim == 3):
-            lr_init_image = utils.recon_resize(init_image, (lr_num_rows, lr_num_cols))
+            lr_init_image = utils.recon_resize(init_image, (lr_num_slices, lr_num_rows, lr_num_cols),
+                                               num_threads=num_threads)
         else:
             lr_init_image = init_image
 
         # Reduce resolution of proximal image if there is one
         if isinstance(prox_image, np.ndarray) and (prox_image.ndim == 3):
-            lr_prox_image = utils.recon_resize(prox_image, (lr_num_rows, lr_num_cols))
+            lr_prox_image = utils.recon_resize(prox_image, (lr_num_slices, lr_num_rows, lr_num_cols),
+                                               num_threads=num_threads)
         else:
             lr_prox_image = prox_image
 
@@ -228,20 +256,45 @@ def multires_recon(sino, angles, weights, weight_type, init_image, prox_image, i
                         init_image=lr_init_image, prox_image=lr_prox_image, init_proj=init_proj,
                         num_rows=lr_num_rows, num_cols=lr_num_cols, roi_radius=roi_radius,
                         delta_channel=delta_channel, delta_pixel=lr_delta_pixel, center_offset=center_offset,
-                        sigma_y=lr_sigma_y, sigma_x=sigma_x, p=p,q=q,T=T,b_interslice=b_interslice,
-                        positivity=positivity, relax_factor=relax_factor, max_resolutions=new_max_resolutions,
+                        sigma_y=sigma_y, sigma_x=sigma_x, p=p,q=q,T=T,b_interslice=b_interslice,
+                        positivity=positivity, relax_factor=relax_factor, max_resolutions=max_resolutions,
                         stop_threshold=stop_threshold, max_iterations=max_iterations, num_threads=num_threads,
                         delete_temps=delete_temps, svmbir_lib_path=svmbir_lib_path, object_name=object_name,
-                        verbose=verbose)
+                        verbose=verbose, geometry_levels=geometry_levels, schedule=schedule[1:],
+                        level_stats=level_stats)
 
         # Interpolate resolution of reconstruction
-        new_init_image = utils.recon_resize(lr_recon, (num_rows, num_cols))
+        start_time = time.time()
+        new_init_image = utils.recon_resize(lr_recon, (settings['num_slices'], num_rows, num_cols),
+                                            num_threads=num_threads)
         del lr_recon
+    else:
+        start_time = time.time()
 
     # Perform reconstruction at current resolution
     if verbose >= 1 :
         print(f'Reconstructing axial size (rows,cols)=({num_rows},{num_cols}).')
 
+    # Fewer views, binned channels and, if the slices are coarsened, binned slices at coarse resolutions
+    sino_geometry = utils.multires_sino_geometry(settings, angles, sino.shape[2], delta_channel, center_offset,
+                                                 magnification)
+    if sino_geometry['decimate']:
+        if weights is None:
+            full_weights = utils.calc_weights_into(sino, weight_type, np.empty(sino.shape, dtype=np.float32))
+        else:
+            full_weights = utils.weights_array(weights, sino.shape)
+        sino, weights, _, _ = utils.decimate_sino(sino, full_weights, angles, center_offset, sino_geometry['view_step'],
+                                                  sino_geometry['channel_bin'], sino_geometry['slice_bin'])
+        del full_weights
+        weights = (weights,)
+        angles, delta_channel = sino_geometry['angles'], sino_geometry['delta_channel']
+        center_offset = sino_geometry['center_offset']
+        init_proj = None
+
+    # The executable computes emission weights as 1/(y+0.1) rather than 1/(|y|+0.1), so they are passed as a file
+    if (weights is None) and (weight_type == 'emission'):
+        weights = (utils.calc_weights_into(sino, weight_type, np.empty(sino.shape, dtype=np.float32)),)
+
     # Collect parameters to pass to C
     (num_views, num_slices, num_channels) = sino.shape
 
@@ -250,26 +303,29 @@ def multires_recon(sino, angles, weights, weight_type, init_image, prox_image, i
     else :
         init_image_value = 0
 
-    reconparams = utils.get_reconparams_dicts(sigma_y, positivity, relax_factor, sigma_x, p, q, T, b_interslice,
-                            stop_threshold, max_iterations,init_image_value=init_image_value, interface = 'Command Line')
-
-    paths, sinoparams, imgparams = _init_geometry(angles, center_offset=center_offset,
-                                                  geometry=geometry, dist_source_detector=dist_source_detector,
-                                                  magnification=magnification,
-                                                  num_channels=num_channels, num_views=num_views, num_slices=num_slices,
-                                                  num_rows=num_rows, num_cols=num_cols,
-                                                  delta_channel=delta_channel, delta_pixel=delta_pixel,
-                                                  roi_radius=roi_radius,
-                                                  svmbir_lib_path=svmbir_lib_path, object_name=object_name,
-                                                  verbose=verbose)
+    # sigma_y grows with the square root of the scale of the resolution
+    reconparams = utils.get_reconparams_dicts(sigma_y * settings['scale']**0.5, positivity, settings['relax_factor'],
+                            sigma_x, p, q, T, b_interslice, settings['stop_threshold'], settings['max_iterations'],
+                            init_image_value=init_image_value, interface = 'Command Line',
+                            weight_type = weight_type if weights is None else 'unweighted')
+
+    paths, sinoparams, imgparams = _get_geometry(geometry_levels, angles, center_offset=center_offset,
+                                                 geometry=geometry, dist_source_detector=dist_source_detector,
+                                                 magnification=magnification,
+                                                 num_channels=num_channels, num_views=num_views, num_slices=num_slices,
+                                                 num_rows=num_rows, num_cols=num_cols,
+                                                 delta_channel=delta_channel, delta_pixel=delta_pixel,
+                                                 roi_radius=roi_radius,
+                                                 svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                                                 verbose=verbose)
 
     # Interface to disk and command line
     cmd_args = dict(i=paths['param_name'], j=paths['param_name'], k=paths['param_name'],
-                    s=paths['sino_name'], r=paths['recon_name'], m=paths['sysmatrix_name'],
-                    w=paths['wght_name'], v=str(verbose))
+                    s=paths['sino_name'], r=paths['recon_name'], m=paths['sysmatrix_name'], v=str(verbose))
 
-    # We're doing anything with projection of the output, so removing to save work
-    # cmd_args['f'] = paths['proj_name']
+    # The executable writes the projection of its result only when it is requested
+    if proj_out is not None:
+        cmd_args['f'] = paths['proj_name']
 
     # Initializing initial conditon w/ multi-res result like this allows de-allocation
     if 'new_init_image' in locals():
@@ -280,9 +336,8 @@ def multires_recon(sino, angles, weights, weight_type, init_image, prox_image, i
         write_recon_openmbir(init_image, paths['init_name'] + '_slice', '.2Dimgdata')
         cmd_args['t'] = paths['init_name']
 
-    if init_proj is not None:
-        write_sino_openmbir(init_proj, paths['init_proj_name'] + '_slice', '.2Dsinodata')
-        cmd_args['e'] = paths['init_proj_name']
+    # init_proj is not passed to the executable: reading it with -e overwrites the name of the system matrix
+    # file in mbir_ct, so the executable computes the projection of the initial image itself.
 
     if prox_image is not None:
         write_recon_openmbir(prox_image, paths['prox_name'] + '_slice', '.2Dimgdata')
@@ -293,12 +348,18 @@ def multires_recon(sino, angles, weights, weight_type, init_image, prox_image, i
     write_params(paths['reconparams_fname'], **reconparams_c)
 
     write_sino_openmbir(sino, paths['sino_name'] + '_slice', '.2Dsinodata')
-    write_sino_openmbir(weights, paths['wght_name'] + '_slice', '.2Dweightdata')
+    # Without a weights array, the executable computes the weights of weight_type itself, except for emission
+    if weights is not None:
+        write_sino_openmbir(utils.weights_array(weights, sino.shape), paths['wght_name'] + '_slice', '.2Dweightdata')
+        cmd_args['w'] = paths['wght_name']
 
     _cmd_exec(**cmd_args)
 
     x = read_recon_openmbir(paths['recon_name'] + '_slice', '.2Dimgdata',
-                            imgparams['Nx'], imgparams['Ny'], imgparams['Nz'])
+                            imgparams['Nx'], imgparams['Ny'], imgparams['Nz'], out=out)
+    if proj_out is not None:
+        read_sino_openmbir(paths['proj_name'] + '_slice', '.2Dprojection',
+                           sinoparams['num_views'], sinoparams['num_slices'], sinoparams['num_channels'], out=proj_out)
 
     if delete_temps:
         os.remove(paths['sinoparams_fname'])
@@ -308,18 +369,21 @@ def multires_recon(sino, angles, weights, weight_type, init_image, prox_image, i
 
         delete_data_openmbir(paths['recon_name'] + '_slice', '.2Dimgdata', imgparams['Nz'])
         delete_data_openmbir(paths['sino_name'] + '_slice', '.2Dsinodata', sinoparams['num_slices'])
-        # delete_data_openmbir(paths['proj_name'] + '_slice', '.2Dprojection', sinoparams['num_slices'])
-        delete_data_openmbir(paths['wght_name'] + '_slice', '.2Dweightdata', sinoparams['num_slices'])
+        if 'f' in cmd_args:
+            delete_data_openmbir(paths['proj_name'] + '_slice', '.2Dprojection', sinoparams['num_slices'])
+        if 'w' in cmd_args:
+            delete_data_openmbir(paths['wght_name'] + '_slice', '.2Dweightdata', sinoparams['num_slices'])
 
         if 't' in cmd_args:
             delete_data_openmbir(paths['init_name'] + '_slice', '.2Dimgdata', imgparams['Nz'])
 
-        if init_proj is not None:
-            delete_data_openmbir(paths['init_proj_name'] + '_slice', '.2Dprojection', sinoparams['num_slices'])
-
         if prox_image is not None:
             delete_data_openmbir(paths['prox_name'] + '_slice', '.2Dimgdata', imgparams['Nz'])
 
+    if level_stats is not None:
+        level_stats.append(dict(settings, num_views=num_views, num_channels=num_channels,
+                                time=time.time() - start_time))
+
     return x
 
 
@@ -346,7 +410,8 @@ def project(image, settings):
               f=paths['proj_name'], t=paths['recon_name'], v=str(verbose))
 
     proj = read_sino_openmbir(paths['proj_name'] + '_slice', '.2Dprojection',
-                              sinoparams['num_views'], sinoparams['num_slices'], sinoparams['num_channels'])
+                              sinoparams['num_views'], sinoparams['num_slices'], sinoparams['num_channels'],
+                              out=settings.get('out'))
 
     if delete_temps :
         os.remove(paths['sinoparams_fname'])
@@ -386,7 +451,7 @@ def backproject(sino, settings):
     _cmd_exec(__exec_path__,*cmd_opts,**cmd_args)
 
     image = read_recon_openmbir(paths['recon_name'] + '_slice', '.2Dimgdata',
-                                imgparams['Nx'], imgparams['Ny'], imgparams['Nz'])
+                                imgparams['Nx'], imgparams['Ny'], imgparams['Nz'], out=settings.get('out'))
 
     if delete_temps :
         os.remove(paths['sinoparams_fname'])
@@ -480,9 +545,16 @@ def readAngleList(filePath):
 ## mbir read/write/delete Binary Files ##
 #########################################
 
-def read_sino_openmbir(rootPath, suffix, N_theta, N_z, N_y):
+def read_sino_openmbir(rootPath, suffix, N_theta, N_z, N_y, out=None):
     fname_list = generateFileList(N_z, rootPath, suffix, numdigit=4)
 
+    # read each slice directly into the N_theta x N_z x N_y output buffer
+    if out is not None:
+        for i, fname in enumerate(fname_list) :
+            with open(fname, 'rb') as fileID :
+                out[:, i] = np.fromfile(fileID, dtype='float32', count=N_theta * N_y).reshape([N_theta, N_y])
+        return out
+
     sizesArray = (N_z, N_theta, N_y)
     x = np.zeros(sizesArray, dtype=np.float32)
 
@@ -512,11 +584,11 @@ def write_sino_openmbir(x, rootPath, suffix):
             x[i].astype('float32').flatten('C').tofile(fileID)
 
 
-def read_recon_openmbir(rootPath, suffix, N_x, N_y, N_z):
+def read_recon_openmbir(rootPath, suffix, N_x, N_y, N_z, out=None):
     fname_list = generateFileList(N_z, rootPath, suffix, numdigit=4)
 
     sizesArray = (N_z, N_y, N_x)
-    x = np.zeros(sizesArray, dtype=np.float32)
+    x = np.zeros(sizesArray, dtype=np.float32) if out is None else out
 
     for i, fname in enumerate(fname_list) :
         with open(fname, 'rb') as fileID :
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2020-2024 by SVMBIR Developers
+# All rights reserved. BSD 3-clause License.
+
+"""
+Command line interface to svmbir.precompute_sysmatrix().
+
+Usage::
+
+    svmbir-precompute geometries.yaml [--max-resolutions 2] [--num-workers 8]
+
+The geometry file is a JSON or YAML file containing either a list of geometries, or a dict with the
+list under the key ``geometries`` and optionally ``max_resolutions``. Each geometry holds the geometry
+arguments of ``svmbir.recon``. The view angles are given either as a list of angles in radians, or as a dict
+``{start: ..., stop: ..., num_views: ..., endpoint: ...}`` that is passed to ``numpy.linspace``.
+For example::
+
+    geometries:
+      - angles: {start: -1.5708, stop: 1.5708, num_views: 144, endpoint: false}
+        num_channels: 256
+      - angles: {start: 0.0, stop: 6.2832, num_views: 360}
+        num_channels: 512
+        geometry: fan-curved
+        dist_source_detector: 1000.0
+        magnification: 2.0
+"""
+
+import argparse
+import json
+import numpy as np
+import svmbir
+
+
+def read_geometries(fname):
+    """Read a list of geometries from a JSON or YAML file.
+
+    Args:
+        fname (string): Path of the geometry file.
+
+    Returns:
+        A tuple (geometries, max_resolutions), where max_resolutions is None if the file does not set it.
+    """
+    with open(fname, 'r') as fileID:
+        if fname.endswith('.json'):
+            contents = json.load(fileID)
+        else:
+            try:
+                from ruamel.yaml import YAML
+            except ImportError:
+                raise Exception("Reading YAML geometry files requires the ruamel.yaml package; use a JSON file instead.")
+            contents = YAML(typ='safe').load(fileID)
+
+    max_resolutions = None
+    if isinstance(contents, dict):
+        max_resolutions = contents.get('max_resolutions')
+        contents = contents['geometries']
+
+    geometries = []
+    for geom in contents:
+        geom = dict(geom)
+        angles = geom['angles']
+        if isinstance(angles, dict):
+            geom['angles'] = np.linspace(angles['start'], angles['stop'], angles['num_views'],
+                                         endpoint=angles.get('endpoint', True))
+        else:
+            geom['angles'] = np.array(angles, dtype=np.float64)
+        geometries.append(geom)
+
+    return geometries, max_resolutions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='svmbir-precompute',
+                                     description='Compute and cache the svmbir system matrices of a list of geometries.')
+    parser.add_argument('geometry_file', help='JSON or YAML file listing the geometries')
+    parser.add_argument('--max-resolutions', type=int, default=None,
+                        help='number of lower resolutions to precompute (default: file setting or 2)')
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--svmbir-lib-path', default=svmbir._svmbir_lib_path(),
+                        help='svmbir cache directory (default: %(default)s)')
+    parser.add_argument('--verbose', type=int, default=1, help='level of printed status output')
+    args = parser.parse_args(argv)
+
+    geometries, max_resolutions = read_geometries(args.geometry_file)
+    if args.max_resolutions is not None:
+        max_resolutions = args.max_resolutions
+    if max_resolutions is None:
+        max_resolutions = 2
+
+    sysmatrix_files = svmbir.precompute_sysmatrix(geometries, max_resolutions=max_resolutions,
+                                                  num_workers=args.num_workers,
+                                                  svmbir_lib_path=args.svmbir_lib_path, verbose=args.verbose)
+    if args.verbose >= 1:
+        for fname in sysmatrix_files:
+            print(fname)
+
+
+if __name__ == '__main__':
+    main()
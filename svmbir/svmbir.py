@@ -3,11 +3,17 @@
 # All rights reserved. BSD 3-clause License.
 
 from psutil import cpu_count
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import functools
+import math
+import multiprocessing
 import shutil
 import numpy as np
 import os
 import sys
+import time
 import warnings
+import weakref
 import svmbir._utils as utils
 
 if os.environ.get('CLIB') =='CMD_LINE':
@@ -17,6 +23,9 @@ else:
 
 __svmbir_lib_path = os.path.join(os.path.expanduser('~'), '.cache', 'svmbir')
 
+# Independent slice groups (b_interslice == 0) are reconstructed in separate processes with this many threads each
+__slice_group_threads = 4
+
 
 def _svmbir_lib_path():
     """Returns the path to the cache directory used by svmbir
@@ -33,6 +42,38 @@ def _clear_cache(svmbir_lib_path = __svmbir_lib_path):
     shutil.rmtree(svmbir_lib_path)
 
 
+def _set_cache_limit(max_bytes, svmbir_lib_path = __svmbir_lib_path):
+    """Set the byte budget of the system matrix cache.
+
+    Whenever a new system matrix is added and the cache exceeds the budget, the least recently used
+    system matrices are deleted. The default budget is read from the ``SVMBIR_CACHE_LIMIT``
+    environment variable, and the cache is unbounded if it is not set.
+
+    Args:
+        max_bytes (int or string): Budget in bytes, or a string with a unit suffix such as '50G'.
+            If None, the cache is unbounded.
+        svmbir_lib_path (string): Path to svmbir cache directory, which is trimmed to the new budget immediately.
+            Defaults to __svmbir_lib_path variable.
+    """
+    utils.set_sysmatrix_cache_limit(max_bytes)
+    max_bytes = utils.get_sysmatrix_cache_limit()
+    if max_bytes is not None:
+        utils.evict_sysmatrix_cache(os.path.join(svmbir_lib_path, 'sysmatrix'), max_bytes)
+
+
+def _cache_stats(svmbir_lib_path = __svmbir_lib_path):
+    """Return the usage counters of the system matrix cache.
+
+    Args:
+        svmbir_lib_path (string): Path to svmbir cache directory. Defaults to __svmbir_lib_path variable.
+
+    Returns:
+        dict: The number of cache 'hits', 'misses', 'evictions' and 'evicted_bytes' in this process,
+        together with the current 'size' of the cache and its 'limit' in bytes.
+    """
+    return utils.sysmatrix_cache_stats(os.path.join(svmbir_lib_path, 'sysmatrix'))
+
+
 def sino_sort(sino, angles, weights=None):
     r"""Sort sinogram views (and sinogram weights if provided) so that view angles are in monotonically increasing order on the interval :math:`[0,2\pi)`.
         This function can be used to preprocess the sinogram data so that svmbir reconstruction is faster.
@@ -126,15 +167,17 @@ def auto_max_resolutions(init_image, prox_image) :
     return max_resolutions
 
 
-def auto_sigma_y(sino, weights, magnification = 1.0, delta_channel = 1.0, delta_pixel = 1.0, snr_db = 30.0 ) :
+def auto_sigma_y(sino, weights, magnification = 1.0, delta_channel = 1.0, delta_pixel = 1.0, snr_db = 30.0,
+                 weight_type = 'unweighted') :
     """Compute the automatic value of ``sigma_y`` for use in MBIR reconstruction.
 
     Args:
         sino (ndarray):
             3D numpy array of sinogram data with shape (num_views,num_slices,num_channels).
-        weights (ndarray):
-            3D numpy array of weights with same shape as sino.
+        weights (ndarray or tuple):
+            3D numpy array of weights with same shape as sino, or broadcastable weights as accepted by ``svmbir.recon``.
             The parameters weights should be the same values as used in svmbir reconstruction.
+            If None, the weights of ``weight_type`` are evaluated view by view without forming a weights array.
         magnification (float):
             (fan beam geometries only) Magnification factor = dist_source_detector/dist_source_isocenter.
         delta_channel (float, optional):
@@ -143,6 +186,8 @@ def auto_sigma_y(sino, weights, magnification = 1.0, delta_channel = 1.0, delta_
             [Default=1.0] Scalar value of pixel spacing in :math:`ALU`.
         snr_db (float, optional):
             [Default=30.0] Scalar value that controls assumed signal-to-noise ratio of the data in dB.
+        weight_type (string, optional):
+            [Default="unweighted"] Type of noise model used when ``weights`` is None. See ``svmbir.calc_weights``.
 
 
     Returns:
@@ -152,8 +197,27 @@ def auto_sigma_y(sino, weights, magnification = 1.0, delta_channel = 1.0, delta_
     sino_indicator = _sino_indicator(sino)
 
     # compute RMS value of sinogram excluding empty space
-    signal_rms = np.average(weights * sino ** 2, None, sino_indicator) ** 0.5
-
+    if weights is not None:
+        weights = utils.test_args_weights(weights, sino.shape)
+    if (weights is not None) and (len(weights) == 1) and (weights[0].shape == sino.shape):
+        signal_rms = np.average(weights[0] * sino ** 2, None, sino_indicator) ** 0.5
+    else:
+        # evaluate the weights view by view instead of forming a weights array
+        weighted_sum = 0.0
+        view_weights = np.empty(sino.shape[1:], dtype=np.float32)
+        for view in range(sino.shape[0]):
+            if weights is None:
+                utils.calc_weights_into(sino[view], weight_type, view_weights)
+            else:
+                utils.weights_view(weights, view, view_weights)
+            weighted_sum += np.sum(view_weights * sino[view] ** 2 * sino_indicator[view])
+        signal_rms = (weighted_sum / np.sum(sino_indicator)) ** 0.5
+
+    return _sigma_y_from_rms(signal_rms, magnification, delta_channel, delta_pixel, snr_db)
+
+
+def _sigma_y_from_rms(signal_rms, magnification, delta_channel, delta_pixel, snr_db):
+    "Compute sigma_y from the weighted RMS value of the sinogram support"
     # convert snr to relative noise standard deviation
     rel_noise_std = 10 ** (-snr_db / 20)
 
@@ -234,8 +298,14 @@ def auto_sigma_prior(sino, magnification = 1.0, delta_channel = 1.0, sharpness =
     # Compute indicator function for sinogram support
     sino_indicator = _sino_indicator(sino)
 
+    return _sigma_prior_from_mean(np.average(sino, weights=sino_indicator), num_channels, magnification,
+                                  delta_channel, sharpness)
+
+
+def _sigma_prior_from_mean(sino_mean, num_channels, magnification, delta_channel, sharpness):
+    "Compute the prior regularization term from the average value of the sinogram support"
     # Compute a typical image value by dividing average sinogram value by a typical projection path length
-    typical_img_value = np.average(sino, weights=sino_indicator) / (num_channels * delta_channel / magnification)
+    typical_img_value = sino_mean / (num_channels * delta_channel / magnification)
 
     # Compute sigma_p as the typical image value when sharpness==0
     sigma_prior = (2 ** sharpness) * typical_img_value
@@ -286,6 +356,113 @@ def max_threads(num_threads, num_slices, num_rows, num_cols, positivity = True):
     return num_threads
 
 
+class Geometry:
+    """Geometry(angles, num_channels, geometry = 'parallel', **kwargs)
+
+    Immutable description of a scan geometry and reconstruction grid that can be passed to ``recon``,
+    ``project`` and ``backproject`` in place of the ``angles`` argument.
+
+    The arguments are validated, and the system matrix is located or computed, once when the object is created.
+    Calls that receive a ``Geometry`` then skip this setup, which reduces the per-call overhead when many
+    small problems with the same geometry are processed. The geometry arguments of the called function are ignored.
+    A ``Geometry`` can be pickled and sent to other processes, which locate the system matrix when they unpickle it.
+
+    Args:
+        angles (ndarray): 1D view angles array in radians.
+        num_channels (int): Number of sinogram channels.
+        geometry (string): [Default='parallel'] Scanner geometry: 'parallel', 'fan-curved', or 'fan-flat'.
+        dist_source_detector (float): (Required for fan beam geometries only) Distance from X-ray focal spot
+            to detectors, in :math:`ALU`.
+        magnification (float): (Required for fan beam geometries only) Magnification factor =
+            dist_source_detector/dist_source_isocenter.
+        num_rows (int, optional): [Default=None] Integer number of rows in the image. If None, automatically set.
+        num_cols (int, optional): [Default=None] Integer number of columns in the image. If None, automatically set.
+        delta_channel (float, optional): [Default=1.0] Scalar value of detector channel spacing in :math:`ALU`.
+        delta_pixel (float, optional): Scalar value of the spacing between image pixels in the 2D slice
+            plane in :math:`ALU`. Defaults as in ``svmbir.recon``.
+        center_offset (float, optional): [Default=0.0] Offset from center-of-rotation in 'fractional number of channels' units.
+        roi_radius (float, optional): [Default=None] Radius of relevant image region in :math:`ALU`.
+            If None, automatically set with auto_roi_radius().
+        svmbir_lib_path (string, optional): [Default='~/.cache/svmbir'] Path to directory containing
+            library of forward projection matrices.
+        verbose (int, optional): [Default=1] Level of printed status output. {0,1,2} Set to 0 for quiet mode.
+    """
+
+    def __init__(self, angles, num_channels, geometry = 'parallel', dist_source_detector = None, magnification = None,
+                 num_rows = None, num_cols = None, delta_channel = 1.0, delta_pixel = None, center_offset = 0.0,
+                 roi_radius = None, svmbir_lib_path = None, verbose = 1):
+        args = _geometry_args(angles, num_channels, geometry=geometry, dist_source_detector=dist_source_detector,
+                              magnification=magnification, num_rows=num_rows, num_cols=num_cols,
+                              delta_channel=delta_channel, delta_pixel=delta_pixel, center_offset=center_offset,
+                              roi_radius=roi_radius)
+        args['angles'] = args['angles'].copy()
+        args['angles'].setflags(write=False)
+
+        for key, value in args.items():
+            object.__setattr__(self, key, value)
+        object.__setattr__(self, 'svmbir_lib_path', svmbir_lib_path if svmbir_lib_path is not None else _svmbir_lib_path())
+
+        # Results of _init_geometry() for the grids used with this geometry
+        object.__setattr__(self, '_levels', dict())
+        self._init_geometry(1, verbose=verbose)
+
+    @property
+    def num_views(self):
+        return len(self.angles)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("svmbir.Geometry objects are immutable")
+
+    def __reduce__(self):
+        # rebuild on unpickling so that the system matrix is located in the receiving process
+        return (_rebuild_geometry, (self._args(),))
+
+    def __repr__(self):
+        return 'svmbir.Geometry({})'.format(', '.join('{}={!r}'.format(key, value) for key, value in self._args().items()
+                                                       if key != 'angles') + ', num_views={}'.format(self.num_views))
+
+    def _args(self):
+        "Return the arguments of this geometry as a dict"
+        return dict(angles=self.angles, num_channels=self.num_channels, geometry=self.geometry,
+                    dist_source_detector=self.dist_source_detector, magnification=self.magnification,
+                    num_rows=self.num_rows, num_cols=self.num_cols, delta_channel=self.delta_channel,
+                    delta_pixel=self.delta_pixel, center_offset=self.center_offset, roi_radius=self.roi_radius,
+                    svmbir_lib_path=self.svmbir_lib_path)
+
+    def _init_geometry(self, num_slices, object_name = 'object', verbose = 0):
+        "Return the paths and parameter dicts of the full resolution grid for num_slices slices"
+        return ci._get_geometry(self._levels, self.angles, num_channels=self.num_channels, num_views=self.num_views,
+                                num_slices=num_slices, num_rows=self.num_rows, num_cols=self.num_cols,
+                                geometry=self.geometry, dist_source_detector=self.dist_source_detector,
+                                magnification=self.magnification, delta_channel=self.delta_channel,
+                                delta_pixel=self.delta_pixel, roi_radius=self.roi_radius,
+                                center_offset=self.center_offset, verbose=verbose,
+                                svmbir_lib_path=self.svmbir_lib_path, object_name=object_name)
+
+    def _pin_sysmatrix(self, num_slices, object_name = 'object', verbose = 0):
+        "Compute or load the full resolution system matrix and return (fd, path) as utils.pin_sysmatrix()"
+        # another process may evict the matrix from the cache between computing and opening it
+        for _ in range(3):
+            paths, _, _ = self._init_geometry(num_slices, object_name=object_name, verbose=verbose)
+            fd, sysmatrix_file = utils.pin_sysmatrix(paths['sysmatrix_name'])
+            if sysmatrix_file is not None:
+                return fd, sysmatrix_file
+            self._levels.clear()
+        raise Exception("svmbir.Geometry(): system matrix {} was evicted from the cache while it was being opened; "
+                        "increase the cache limit".format(paths['sysmatrix_name']))
+
+
+def _rebuild_geometry(args):
+    "Create a Geometry from its arguments when unpickling"
+    return Geometry(verbose=0, **args)
+
+
+@functools.lru_cache(maxsize=None)
+def _default_num_threads():
+    "Default number of compute threads: the number of physical cores"
+    return cpu_count(logical=False)
+
+
 def recon(sino, angles,
           geometry = 'parallel', dist_source_detector = None, magnification = None,
           weights = None, weight_type = 'unweighted', init_image = 0.0, prox_image = None, init_proj = None,
@@ -294,14 +471,20 @@ def recon(sino, angles,
           sigma_y = None, snr_db = 30.0, sigma_x = None, sigma_p = None, p = 1.2, q = 2.0, T = 1.0, b_interslice = 1.0,
           sharpness = 0.0, positivity = True, relax_factor=1.0, max_resolutions = None, stop_threshold = 0.02, max_iterations = 100,
           num_threads = None, delete_temps = True, svmbir_lib_path = __svmbir_lib_path, object_name = 'object',
-          verbose = 1) :
+          verbose = 1, out = None, num_processes = None,
+          checkpoint_file = None, checkpoint_iterations = 10, checkpoint_seconds = None, resume_from = None,
+          callback = None, callback_iterations = 1, callback_cost = False, return_proj = False,
+          schedule = None, return_schedule = False, multires_slices = False, drop_zero_weight_views = False) :
     """recon(sino, angles, geometry = 'parallel', **kwargs)
 
     Compute 3D MBIR reconstruction using multi-resolution SVMBIR algorithm.
 
     Args:
         sino (ndarray): 3D sinogram array with shape (num_views, num_slices, num_channels).
-        angles (ndarray): 1D view angles array in radians.
+        angles (ndarray or svmbir.Geometry): 1D view angles array in radians, or a ``svmbir.Geometry``.
+            If a ``Geometry`` is given, the arguments ``geometry``, ``dist_source_detector``, ``magnification``,
+            ``num_rows``, ``num_cols``, ``roi_radius``, ``delta_channel``, ``delta_pixel``, ``center_offset``
+            and ``svmbir_lib_path`` are taken from it and the values passed to this function are ignored.
         geometry (string):
             [Default='parallel'] Scanner geometry: 'parallel', 'fan-curved', or 'fan-flat'. Note for fan geometries
             the ``dist_source_detector`` and ``magnification`` arguments must be specified.
@@ -309,10 +492,17 @@ def recon(sino, angles,
             (Required for fan beam geometries only) Distance from X-ray focal spot to detectors, in :math:`ALU`.
         magnification (float):
             (Required for fan beam geometries only) Magnification factor = dist_source_detector/dist_source_isocenter.
-        weights (ndarray, optional): [Default=None] 3D weights array with same shape as sino.
+        weights (ndarray or tuple, optional): [Default=None] 3D weights array with same shape as sino.
+            Weights that do not depend on every axis can be given in a smaller array that is broadcast to the
+            sinogram shape: a 3D array such as (num_views,1,1) or (num_views,1,num_channels),
+            a 2D array with shape (num_views,num_channels), or a 1D array of per-view or per-channel weights.
+            A tuple of such arrays specifies weights that are the product of the factors, e.g.
+            ``(view_weights, channel_weights)``. Broadcast weights are never expanded to a sinogram-sized array
+            outside the internal buffer of the reconstruction.
+            Views whose weights are all zero can be removed before reconstruction with ``drop_zero_weight_views``.
         weight_type (string, optional): [Default="unweighted"] Type of noise model used for data.
-            If the ``weights`` array is not supplied, then the function ``svmbir.calc_weights`` is 
-            used to set weights using specified ``weight_type`` parameter.
+            If the ``weights`` array is not supplied, then weights are computed as in ``svmbir.calc_weights``
+            using specified ``weight_type`` parameter, directly in the internal buffer used by the reconstruction.
             Option "unweighted" corresponds to unweighted reconstruction;
             Option "transmission" is the correct weighting for transmission CT with constant dosage;
             Option "transmission_root" is commonly used with transmission CT data to improve image homogeneity;
@@ -353,6 +543,8 @@ def recon(sino, angles,
             The default value of 1.0 should be fine for most applications.
             However, b_interslice can be increased to values :math:`>1` in order to increase 
             regularization along the slice axis.
+            With ``b_interslice=0`` the slices are independent, and ``num_processes='auto'`` reconstructs them as
+            separate groups of slices in parallel processes, each with its own stopping criterion.
         sharpness (float, optional):
             [Default=0.0] Scalar value that controls level of sharpness.
             ``sharpness=0.0`` is neutral; ``sharpness>0`` increases sharpness; ``sharpness<0`` reduces sharpness.
@@ -365,6 +557,8 @@ def recon(sino, angles,
         max_resolutions (int, optional): [Default=None] Integer >=0 that specifies the maximum number of grid
             resolutions used to solve MBIR reconstruction problem.
             If None, automatically set with auto_max_resolutions to 0 if inital image is provided and 2 otherwise.
+            The lower resolutions are reconstructed from a sinogram with fewer views and binned channels,
+            see ``schedule``.
         stop_threshold (float, optional): [Default=0.02] Scalar valued stopping threshold in percent.
             If stop_threshold=0.0, then run max iterations.
         max_iterations (int, optional): [Default=100] Integer valued specifying the maximum number of 
@@ -380,9 +574,83 @@ def recon(sino, angles,
             Useful for building multi-process and multi-node functionality on top of svmbir.
         verbose (int, optional): [Default=1] Possible values are {0,1,2}, where 0 is quiet, 
             1 prints minimal reconstruction progress information, and 2 prints the full information.
+        out (ndarray, optional): [Default=None] C-contiguous float32 array of shape (num_slices,num_rows,num_cols),
+            such as a slab of a ``numpy.memmap``, that the reconstruction is computed in. If None, a new array is allocated.
+        num_processes (int or string, optional): [Default=None] Number of local processes. If larger than 1, the
+            slices are split into ``num_processes`` slabs with halo slices that are reconstructed in parallel by
+            ``svmbir.recon_slabs``, with one process per NUMA node when ``num_processes`` equals the number of nodes.
+            ``num_threads`` is then the number of threads of each process. If 'auto' and ``b_interslice=0``, the
+            independent slices are reconstructed in groups by processes with 4 of the ``num_threads`` threads each,
+            and each group stops on its own convergence. Otherwise the reconstruction runs in this process.
+        checkpoint_file (string, optional): [Default=None] Path of a .npz file that the current image is saved to
+            while the reconstruction runs, so that an interrupted reconstruction can be resumed with ``resume_from``.
+            Each resolution is then reconstructed in segments of ``checkpoint_iterations`` iterations, and a
+            checkpoint is written after each segment and at the end of each resolution. This changes the iteration
+            schedule: the C library runs a fixed number of iterations in each segment and restarts its order of
+            updates in every segment, and a resolution stops once the ``change`` of the image over a segment, as
+            reported to ``callback``, is below ``stop_threshold``. The result therefore differs from that of a
+            reconstruction without checkpoints within the convergence tolerance, while a resumed reconstruction
+            runs the same segments as an uninterrupted one with checkpoints.
+        checkpoint_iterations (int, optional): [Default=10] Number of iterations between checkpoints.
+        checkpoint_seconds (float, optional): [Default=None] If set, the checkpoints within a resolution are
+            written only when at least this many seconds have passed since the previous checkpoint.
+        resume_from (string, optional): [Default=None] Path of a checkpoint file of a previous call with the same
+            arguments. The reconstruction continues at the resolution and iteration of the checkpoint.
+            If the file does not exist, the reconstruction starts from the beginning, so a job that is restarted
+            after preemption can pass the same path as ``checkpoint_file`` and ``resume_from``.
+        callback (callable, optional): [Default=None] Function called as ``callback(record)`` after every
+            ``callback_iterations`` iterations of each resolution, e.g. ``stats.append``. The dict ``record`` holds
+            the resolution index ``level`` (0 is full resolution), ``num_rows``, ``num_cols``, the number of
+            iterations of the resolution that the C library ran so far ``iteration``, the ``change`` of the image
+            per iteration over the last iterations, which is the stop criterion of the C library in percent evaluated
+            over whole iterations and is compared against ``stop_threshold``, ``converged``, the wall ``time``
+            of the last iterations in seconds, ``voxels_updated``, the number of voxels whose value changed,
+            ``num_threads``, and ``cost``. As with checkpoints, the resolutions are then reconstructed in segments
+            of ``callback_iterations`` iterations, which changes the iteration schedule. With the Cython interface,
+            the sinogram and the projection of the image are kept from one segment to the next; with the command
+            line interface, every segment starts with a forward projection.
+        callback_iterations (int, optional): [Default=1] Number of iterations between calls of ``callback``.
+        callback_cost (bool, optional): [Default=False] If True, ``record['cost']`` is the value of the MAP cost
+            function of the current image at the current resolution, which takes an extra forward projection;
+            otherwise it is None.
+        return_proj (bool, optional): [Default=False] If True, also return the forward projection of the
+            reconstruction, which can be passed as ``init_proj`` to the next call in a Plug-and-Play or ADMM loop.
+            The error sinogram is ``sino - proj``. With the command line interface, the projection is written by
+            the reconstruction executable; with the Cython interface, it is computed with the system matrix already
+            set up for the reconstruction.
+        schedule (list, optional): [Default=None] Resolutions of the multi-resolution reconstruction, as a list of
+            dicts with the downsampling factor ``scale`` of the resolution, e.g. 4, 2 and 1, and optionally its own
+            ``stop_threshold``, ``max_iterations`` and ``relax_factor``. Settings that are not given are those of
+            this call. The resolutions are reconstructed from the largest to the smallest scale, which must be 1.
+            The resolutions with a scale of 2 or more are reconstructed from a reduced sinogram, in which groups of
+            neighboring views and channels are combined into their weighted mean, as far as the coarser grid
+            allows. Set ``decimate=False`` in the dict of a resolution to use the whole sinogram.
+            For example, ``schedule=[dict(scale=4, stop_threshold=0.5), dict(scale=2, stop_threshold=0.2),
+            dict(scale=1)]`` stops the low resolutions early, as they only initialize the next one.
+            If given, ``max_resolutions`` is ignored.
+        return_schedule (bool, optional): [Default=False] If True, also return the list of resolutions that were
+            reconstructed, from coarsest to finest, as dicts with the ``level`` (0 is full resolution), ``scale``,
+            ``slice_scale``, ``num_slices``, ``num_rows``, ``num_cols``, ``delta_pixel``, ``stop_threshold``,
+            ``max_iterations``, ``relax_factor``, ``decimate``, the ``num_views`` and ``num_channels`` of the
+            sinogram it was reconstructed from, and the wall ``time`` of the resolution in seconds.
+        multires_slices (bool, optional): [Default=False] If True, the lower resolutions also have fewer slices:
+            the slices are reduced by the same factor as the rows and columns, and the sinogram slices are combined
+            into their weighted mean accordingly. The reconstruction of a lower resolution is interpolated along the
+            slices to initialize the next one. This helps tall stacks with a strong ``b_interslice`` coupling, where
+            the convergence along the slices takes most iterations. A resolution of ``schedule`` can set its own
+            integer ``slice_scale``.
+        drop_zero_weight_views (bool, optional): [Default=False] If True, the views whose ``weights`` are all zero
+            are removed before reconstruction, so they cost no compute time. This makes copies of the remaining
+            views of ``sino``, ``weights`` and ``init_proj``, and computes the system matrix of the remaining views
+            unless it is cached, so it pays off when many views are dropped or the same views are dropped in
+            repeated calls. Views are not removed if ``angles`` is a ``svmbir.Geometry``.
 
     Returns:
         3D numpy array: 3D reconstruction with shape (num_slices,num_rows,num_cols) in units of :math:`ALU^{-1}`.
+        If ``out`` is given, it is returned.
+        If ``return_proj`` is True, a tuple (reconstruction, proj) with the float32 projection ``proj`` of shape
+        (num_views, num_slices, num_channels).
+        If ``return_schedule`` is True, the list of resolutions is appended to the returned tuple.
     """
 
     # Issue notice of change of default regularization for 1 or 2 release cycles
@@ -396,6 +664,46 @@ def recon(sino, angles,
     #        sys.stderr.write("** next release. To apply the changes immediately supply the following argument:\n")
     #        sys.stderr.write("** svmbir.recon(...,new_reg_defaults=True)\n")
 
+    # Arguments of this call for handing the reconstruction to recon_slabs()
+    recon_args = dict(geometry=geometry, dist_source_detector=dist_source_detector, magnification=magnification,
+                      weights=weights, weight_type=weight_type, init_image=init_image, prox_image=prox_image,
+                      init_proj=init_proj, num_rows=num_rows, num_cols=num_cols, roi_radius=roi_radius,
+                      delta_channel=delta_channel, delta_pixel=delta_pixel, center_offset=center_offset,
+                      sigma_y=sigma_y, snr_db=snr_db, sigma_x=sigma_x, sigma_p=sigma_p, p=p, q=q, T=T,
+                      b_interslice=b_interslice, sharpness=sharpness, positivity=positivity,
+                      relax_factor=relax_factor, max_resolutions=max_resolutions, stop_threshold=stop_threshold,
+                      max_iterations=max_iterations, num_threads=num_threads, delete_temps=delete_temps,
+                      svmbir_lib_path=svmbir_lib_path, object_name=object_name, verbose=verbose,
+                      checkpoint_file=checkpoint_file, checkpoint_iterations=checkpoint_iterations,
+                      checkpoint_seconds=checkpoint_seconds, resume_from=resume_from, callback=callback,
+                      callback_iterations=callback_iterations, callback_cost=callback_cost, return_proj=return_proj,
+                      schedule=schedule, return_schedule=return_schedule, multires_slices=multires_slices,
+                      drop_zero_weight_views=drop_zero_weight_views)
+
+    # Checkpoints, callbacks and the returned projection and schedule need the whole reconstruction in this process
+    single_process = (checkpoint_file is not None) or (resume_from is not None) or (callback is not None) or \
+                     return_proj or return_schedule
+
+    # Split the slice axis across a pool of local processes
+    num_processes = utils.test_args_num_processes(num_processes)
+    if isinstance(num_processes, int) and (num_processes > 1):
+        if single_process:
+            raise Exception("svmbir.recon(): checkpoints, callbacks, return_proj and return_schedule are not "
+                            "supported with num_processes > 1")
+        num_slices = np.shape(sino)[1]
+        return recon_slabs(sino, angles, slab_size=math.ceil(num_slices / num_processes),
+                           num_workers=num_processes, out=out, **recon_args)
+
+    # Unpack the arguments of a precomputed geometry
+    geom = None
+    if isinstance(angles, Geometry):
+        geom = angles
+        angles = geom.angles
+        geometry, dist_source_detector, magnification = geom.geometry, geom.dist_source_detector, geom.magnification
+        num_rows, num_cols, roi_radius = geom.num_rows, geom.num_cols, geom.roi_radius
+        delta_channel, delta_pixel, center_offset = geom.delta_channel, geom.delta_pixel, geom.center_offset
+        svmbir_lib_path = geom.svmbir_lib_path
+
     # Issue warning that 'fan' geometry will be removed in the future (last valid version is v0.2.9)
     if geometry=='fan':
         geometry = 'fan-curved'
@@ -403,13 +711,16 @@ def recon(sino, angles,
 
     # If not specified, then set number of threads = to number of processors
     if num_threads is None :
-        num_threads = cpu_count(logical=False)
+        num_threads = _default_num_threads()
 
     # Test for valid sino and angles structure. If sino is 2D, make it 3D
     angles = utils.test_args_angles(angles)
     sino = utils.test_args_sino(sino, angles)
     (num_views, num_slices, num_channels) = sino.shape
 
+    if (geom is not None) and (num_channels != geom.num_channels):
+        raise Exception("Error: Input 'sino' and geometry have different numbers of channels")
+
     # Tests parameters for valid types and values; print warnings if necessary; and return default values.
     num_rows, num_cols, delta_pixel, roi_radius, delta_channel, center_offset = utils.test_args_geom(
         num_rows, num_cols, delta_pixel, roi_radius, delta_channel, center_offset)
@@ -417,6 +728,8 @@ def recon(sino, angles,
         sharpness, positivity, relax_factor, max_resolutions, stop_threshold, max_iterations)
     init_image, prox_image, init_proj, weights, weight_type = utils.test_args_inits(
         init_image, prox_image, init_proj, weights, weight_type)
+    weights = utils.test_args_weights(weights, sino.shape)
+    schedule = utils.test_args_schedule(schedule)
     sigma_y, snr_db, sigma_x, sigma_p = utils.test_args_noise(sigma_y, snr_db, sigma_x, sigma_p)
     p, q, T, b_interslice = utils.test_args_qggmrf(p, q, T, b_interslice)
     num_threads, delete_temps, verbose = utils.test_args_sys(num_threads, delete_temps, verbose)
@@ -449,14 +762,25 @@ def recon(sino, angles,
     if prox_image is not None:
         if prox_image.shape != (num_slices,num_rows,num_cols):
             raise Exception("Parameter prox_image should have shape (num_slices,num_rows,num_cols).")
-
-    # Set automatic values for weights
-    if weights is None:
-        weights = calc_weights(sino, weight_type)
+    if out is not None:
+        out = utils.test_args_out(out, (num_slices,num_rows,num_cols))
+
+    # With b_interslice == 0 every slice is an independent 2D problem. Reconstruct groups of slices as separate jobs,
+    # each with its own stopping criterion, so that workers whose slices converge early go on to other groups.
+    if (num_processes == 'auto') and (b_interslice == 0) and (num_slices > 1) and not single_process:
+        num_workers = min(num_slices, num_threads // __slice_group_threads)
+        if num_workers > 1:
+            if verbose >= 1:
+                print(f'b_interslice is 0: reconstructing independent slice groups in {num_workers} processes.')
+            return recon_slabs(sino, angles if geom is None else geom,
+                               slab_size=math.ceil(num_slices / (4 * num_workers)), slab_halo=0,
+                               num_workers=num_workers, out=out,
+                               **dict(recon_args, num_threads=num_threads // num_workers))
 
     # Set automatic value of sigma_y
     if sigma_y is None:
-        sigma_y = auto_sigma_y(sino, weights, magnification, delta_channel=delta_channel, delta_pixel=delta_pixel, snr_db=snr_db)
+        sigma_y = auto_sigma_y(sino, weights, magnification, delta_channel=delta_channel, delta_pixel=delta_pixel,
+                               snr_db=snr_db, weight_type=weight_type)
 
     # Set automatic value of sigma_x
     # if qGGMRF mode, then set sigma_x either using the provided value by user, or with auto_sigma_x
@@ -469,6 +793,23 @@ def recon(sino, angles,
             sigma_p = auto_sigma_p(sino, magnification, delta_channel, sharpness)
         sigma_x = sigma_p
 
+    # Drop views whose weights are all zero, so they are not traversed in the system matrix.
+    # The reduced view set has its own system matrix, so this is not done when a Geometry is given.
+    view_mask = None
+    if drop_zero_weight_views and (weights is not None) and (geom is None):
+        view_mask = utils.nonzero_weight_views(weights, num_views)
+        if np.all(view_mask) or not np.any(view_mask):
+            view_mask = None
+        else:
+            if verbose >= 1:
+                print(f'Skipping {num_views - np.count_nonzero(view_mask)} views with zero weight.')
+            sino = sino[view_mask]
+            dropped_angles = angles[~view_mask]
+            angles = angles[view_mask]
+            weights = tuple(factor[view_mask] if factor.shape[0] > 1 else factor for factor in weights)
+            if init_proj is not None:
+                init_proj = init_proj[view_mask]
+
     # Reduce num_threads for positivity=False if problems size calls for it
     # num_threads_max = max_threads(num_threads, num_slices, num_rows, num_cols, positivity=positivity)
     # if num_threads_max < num_threads:
@@ -476,26 +817,480 @@ def recon(sino, angles,
     os.environ['OMP_NUM_THREADS'] = str(num_threads)
     os.environ['OMP_DYNAMIC'] = 'true'
 
-    reconstruction = ci.multires_recon(sino=sino, angles=angles, weights=weights, weight_type=weight_type,
-                                       geometry=geometry, dist_source_detector=dist_source_detector, magnification=magnification,
-                                       init_image=init_image, prox_image=prox_image, init_proj=init_proj,
-                                       num_rows=num_rows, num_cols=num_cols, roi_radius=roi_radius,
-                                       delta_channel=delta_channel, delta_pixel=delta_pixel, center_offset=center_offset,
-                                       sigma_y=sigma_y, sigma_x=sigma_x, p=p, q=q, T=T, b_interslice=b_interslice,
-                                       positivity=positivity, relax_factor=relax_factor, max_resolutions=max_resolutions,
-                                       stop_threshold=stop_threshold, max_iterations=max_iterations, num_threads=num_threads,
-                                       delete_temps=delete_temps, svmbir_lib_path=svmbir_lib_path, object_name=object_name,
-                                       verbose=verbose)
+    multires_args = dict(sino=sino, angles=angles, weights=weights, weight_type=weight_type,
+                         geometry=geometry, dist_source_detector=dist_source_detector, magnification=magnification,
+                         init_image=init_image, prox_image=prox_image, init_proj=init_proj,
+                         num_rows=num_rows, num_cols=num_cols, roi_radius=roi_radius,
+                         delta_channel=delta_channel, delta_pixel=delta_pixel, center_offset=center_offset,
+                         sigma_y=sigma_y, sigma_x=sigma_x, p=p, q=q, T=T, b_interslice=b_interslice,
+                         positivity=positivity, relax_factor=relax_factor, max_resolutions=max_resolutions,
+                         stop_threshold=stop_threshold, max_iterations=max_iterations, num_threads=num_threads,
+                         delete_temps=delete_temps, svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                         verbose=verbose, geometry_levels=geom._levels if geom is not None else None,
+                         out=out, level_stats=[] if return_schedule else None,
+                         schedule=utils.multires_schedule(num_slices, num_rows, num_cols, delta_pixel, max_resolutions,
+                                                          stop_threshold, max_iterations, relax_factor, schedule,
+                                                          multires_slices))
+
+    # Projection of the reconstruction at the views that are reconstructed
+    proj = None
+    if return_proj:
+        proj = np.empty((num_views, num_slices, num_channels), dtype=np.float32)
+        multires_args['proj_out'] = proj if view_mask is None else np.empty(sino.shape, dtype=np.float32)
+
+    if (checkpoint_file is not None) or (resume_from is not None) or (callback is not None):
+        for (name, value) in [('checkpoint_iterations', checkpoint_iterations), ('callback_iterations', callback_iterations)]:
+            if not (isinstance(value, int) and (value > 0)):
+                raise Exception("svmbir.recon(): '{}' must be a positive integer".format(name))
+        reconstruction = _recon_segments(multires_args, checkpoint_file, checkpoint_iterations, checkpoint_seconds,
+                                         resume_from, callback,
+                                         callback_iterations if callback is not None else checkpoint_iterations,
+                                         callback_cost)
+    else:
+        reconstruction = ci.multires_recon(**multires_args)
+
+    if not (return_proj or return_schedule):
+        return reconstruction
+
+    result = (reconstruction,)
+    if return_proj:
+        # The views without weight are not seen by the reconstruction; project them separately
+        if view_mask is not None:
+            proj[view_mask] = multires_args['proj_out']
+            proj[~view_mask] = _recon_proj(reconstruction, dict(multires_args, angles=dropped_angles), delta_pixel)
+        result += (proj,)
+    if return_schedule:
+        result += (multires_args['level_stats'],)
+    return result
+
+
+def _recon_segments(multires_args, checkpoint_file, checkpoint_iterations, checkpoint_seconds, resume_from,
+                    callback, segment_iterations, callback_cost):
+    """Run the multi-resolution reconstruction of recon() as a sequence of calls to ci.multires_recon(), each of
+    one resolution and at most segment_iterations iterations, and write checkpoints and call callback between them.
+
+    The C library runs a fixed number of iterations in each segment, so the iterations are counted exactly, and the
+    stop_threshold of the resolution is compared with the utils.image_change() of each segment. The C library
+    restarts its update schedule in every segment. With the Cython interface, segment_state keeps the sinogram and
+    weights in the layout of the C library and the projection of the image from one segment to the next.
+    """
+    init_image, prox_image, out = multires_args['init_image'], multires_args['prox_image'], multires_args['out']
+    levels, level_stats = multires_args['schedule'], multires_args['level_stats']
+    level_shapes = [(settings['num_slices'], settings['num_rows'], settings['num_cols']) for settings in levels]
+
+    # Starting point: the coarsest resolution, or the resolution and iteration of the checkpoint
+    start_level, start_iteration, image = len(levels) - 1, 0, None
+    checkpoint = utils.load_checkpoint(resume_from) if resume_from is not None else None
+    if checkpoint is not None:
+        start_level, image = checkpoint['level'], checkpoint['image']
+        if (checkpoint['num_levels'] != len(levels)) or (start_level >= len(levels)) or \
+           (image.shape != level_shapes[start_level]):
+            raise Exception("svmbir.recon(): checkpoint {} does not match the reconstruction".format(resume_from))
+        start_iteration = levels[start_level]['max_iterations'] if checkpoint['converged'] else checkpoint['iteration']
+        (lr_num_rows, lr_num_cols) = (levels[start_level]['num_rows'], levels[start_level]['num_cols'])
+        if multires_args['verbose'] >= 1:
+            print(f'Resuming from {resume_from} at axial size (rows,cols)=({lr_num_rows},{lr_num_cols}), '
+                  f'iteration {start_iteration}.')
+
+    last_checkpoint_time = time.time()
+    segment_state = dict()
+    for level in reversed(range(start_level + 1)):
+        settings = levels[level]
+        (lr_num_rows, lr_num_cols, lr_delta_pixel) = (settings['num_rows'], settings['num_cols'], settings['delta_pixel'])
+        max_iterations, stop_threshold = settings['max_iterations'], settings['stop_threshold']
+        level_time = time.time()
+        if image is None:
+            # First segment: the initial and proximal images reduced to the coarsest resolution
+            image = init_image
+            for lr_shape in level_shapes[1:level + 1]:
+                image = utils.recon_resize(image, lr_shape) if not np.isscalar(image) else image
+        elif image.shape != level_shapes[level]:
+            image = utils.recon_resize(image, level_shapes[level])
+        lr_prox_image = prox_image
+        for lr_shape in level_shapes[1:level + 1]:
+            lr_prox_image = utils.recon_resize(lr_prox_image, lr_shape) if lr_prox_image is not None else None
+
+        iteration = start_iteration if level == start_level else 0
+        checkpoint_iteration = iteration
+        segment_stats = []
+        converged = False
+        while (iteration < max_iterations) and not converged:
+            num_iterations = min(segment_iterations, max_iterations - iteration)
+            prev_image = image.copy() if not np.isscalar(image) else image
+            start_time = time.time()
+            image = ci.multires_recon(**dict(multires_args, init_image=image, prox_image=lr_prox_image, proj_out=None,
+                                             init_proj=multires_args['init_proj'] if image is init_image else None,
+                                             num_rows=lr_num_rows, num_cols=lr_num_cols, delta_pixel=lr_delta_pixel,
+                                             schedule=[dict(settings, stop_threshold=0.0,
+                                                            max_iterations=num_iterations)],
+                                             level_stats=segment_stats, out=out if level == 0 else None,
+                                             segment_state=segment_state))
+            segment_time = time.time() - start_time
+            iteration += num_iterations
+            change = utils.image_change(image, prev_image, num_iterations)
+            converged = (stop_threshold > 0) and (change < stop_threshold)
+
+            if callback is not None:
+                record = dict(level=level, num_rows=lr_num_rows, num_cols=lr_num_cols, iteration=iteration,
+                              change=change, converged=converged, time=segment_time,
+                              voxels_updated=int(np.count_nonzero(image != prev_image)),
+                              num_threads=multires_args['num_threads'], cost=None)
+                if callback_cost:
+                    record['cost'] = _recon_cost(image, lr_prox_image, multires_args, settings)
+                callback(record)
+            del prev_image
+
+            level_done = converged or (iteration >= max_iterations)
+            if (checkpoint_file is not None) and \
+               (level_done or ((iteration - checkpoint_iteration >= checkpoint_iterations) and
+                               ((checkpoint_seconds is None) or
+                                (time.time() - last_checkpoint_time >= checkpoint_seconds)))):
+                utils.save_checkpoint(checkpoint_file, image, level, iteration, converged, len(levels))
+                last_checkpoint_time = time.time()
+                checkpoint_iteration = iteration
+
+        if level_stats is not None:
+            record = dict(settings)
+            if segment_stats:
+                record.update(num_views=segment_stats[-1]['num_views'], num_channels=segment_stats[-1]['num_channels'])
+            record['time'] = time.time() - level_time
+            level_stats.append(record)
+
+    if out is not None and image is not out:
+        np.copyto(out, image)
+        image = out
+    if multires_args.get('proj_out') is not None:
+        _recon_proj(image, multires_args, multires_args['delta_pixel'], out=multires_args['proj_out'])
+    return image
+
+
+def _recon_proj(image, multires_args, delta_pixel, out = None):
+    "Return the projection of an image with the geometry of the ci.multires_recon() arguments and pixel pitch"
+    args = multires_args
+    return project(image, args['angles'], args['sino'].shape[2], geometry=args['geometry'],
+                   dist_source_detector=args['dist_source_detector'], magnification=args['magnification'],
+                   delta_channel=args['delta_channel'], delta_pixel=delta_pixel, center_offset=args['center_offset'],
+                   roi_radius=args['roi_radius'], num_threads=args['num_threads'],
+                   svmbir_lib_path=args['svmbir_lib_path'], delete_temps=args['delete_temps'],
+                   object_name=args['object_name'], verbose=0, out=out)
+
+
+def _recon_cost(image, prox_image, multires_args, settings):
+    "Return the MAP cost function of recon() for an image of a resolution of utils.multires_schedule()"
+    args = multires_args
+    sino, weights, weight_type, angles = args['sino'], args['weights'], args['weight_type'], args['angles']
+    if settings['slice_scale'] > 1:
+        # The sinogram slices combined as for the reconstruction of this resolution
+        if weights is None:
+            weights = utils.calc_weights_into(sino, weight_type, np.empty(sino.shape, dtype=np.float32))
+        else:
+            weights = utils.weights_array(weights, sino.shape)
+        sino, weights, angles, _ = utils.decimate_sino(sino, weights, angles, 0.0, 1, 1, settings['slice_scale'])
+        weights = (weights,)
+    proj = _recon_proj(image, dict(args, angles=angles), settings['delta_pixel'])
+    cost = utils.forward_cost(sino, proj, weights, weight_type, args['sigma_y'] * settings['scale']**0.5)
+    if prox_image is None:
+        cost += utils.qggmrf_cost(image, args['sigma_x'], args['p'], args['q'], args['T'], args['b_interslice'])
+    else:
+        cost += float(np.sum((image - prox_image) ** 2, dtype=np.float64) / (2 * args['sigma_x'] ** 2))
+    return cost
+
+
+def recon_slabs(sino, angles, slab_size, slab_halo = 4,
+                weights = None, weight_type = 'unweighted', init_image = 0.0, prox_image = None, init_proj = None,
+                sigma_y = None, snr_db = 30.0, sigma_x = None, sigma_p = None, sharpness = 0.0,
+                num_workers = None, out = None, verbose = 1, **kwargs):
+    """recon_slabs(sino, angles, slab_size, slab_halo = 4, **kwargs)
+
+    Compute a 3D MBIR reconstruction slab by slab, for volumes that do not fit in memory.
+
+    The slices are reconstructed in slabs of ``slab_size`` slices. Each slab is reconstructed together with
+    ``slab_halo`` neighboring slices on each side, which are discarded, so that the ``b_interslice`` coupling
+    is consistent across slab boundaries. The sinogram and any other slice-dependent inputs are read one slab
+    at a time, so they can be ``numpy.memmap`` arrays or other array-like objects that support slicing, and each
+    finished slab is written to ``out``. The peak memory is bounded by the size of a slab with its halo.
 
-    return reconstruction
+    ``sigma_y``, ``sigma_x`` and ``sigma_p`` are computed from the whole sinogram in two passes over the slabs
+    unless they are given, so that all slabs use the same regularization.
 
+    With ``num_workers`` > 1, the slabs are reconstructed in parallel by a pool of local processes. The workers
+    are spread over the NUMA nodes of the machine and pinned to the cores of their node. The sinogram is shared
+    with the workers through shared memory, or by file name if it is a ``numpy.memmap``, and the workers write
+    their slabs into a shared output buffer, or directly into ``out`` if it is a ``numpy.memmap``.
+
+    Args:
+        sino (array-like): 3D sinogram array with shape (num_views, num_slices, num_channels).
+        angles (ndarray or svmbir.Geometry): 1D view angles array in radians, or a ``svmbir.Geometry``.
+        slab_size (int): Number of slices reconstructed in each slab.
+        slab_halo (int, optional): [Default=4] Number of slices added on each side of a slab and discarded.
+        weights (array-like or tuple, optional): [Default=None] Weights as in ``svmbir.recon``.
+            A 3D array with num_slices slices is read one slab at a time.
+        weight_type (string, optional): [Default="unweighted"] Type of noise model used for data.
+        init_image (float or array-like, optional): [Default=0.0] Initial value of reconstruction image.
+        prox_image (array-like, optional): [Default=None] Proximal map input image.
+        init_proj (array-like, optional): [Default=None] Initial projection of init_image.
+        sigma_y (float, optional): [Default=None] Forward model regularization parameter.
+        snr_db (float, optional): [Default=30.0] Assumed signal-to-noise ratio of the data in dB.
+        sigma_x (float, optional): [Default=None] qGGMRF prior model regularization parameter.
+        sigma_p (float, optional): [Default=None] Proximal map regularization parameter.
+        sharpness (float, optional): [Default=0.0] Controls level of sharpness in the reconstruction.
+        num_workers (int, optional): [Default=None] Number of worker processes. If None or 1, the slabs are
+            reconstructed one after the other in this process.
+        out (array-like, optional): [Default=None] Array of shape (num_slices,num_rows,num_cols), such as a
+            ``numpy.memmap``, that the finished slabs are written to. If None, a float32 array is allocated.
+        verbose (int, optional): [Default=1] Level of printed status output. {0,1,2} Set to 0 for quiet mode.
+        **kwargs: Other arguments of ``svmbir.recon``, used for every slab.
+
+    Returns:
+        3D array: Reconstruction with shape (num_slices,num_rows,num_cols). If ``out`` is given, it is returned.
+    """
+    num_slices = sino.shape[1]
+    slab_bounds, slab_inputs, recon_args = _plan_slabs(sino, angles, slab_size, slab_halo, weights, weight_type,
+                                                       init_image, prox_image, init_proj, sigma_y, snr_db, sigma_x,
+                                                       sigma_p, sharpness, verbose, kwargs)
+
+    if (num_workers is not None) and (num_workers > 1) and (len(slab_bounds) > 1):
+        return _recon_slabs_parallel(sino, angles, slab_bounds, slab_inputs, recon_args,
+                                     min(num_workers, len(slab_bounds)), out)
+
+    for (first, last, lo, hi) in slab_bounds:
+        if verbose >= 1:
+            print(f'Reconstructing slices [{first},{last}) of {num_slices} with halo slices [{lo},{hi}).')
+
+        slab_recon = recon(np.asarray(sino[:, lo:hi]), angles, **slab_inputs(lo, hi), **recon_args)
+
+        if out is None:
+            out = np.empty((num_slices,) + slab_recon.shape[1:], dtype=np.float32)
+        out[first:last] = slab_recon[first - lo:last - lo]
+        del slab_recon
+
+    return out
+
+
+def _plan_slabs(sino, angles, slab_size, slab_halo, weights, weight_type, init_image, prox_image, init_proj,
+                sigma_y, snr_db, sigma_x, sigma_p, sharpness, verbose, kwargs):
+    """Split a slab reconstruction of recon_slabs() into slabs.
+
+    Returns:
+        A tuple (slab_bounds, slab_inputs, recon_args) of the (first, last, lo, hi) slices of each slab and its halo,
+        a function slab_inputs(lo, hi) returning the slice-dependent recon() arguments of a slab, and the recon()
+        arguments shared by all slabs.
+    """
+    if not (isinstance(slab_size, int) and slab_size > 0):
+        raise Exception("svmbir.recon_slabs(): 'slab_size' must be a positive integer")
+    if not (isinstance(slab_halo, int) and slab_halo >= 0):
+        raise Exception("svmbir.recon_slabs(): 'slab_halo' must be a non-negative integer")
+    if any(kwargs.get(key) for key in ['checkpoint_file', 'resume_from', 'callback', 'return_proj', 'return_schedule']):
+        raise Exception("svmbir.recon_slabs(): checkpoints, callbacks, return_proj and return_schedule are not "
+                        "supported; use svmbir.recon on each slab")
+
+    num_slices = sino.shape[1]
+    slabs = [(first, min(first + slab_size, num_slices)) for first in range(0, num_slices, slab_size)]
+
+    # Compute the automatic regularization from the whole sinogram so that all slabs use the same values
+    if (sigma_y is None) or (sigma_x is None and prox_image is None) or (sigma_p is None and prox_image is not None):
+        auto_sigma_y, auto_sigma_x, auto_sigma_p = _auto_sigmas_slabs(sino, angles, slabs, weights, weight_type,
+                                                                      snr_db, sharpness, kwargs)
+        sigma_y = auto_sigma_y if sigma_y is None else sigma_y
+        sigma_x = auto_sigma_x if sigma_x is None else sigma_x
+        sigma_p = auto_sigma_p if sigma_p is None else sigma_p
+
+    # Slabs with their halo slices
+    slab_bounds = [(first, last, max(first - slab_halo, 0), min(last + slab_halo, num_slices)) for (first, last) in slabs]
+    recon_args = dict(weight_type=weight_type, sigma_y=sigma_y, snr_db=snr_db, sigma_x=sigma_x, sigma_p=sigma_p,
+                      sharpness=sharpness, verbose=verbose, **kwargs)
+    recon_args['num_processes'] = 1  # each slab is reconstructed in a single process
+
+    def slab_inputs(lo, hi):
+        return dict(weights=_slab_weights(weights, num_slices, lo, hi), init_image=_slab_array(init_image, 0, lo, hi),
+                    prox_image=_slab_array(prox_image, 0, lo, hi), init_proj=_slab_array(init_proj, 1, lo, hi))
+
+    return slab_bounds, slab_inputs, recon_args
 
 
-def project(image, angles, num_channels,
+def _recon_slabs_parallel(sino, angles, slab_bounds, slab_inputs, recon_args, num_workers, out):
+    """Reconstruct the slabs of recon_slabs() in a pool of worker processes.
+
+    The workers are spawned so that they do not inherit the OpenMP state of this process, and each one pins
+    itself to the cores of one NUMA node in its initializer.
+    """
+    (num_views, num_slices, num_channels) = sino.shape
+    image_shape = (num_slices,) + _recon_image_size(angles, num_channels, recon_args)
+    if (out is not None) and (tuple(out.shape) != image_shape):
+        raise Exception("svmbir.recon_slabs(): 'out' should have shape {}".format(image_shape))
+
+    # Split the physical cores of each NUMA node between the workers placed on it
+    node_cpus = utils.numa_node_cpus()
+    workers_per_node = math.ceil(num_workers / len(node_cpus))
+    cores_per_cpu = _default_num_threads() / cpu_count(logical=True)
+    if recon_args.get('num_threads') is None:
+        recon_args = dict(recon_args, num_threads=max(1, int(min(len(cpus) for cpus in node_cpus) * cores_per_cpu)
+                                                      // workers_per_node))
+    verbose = recon_args['verbose']
+    object_name = recon_args.get('object_name', 'object')
+    if verbose >= 1:
+        print(f'Reconstructing {len(slab_bounds)} slabs with {num_workers} processes on {len(node_cpus)} NUMA nodes, '
+              f'{recon_args["num_threads"]} threads each.')
+
+    sino_desc, sino_shm = utils.share_array(sino)
+    # A memmap output is written directly by the workers; any other output is assembled in shared memory
+    if out is not None:
+        out_desc, out_shm = utils.share_array(out, copy=False, writable=True)
+    else:
+        out_desc, out_shm = utils.share_array(np.broadcast_to(np.float32(0), image_shape), copy=False,
+                                              writable=True)
+
+    omp_num_threads = os.environ.get('OMP_NUM_THREADS')
+    os.environ['OMP_NUM_THREADS'] = str(recon_args['num_threads'])
+    mp_context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context, initializer=_recon_slab_worker_init,
+                                 initargs=(mp_context.Value('i', 0), node_cpus)) as pool:
+            # Submit a few slabs ahead of the workers so that only those slabs' inputs are held here
+            pending = set()
+            for (first, last, lo, hi) in slab_bounds:
+                if len(pending) >= 2 * num_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                slab_args = dict(recon_args, object_name='{}_slab{}'.format(object_name, first))
+                pending.add(pool.submit(_recon_slab_worker, sino_desc, out_desc, angles, (first, last, lo, hi),
+                                        slab_inputs(lo, hi), slab_args))
+            for future in pending:
+                future.result()
+
+        if out_shm is not None:
+            shared_out = np.ndarray(image_shape, dtype=np.float32, buffer=out_shm.buf)
+            if out is None:
+                out = np.empty(image_shape, dtype=np.float32)
+            out[...] = shared_out
+            del shared_out
+    finally:
+        if omp_num_threads is None:
+            del os.environ['OMP_NUM_THREADS']
+        else:
+            os.environ['OMP_NUM_THREADS'] = omp_num_threads
+        for shm in [sino_shm, out_shm]:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return out
+
+
+def _recon_slab_worker_init(worker_counter, node_cpus):
+    "Pin a slab worker process to the cores of a NUMA node, placing consecutive workers on different nodes"
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, node_cpus[worker_index % len(node_cpus)])
+
+
+def _recon_slab_worker(sino_desc, out_desc, angles, bounds, slab_inputs, recon_args):
+    "Reconstruct one slab of recon_slabs() in a worker process and write it to the shared output"
+    (first, last, lo, hi) = bounds
+    sino, sino_handle = utils.attach_array(sino_desc)
+    out, out_handle = utils.attach_array(out_desc)
+    try:
+        slab_recon = recon(np.array(sino[:, lo:hi]), angles, **slab_inputs, **recon_args)
+        out[first:last] = slab_recon[first - lo:last - lo]
+        if isinstance(out, np.memmap):
+            out.flush()
+    finally:
+        del sino, out
+        for handle in [sino_handle, out_handle]:
+            if handle is not None:
+                handle.close()
+
+
+def _recon_image_size(angles, num_channels, recon_args):
+    "Return the (num_rows, num_cols) that recon() uses for the given arguments"
+    if isinstance(angles, Geometry):
+        return (angles.num_rows, angles.num_cols)
+    magnification, delta_channel, delta_pixel = _recon_pixel_params(recon_args)
+    num_rows, num_cols = auto_img_size(num_channels, delta_channel, delta_pixel, magnification)
+    num_rows = recon_args['num_rows'] if recon_args.get('num_rows') is not None else num_rows
+    num_cols = recon_args['num_cols'] if recon_args.get('num_cols') is not None else num_cols
+    return (num_rows, num_cols)
+
+
+def _recon_pixel_params(recon_args):
+    "Return the magnification, delta_channel and delta_pixel that recon() uses for the given arguments"
+    magnification = recon_args.get('magnification') if recon_args.get('geometry', 'parallel') != 'parallel' else 1.0
+    delta_channel = recon_args.get('delta_channel', 1.0)
+    delta_pixel = recon_args.get('delta_pixel')
+    if delta_pixel is None:
+        delta_pixel = delta_channel / magnification
+    return magnification, delta_channel, delta_pixel
+
+
+def _slab_array(x, axis, lo, hi):
+    "Return slices lo:hi along the slice axis of an array-like input, or x itself if it is not an array"
+    if x is None or np.isscalar(x):
+        return x
+    index = (slice(None),) * axis + (slice(lo, hi),)
+    return np.asarray(x[index])
+
+
+def _slab_weights(weights, num_slices, lo, hi):
+    "Return the weights of slices lo:hi, keeping broadcast factors that do not depend on the slice"
+    if weights is None:
+        return None
+    factors = weights if isinstance(weights, (tuple, list)) else (weights,)
+    slab_factors = tuple(_slab_array(factor, 1, lo, hi) if factor.ndim == 3 and factor.shape[1] == num_slices
+                         else np.asarray(factor) for factor in factors)
+    return slab_factors if isinstance(weights, (tuple, list)) else slab_factors[0]
+
+
+def _auto_sigmas_slabs(sino, angles, slabs, weights, weight_type, snr_db, sharpness, kwargs):
+    """Compute the automatic sigma_y, sigma_x and sigma_p of a sinogram that is read one slab at a time.
+
+    This uses the same sinogram support and averages as auto_sigma_y() and auto_sigma_prior() for the whole sinogram.
+    """
+    (num_views, num_slices, num_channels) = sino.shape
+
+    if isinstance(angles, Geometry):
+        magnification, delta_channel, delta_pixel = angles.magnification, angles.delta_channel, angles.delta_pixel
+    else:
+        magnification, delta_channel, delta_pixel = _recon_pixel_params(kwargs)
+
+    # First pass: threshold of the sinogram support
+    abs_sum = 0.0
+    for (first, last) in slabs:
+        abs_sum += np.sum(np.fabs(np.asarray(sino[:, first:last])), dtype=np.float64)
+    threshold = 0.05 * abs_sum / sino.size
+
+    # Second pass: weighted sums over the sinogram support
+    support_count = 0
+    sino_sum = 0.0
+    weighted_sum = 0.0
+    for (first, last) in slabs:
+        slab_sino = np.asarray(sino[:, first:last])
+        slab_indicator = slab_sino > threshold
+        support_count += np.count_nonzero(slab_indicator)
+        sino_sum += np.sum(slab_sino, where=slab_indicator, dtype=np.float64)
+
+        slab_weights = utils.test_args_weights(_slab_weights(weights, num_slices, first, last), slab_sino.shape)
+        view_weights = np.empty(slab_sino.shape[1:], dtype=np.float32)
+        for view in range(num_views):
+            if slab_weights is None:
+                utils.calc_weights_into(slab_sino[view], weight_type, view_weights)
+            else:
+                utils.weights_view(slab_weights, view, view_weights)
+            weighted_sum += np.sum(view_weights * slab_sino[view] ** 2, where=slab_indicator[view], dtype=np.float64)
+
+    sigma_y = _sigma_y_from_rms((weighted_sum / support_count) ** 0.5, magnification, delta_channel, delta_pixel, snr_db)
+    sigma_prior = _sigma_prior_from_mean(sino_sum / support_count, num_channels, magnification, delta_channel, sharpness)
+
+    return float(sigma_y), float(0.2 * sigma_prior), float(1.0 * sigma_prior)
+
+
+def project(image, angles, num_channels = None,
             geometry = 'parallel', dist_source_detector = None, magnification = None,
             delta_channel = 1.0, delta_pixel = None, center_offset = 0.0, roi_radius = None,
             num_threads = None, svmbir_lib_path = __svmbir_lib_path, delete_temps = True,
-            object_name = 'object', verbose = 1):
+            object_name = 'object', verbose = 1, out = None):
     """project(image, angles, num_channels, geometry = 'parallel', **kwargs)
 
     Compute 3D forward-projection.
@@ -505,11 +1300,15 @@ def project(image, angles, num_channels,
             3D numpy array of image being projected.
             The image shape is (num_slices,num_rows,num_cols). The output will contain 'num_slices' projections.
             Note the image is considered 0 outside the 'roi_radius' (disregarded pixels).
-        angles (ndarray):
+            A 4D array with shape (batch_size,num_slices,num_rows,num_cols) projects a batch of images
+            in a single pass over the system matrix.
+        angles (ndarray or svmbir.Geometry):
             1D numpy array of view angles in radians.
             'angles[k]' is the angle in radians for view :math:`k`.
+            If a ``svmbir.Geometry`` is given, all geometry arguments are taken from it and the remaining
+            geometry arguments of this function are ignored.
         num_channels (int):
-            Number of sinogram channels.
+            Number of sinogram channels. Required unless ``angles`` is a ``svmbir.Geometry``.
         geometry (string):
             [Default='parallel'] Scanner geometry: 'parallel', 'fan-curved', or 'fan-flat'. Note for fan geometries
             the ``dist_source_detector`` and ``magnification`` arguments must be specified.
@@ -535,9 +1334,13 @@ def project(image, angles, num_channels,
         object_name (string, optional):
             [Default='object'] Specifies base filename of temporary files. Unused for cython version.
         verbose (int, optional): [Default=1] Level of printed status output. {0,1,2} Set to 0 for quiet mode.
+        out (ndarray, optional): [Default=None] float32 array with the shape of the result that the projection
+            is written to. If ``np.swapaxes(out, 0, 1)`` is C-contiguous, the C library writes to it directly.
 
     Returns:
         ndarray: 3D numpy array containing projection with shape (num_views, num_slices, num_channels).
+        For a batch of images the shape is (batch_size, num_views, num_slices, num_channels).
+        If ``out`` is given, it is returned.
     """
 
     # Temporary check for argument order. From v0.2.4, order is project(image,angles,...)
@@ -549,12 +1352,17 @@ def project(image, angles, num_channels,
         image = angles
         angles = temp_id
 
+    # Fold the batch axis into the slice axis; the 2D system matrix is shared by all slices
+    batch_size = None
+    if isinstance(image,np.ndarray) and (image.ndim == 4):
+        batch_size = image.shape[0]
+        image = _fold_image_batch(image)
+
     # validate input arguments
     image = utils.test_args_image(image)
-    angles = utils.test_args_angles(angles)
 
     if num_threads is None :
-        num_threads = cpu_count(logical=False)
+        num_threads = _default_num_threads()
 
     os.environ['OMP_NUM_THREADS'] = str(num_threads)
     os.environ['OMP_DYNAMIC'] = 'true'
@@ -562,37 +1370,48 @@ def project(image, angles, num_channels,
     num_slices = image.shape[0]
     num_rows = image.shape[1]
     num_cols = image.shape[2]
-    num_views = len(angles)
-
-    # Issue warning that 'fan' geometry will be removed in the future (last valid version is v0.2.9)
-    if geometry=='fan':
-        geometry = 'fan-curved'
-        warnings.warn("'fan' geometry will be removed in a future release. Fan beam geometry is now specified as either 'fan-curved' or 'fan-flat'. Defaulting to 'fan-curved'.",FutureWarning)
 
-    # Geometry dependent settings
-    if geometry == 'parallel':
-        dist_source_detector = 0.0
-        magnification = 1.0
-    elif geometry=='fan-curved' or geometry=='fan-flat':
-        if dist_source_detector is None or magnification is None:
-            raise Exception('For fan beam geometries, need to specify dist_source_detector and magnification')
+    # Reuse the setup of a precomputed geometry
+    if isinstance(angles, Geometry):
+        if (num_rows, num_cols) != (angles.num_rows, angles.num_cols):
+            raise Exception("Error: image shape does not agree with the geometry (num_rows, num_cols)")
+        paths, sinoparams, imgparams = angles._init_geometry(num_slices, object_name=object_name, verbose=verbose)
     else:
-        raise Exception('Unrecognized geometry {}'.format(geometry))
-
-    if delta_pixel is None:
-        delta_pixel = delta_channel/magnification
-    if roi_radius is None :
-        roi_radius = auto_roi_radius(delta_pixel, num_rows, num_cols)
-
-    paths, sinoparams, imgparams = ci._init_geometry(angles, center_offset=center_offset,
-                                                     geometry=geometry, dist_source_detector=dist_source_detector,
-                                                     magnification=magnification,
-                                                     num_channels=num_channels, num_views=num_views, num_slices=num_slices,
-                                                     num_rows=num_rows, num_cols=num_cols,
-                                                     delta_channel=delta_channel, delta_pixel=delta_pixel,
-                                                     roi_radius=roi_radius,
-                                                     svmbir_lib_path=svmbir_lib_path, object_name=object_name,
-                                                     verbose=verbose)
+        angles = utils.test_args_angles(angles)
+        num_views = len(angles)
+
+        if num_channels is None:
+            raise Exception("svmbir.project(): num_channels must be specified unless angles is a svmbir.Geometry")
+
+        # Issue warning that 'fan' geometry will be removed in the future (last valid version is v0.2.9)
+        if geometry=='fan':
+            geometry = 'fan-curved'
+            warnings.warn("'fan' geometry will be removed in a future release. Fan beam geometry is now specified as either 'fan-curved' or 'fan-flat'. Defaulting to 'fan-curved'.",FutureWarning)
+
+        # Geometry dependent settings
+        if geometry == 'parallel':
+            dist_source_detector = 0.0
+            magnification = 1.0
+        elif geometry=='fan-curved' or geometry=='fan-flat':
+            if dist_source_detector is None or magnification is None:
+                raise Exception('For fan beam geometries, need to specify dist_source_detector and magnification')
+        else:
+            raise Exception('Unrecognized geometry {}'.format(geometry))
+
+        if delta_pixel is None:
+            delta_pixel = delta_channel/magnification
+        if roi_radius is None :
+            roi_radius = auto_roi_radius(delta_pixel, num_rows, num_cols)
+
+        paths, sinoparams, imgparams = ci._init_geometry(angles, center_offset=center_offset,
+                                                         geometry=geometry, dist_source_detector=dist_source_detector,
+                                                         magnification=magnification,
+                                                         num_channels=num_channels, num_views=num_views, num_slices=num_slices,
+                                                         num_rows=num_rows, num_cols=num_cols,
+                                                         delta_channel=delta_channel, delta_pixel=delta_pixel,
+                                                         roi_radius=roi_radius,
+                                                         svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                                                         verbose=verbose)
 
     # Collect settings to pass to C
     settings = dict()
@@ -603,9 +1422,23 @@ def project(image, angles, num_channels,
     settings['num_threads'] = num_threads
     settings['delete_temps'] = delete_temps
 
+    if out is not None:
+        if batch_size is None:
+            settings['out'] = utils.test_args_out(out, (sinoparams['num_views'], num_slices, sinoparams['num_channels']),
+                                                  contiguous=False)
+        else:
+            out = utils.test_args_out(out, (batch_size, sinoparams['num_views'], num_slices//batch_size,
+                                            sinoparams['num_channels']), contiguous=False)
+
     # Do the projection
     proj = ci.project(image, settings)
 
+    if batch_size is not None:
+        proj = _unfold_sino_batch(proj, batch_size)
+        if out is not None:
+            np.copyto(out, proj)
+            proj = out
+
     return proj
 
 
@@ -613,7 +1446,7 @@ def backproject(sino, angles, num_rows=None, num_cols=None,
             geometry = 'parallel', dist_source_detector = None, magnification = None,
             delta_channel = 1.0, delta_pixel = None, center_offset = 0.0, roi_radius = None,
             num_threads = None, svmbir_lib_path = __svmbir_lib_path, delete_temps = True,
-            object_name = 'object', verbose = 1):
+            object_name = 'object', verbose = 1, out = None):
     """backproject(sino, angles, **kwargs)
 
     Compute 3D back-projection.
@@ -621,9 +1454,13 @@ def backproject(sino, angles, num_rows=None, num_cols=None,
     Args:
         sino (ndarray):
             3D numpy array of input sinogram with shape (num_views,num_slices,num_channels).
-        angles (ndarray):
+            A 4D array with shape (batch_size,num_views,num_slices,num_channels) back projects a batch
+            of sinograms in a single pass over the system matrix.
+        angles (ndarray or svmbir.Geometry):
             1D numpy array of view angles in radians.
             'angles[k]' is the angle in radians for view :math:`k`.
+            If a ``svmbir.Geometry`` is given, all geometry arguments are taken from it and the remaining
+            geometry arguments of this function are ignored.
         num_rows (int, optional):
             [Default=num_channels] Integer number of output image rows.
         num_cols (int, optional):
@@ -654,17 +1491,32 @@ def backproject(sino, angles, num_rows=None, num_cols=None,
         object_name (string, optional):
             [Default='object'] Specifies base filename of temporary files. Unused for cython version.
         verbose (int, optional): [Default=1] Level of printed status output. {0,1,2} Set to 0 for quiet mode.
+        out (ndarray, optional): [Default=None] C-contiguous float32 array with the shape of the result, such as
+            a slab of a ``numpy.memmap``, that the back projection is written to.
 
     Returns:
         ndarray: 3D numpy array containing back projected image (num_slices,num_rows,num_cols).
+        For a batch of sinograms the shape is (batch_size,num_slices,num_rows,num_cols).
+        If ``out`` is given, it is returned.
     """
 
+    # Reuse the setup of a precomputed geometry
+    geom = angles if isinstance(angles, Geometry) else None
+    if geom is not None:
+        angles = geom.angles
+
+    # Fold the batch axis into the slice axis; the 2D system matrix is shared by all slices
+    batch_size = None
+    if isinstance(sino,np.ndarray) and (sino.ndim == 4):
+        batch_size = sino.shape[0]
+        sino = _fold_sino_batch(sino)
+
     # validate input arguments
     angles = utils.test_args_angles(angles)
     sino = utils.test_args_sino(sino,angles)
 
     if num_threads is None :
-        num_threads = cpu_count(logical=False)
+        num_threads = _default_num_threads()
 
     os.environ['OMP_NUM_THREADS'] = str(num_threads)
     os.environ['OMP_DYNAMIC'] = 'true'
@@ -676,12 +1528,518 @@ def backproject(sino, angles, num_rows=None, num_cols=None,
     if num_views != len(angles):
         raise Exception('svmbir.backproject(): angles and sinogram arrays have conflicting sizes')
 
-    # Issue warning that 'fan' geometry will be removed in the future (last valid version is v0.2.9)
-    if geometry=='fan':
+    if geom is not None:
+        if num_channels != geom.num_channels:
+            raise Exception("Error: Input 'sino' and geometry have different numbers of channels")
+        paths, sinoparams, imgparams = geom._init_geometry(num_slices, object_name=object_name, verbose=verbose)
+    else:
+        # Issue warning that 'fan' geometry will be removed in the future (last valid version is v0.2.9)
+        if geometry=='fan':
+            geometry = 'fan-curved'
+            warnings.warn("'fan' geometry will be removed in a future release. Fan beam geometry is now specified as either 'fan-curved' or 'fan-flat'. Defaulting to 'fan-curved'.",FutureWarning)
+
+        # Geometry dependent settings
+        if geometry == 'parallel':
+            dist_source_detector = 0.0
+            magnification = 1.0
+        elif geometry=='fan-curved' or geometry=='fan-flat':
+            if dist_source_detector is None or magnification is None:
+                raise Exception('For fan beam geometries, need to specify dist_source_detector and magnification')
+        else:
+            raise Exception('Unrecognized geometry {}'.format(geometry))
+
+        if delta_pixel is None:
+            delta_pixel = delta_channel/magnification
+        if num_rows is None:
+            num_rows,_ = auto_img_size(num_channels, delta_channel, delta_pixel, magnification)
+        if num_cols is None:
+            _,num_cols = auto_img_size(num_channels, delta_channel, delta_pixel, magnification)
+        if roi_radius is None:
+            roi_radius = auto_roi_radius(delta_pixel, num_rows, num_cols)
+
+        paths, sinoparams, imgparams = ci._init_geometry(angles, center_offset=center_offset,
+                                                         geometry=geometry, dist_source_detector=dist_source_detector,
+                                                         magnification=magnification,
+                                                         num_channels=num_channels, num_views=num_views, num_slices=num_slices,
+                                                         num_rows=num_rows, num_cols=num_cols,
+                                                         delta_channel=delta_channel, delta_pixel=delta_pixel,
+                                                         roi_radius=roi_radius,
+                                                         svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                                                         verbose=verbose)
+
+    # Collect settings to pass to C
+    settings = dict()
+    settings['paths'] = paths
+    settings['imgparams'] = imgparams
+    settings['sinoparams'] = sinoparams
+    settings['verbose'] = verbose
+    settings['num_threads'] = num_threads
+    settings['delete_temps'] = delete_temps
+
+    if out is not None:
+        image_shape = (num_slices, imgparams['Ny'], imgparams['Nx'])
+        if batch_size is None:
+            settings['out'] = utils.test_args_out(out, image_shape)
+        else:
+            out = utils.test_args_out(out, (batch_size, num_slices//batch_size) + image_shape[1:])
+            settings['out'] = _fold_image_batch(out)
+
+    image = ci.backproject(sino, settings)
+
+    if batch_size is not None:
+        image = _unfold_image_batch(image, batch_size)
+    if out is not None:
+        image = out
+
+    return image
+
+
+def _fold_image_batch(image):
+    "Reshape a batch of images (batch_size,num_slices,num_rows,num_cols) to one image with batch_size*num_slices slices"
+    return image.reshape((-1,) + image.shape[2:])
+
+
+def _unfold_image_batch(image, batch_size):
+    "Inverse of _fold_image_batch()"
+    return image.reshape((batch_size, -1) + image.shape[1:])
+
+
+def _fold_sino_batch(sino):
+    """Reshape a batch of sinograms (batch_size,num_views,num_slices,num_channels) to one sinogram with
+    batch_size*num_slices slices. The result is a view of a (slices,views,channels) float32 array, which is
+    the layout used by the C library, so it is not copied again.
+    """
+    (batch_size, num_views, num_slices, num_channels) = sino.shape
+    sino = np.ascontiguousarray(np.transpose(sino, (0, 2, 1, 3)), dtype=np.float32)
+    return np.swapaxes(sino.reshape(batch_size*num_slices, num_views, num_channels), 0, 1)
+
+
+def _unfold_sino_batch(sino, batch_size):
+    "Inverse of _fold_sino_batch()"
+    (num_views, _, num_channels) = sino.shape
+    return np.moveaxis(sino.reshape(num_views, batch_size, -1, num_channels), 1, 0)
+
+
+class Projector:
+    """Projector(geometry, num_slices = 1, num_threads = None, verbose = 0)
+
+    Linear operator :math:`A` that maps an image to its sinogram for a fixed ``svmbir.Geometry`` and number of slices.
+
+    The system matrix is computed or found in the cache once when the projector is created, and its file is
+    kept open until ``close()`` is called or the projector is deleted, so repeated applications inside an
+    iterative solver do no setup and are not affected by eviction from the cache. The interface follows ``scipy.sparse.linalg.LinearOperator``; a
+    ``LinearOperator`` can be created with
+    ``LinearOperator(P.shape, matvec=P.matvec, rmatvec=P.rmatvec, dtype=P.dtype)``.
+
+    Args:
+        geometry (svmbir.Geometry): Scan geometry and reconstruction grid.
+        num_slices (int, optional): [Default=1] Number of slices of the images and sinograms.
+        num_threads (int, optional): [Default=None] Number of compute threads requested when executed.
+            If None, num_threads is set to the number of cores in the system.
+        verbose (int, optional): [Default=0] Level of printed status output. {0,1,2} Set to 0 for quiet mode.
+
+    Attributes:
+        image_shape (tuple): Shape (num_slices, num_rows, num_cols) of the image.
+        sino_shape (tuple): Shape (num_views, num_slices, num_channels) of the sinogram.
+        shape (tuple): Shape (M, N) of the operator on flattened arrays, with M the sinogram size and N the image size.
+        dtype (numpy.dtype): float32.
+    """
+
+    dtype = np.dtype(np.float32)
+
+    def __init__(self, geometry, num_slices = 1, num_threads = None, verbose = 0):
+        if not isinstance(geometry, Geometry):
+            raise Exception("svmbir.Projector(): 'geometry' must be a svmbir.Geometry")
+        if not (isinstance(num_slices, int) and num_slices > 0):
+            raise Exception("svmbir.Projector(): 'num_slices' must be a positive integer")
+
+        self.geometry = geometry
+        self.num_threads = num_threads if num_threads is not None else _default_num_threads()
+        self.verbose = verbose
+        self.image_shape = (num_slices, geometry.num_rows, geometry.num_cols)
+        self.sino_shape = (geometry.num_views, num_slices, geometry.num_channels)
+        self.shape = (int(np.prod(self.sino_shape)), int(np.prod(self.image_shape)))
+
+        # Keep the system matrix file open for the lifetime of the projector, so that it cannot be evicted
+        fd, self._sysmatrix_file = geometry._pin_sysmatrix(num_slices, verbose=verbose)
+        self._finalizer = weakref.finalize(self, os.close, fd) if fd is not None else None
+
+    def __repr__(self):
+        return 'svmbir.Projector(image_shape={}, sino_shape={})'.format(self.image_shape, self.sino_shape)
+
+    def close(self):
+        "Close the system matrix file"
+        if self._finalizer is not None:
+            self._finalizer()
+        self._sysmatrix_file = None
+
+    def _settings(self, num_slices):
+        "Return the settings dict passed to the projection functions of the C interface"
+        paths, sinoparams, imgparams = self.geometry._init_geometry(num_slices, verbose=self.verbose)
+        settings = dict()
+        settings['paths'] = paths
+        settings['imgparams'] = imgparams
+        settings['sinoparams'] = sinoparams
+        settings['verbose'] = self.verbose
+        settings['num_threads'] = self.num_threads
+        settings['delete_temps'] = True
+        settings['sysmatrix_file'] = self._sysmatrix_file
+        return settings
+
+    def forward(self, image, out = None):
+        """Compute the sinogram :math:`Ax` of an image.
+
+        Args:
+            image (ndarray): Image of shape ``image_shape``, or flattened to N elements, or a batch of images
+                of shape (batch_size,) + ``image_shape``.
+            out (ndarray, optional): [Default=None] float32 array with the shape of the result to write to.
+
+        Returns:
+            ndarray: float32 sinogram of shape ``sino_shape``, or (batch_size,) + ``sino_shape`` for a batch.
+        """
+        image = np.asarray(image)
+        batch_size = image.shape[0] if image.ndim == 4 else None
+        if batch_size is None:
+            image = image.reshape(self.image_shape)
+        elif image.shape[1:] != self.image_shape:
+            raise Exception("svmbir.Projector.forward(): image batch shape does not agree with image_shape")
+        else:
+            image = _fold_image_batch(image)
+
+        settings = self._settings(image.shape[0])
+        if out is not None:
+            if batch_size is None:
+                settings['out'] = utils.test_args_out(out, self.sino_shape, contiguous=False)
+            else:
+                out = utils.test_args_out(out, (batch_size,) + self.sino_shape, contiguous=False)
+
+        os.environ['OMP_NUM_THREADS'] = str(self.num_threads)
+        proj = ci.project(image, settings)
+
+        if batch_size is not None:
+            proj = _unfold_sino_batch(proj, batch_size)
+            if out is not None:
+                np.copyto(out, proj)
+                proj = out
+        return proj
+
+    def adjoint(self, sino, out = None):
+        """Compute the back projection :math:`A^T y` of a sinogram.
+
+        Args:
+            sino (ndarray): Sinogram of shape ``sino_shape``, or flattened to M elements, or a batch of sinograms
+                of shape (batch_size,) + ``sino_shape``.
+            out (ndarray, optional): [Default=None] C-contiguous float32 array with the shape of the result to write to.
+
+        Returns:
+            ndarray: float32 image of shape ``image_shape``, or (batch_size,) + ``image_shape`` for a batch.
+        """
+        sino = np.asarray(sino)
+        batch_size = sino.shape[0] if sino.ndim == 4 else None
+        if batch_size is None:
+            sino = sino.reshape(self.sino_shape)
+        elif sino.shape[1:] != self.sino_shape:
+            raise Exception("svmbir.Projector.adjoint(): sinogram batch shape does not agree with sino_shape")
+        else:
+            sino = _fold_sino_batch(sino)
+
+        settings = self._settings(sino.shape[1])
+        if out is not None:
+            if batch_size is None:
+                settings['out'] = utils.test_args_out(out, self.image_shape)
+            else:
+                settings['out'] = _fold_image_batch(utils.test_args_out(out, (batch_size,) + self.image_shape))
+
+        os.environ['OMP_NUM_THREADS'] = str(self.num_threads)
+        image = ci.backproject(sino, settings)
+
+        if batch_size is not None:
+            image = _unfold_image_batch(image, batch_size)
+        if out is not None:
+            image = out
+        return image
+
+    def matvec(self, x):
+        "Apply the operator to a flattened image and return the flattened sinogram"
+        return self.forward(x).reshape(-1)
+
+    def rmatvec(self, y):
+        "Apply the adjoint operator to a flattened sinogram and return the flattened image"
+        return self.adjoint(y).reshape(-1)
+
+    __call__ = forward
+
+
+class ProxSession:
+    """ProxSession(sino, geometry, weights = None, weight_type = 'unweighted', **kwargs)
+
+    Proximal map of the MBIR forward model for a fixed sinogram and ``svmbir.Geometry``, for Plug-and-Play and
+    ADMM loops that call ``svmbir.recon`` with a ``prox_image`` many times on the same data.
+
+    The arguments are validated, the automatic ``sigma_y`` and ``sigma_p`` are computed, and the sinogram and
+    scaled weights are converted to the layout of the C library once when the session is created. The system
+    matrix file is kept open until ``close()`` is called or the session is deleted.
+    Each call of ``prox`` then only runs the ICD iterations. With the command line interface, the sinogram
+    and weights are still written to disk on each call.
+
+    Args:
+        sino (ndarray): 3D sinogram array with shape (num_views, num_slices, num_channels).
+        geometry (svmbir.Geometry): Scan geometry and reconstruction grid.
+        weights (ndarray or tuple, optional): [Default=None] Weights as in ``svmbir.recon``.
+        weight_type (string, optional): [Default="unweighted"] Type of noise model used for data.
+        sigma_y (float, optional): [Default=None] Noise standard deviation parameter.
+            If None, automatically set with auto_sigma_y.
+        snr_db (float, optional): [Default=30.0] Assumed signal-to-noise ratio of the data in dB.
+        sigma_p (float, optional): [Default=None] Proximal map parameter. If None, automatically set with auto_sigma_p.
+        sharpness (float, optional): [Default=0.0] Controls the automatic value of ``sigma_p``.
+        p (float, optional): [Default=1.2] Scalar value in range :math:`[1,2]` passed to the C library as in ``svmbir.recon``.
+        q (float, optional): [Default=2.0] Scalar value in range :math:`[p,2]` passed to the C library as in ``svmbir.recon``.
+        T (float, optional): [Default=1.0] Scalar value :math:`>0` passed to the C library as in ``svmbir.recon``.
+        b_interslice (float, optional): [Default=1.0] Interslice regularization passed to the C library as in ``svmbir.recon``.
+        positivity (bool, optional): [Default=True] Enforce a positivity constraint.
+        relax_factor (float, optional): [Default=1.0] Relaxation factor for pixel update.
+        stop_threshold (float, optional): [Default=0.02] Stopping threshold in percent.
+        max_iterations (int, optional): [Default=100] Maximum number of iterations of each call.
+        num_threads (int, optional): [Default=None] Number of compute threads requested when executed.
+            If None, num_threads is set to the number of cores in the system.
+        object_name (string, optional): [Default='object'] Specifies filenames of temporary files.
+        verbose (int, optional): [Default=0] Level of printed status output. {0,1,2} Set to 0 for quiet mode.
+
+    Attributes:
+        image_shape (tuple): Shape (num_slices, num_rows, num_cols) of the images.
+        sino_shape (tuple): Shape (num_views, num_slices, num_channels) of the sinogram.
+        sigma_y (float): Noise standard deviation parameter used by the session.
+        sigma_p (float): Proximal map parameter used by the session.
+    """
+
+    def __init__(self, sino, geometry, weights = None, weight_type = 'unweighted', sigma_y = None, snr_db = 30.0,
+                 sigma_p = None, sharpness = 0.0, p = 1.2, q = 2.0, T = 1.0, b_interslice = 1.0, positivity = True,
+                 relax_factor = 1.0, stop_threshold = 0.02, max_iterations = 100, num_threads = None,
+                 object_name = 'object', verbose = 0):
+        if not isinstance(geometry, Geometry):
+            raise Exception("svmbir.ProxSession(): 'geometry' must be a svmbir.Geometry")
+        sino = utils.test_args_sino(sino, geometry.angles)
+        (num_views, num_slices, num_channels) = sino.shape
+        if num_channels != geometry.num_channels:
+            raise Exception("Error: Input 'sino' and geometry have different numbers of channels")
+
+        sharpness, positivity, relax_factor, _, stop_threshold, max_iterations = utils.test_args_recon(
+            sharpness, positivity, relax_factor, 0, stop_threshold, max_iterations)
+        _, _, _, _, weight_type = utils.test_args_inits(0.0, None, None, weights, weight_type)
+        weights = utils.test_args_weights(weights, sino.shape)
+        sigma_y, snr_db, _, sigma_p = utils.test_args_noise(sigma_y, snr_db, None, sigma_p)
+        p, q, T, b_interslice = utils.test_args_qggmrf(p, q, T, b_interslice)
+        num_threads, _, verbose = utils.test_args_sys(num_threads, True, verbose)
+
+        if sigma_y is None:
+            sigma_y = auto_sigma_y(sino, weights, geometry.magnification, delta_channel=geometry.delta_channel,
+                                   delta_pixel=geometry.delta_pixel, snr_db=snr_db, weight_type=weight_type)
+        if sigma_p is None:
+            sigma_p = auto_sigma_p(sino, geometry.magnification, geometry.delta_channel, sharpness)
+
+        self.geometry = geometry
+        self.image_shape = (num_slices, geometry.num_rows, geometry.num_cols)
+        self.sino_shape = sino.shape
+        self.sigma_y = sigma_y
+        self.sigma_p = sigma_p
+        self.num_threads = num_threads if num_threads is not None else _default_num_threads()
+        self.verbose = verbose
+        self._recon_args = dict(weight_type=weight_type, geometry=geometry.geometry,
+                                dist_source_detector=geometry.dist_source_detector,
+                                magnification=geometry.magnification, num_rows=geometry.num_rows,
+                                num_cols=geometry.num_cols, roi_radius=geometry.roi_radius,
+                                delta_channel=geometry.delta_channel, delta_pixel=geometry.delta_pixel,
+                                center_offset=geometry.center_offset, sigma_y=sigma_y, sigma_x=sigma_p,
+                                p=p, q=q, T=T, b_interslice=b_interslice, positivity=positivity,
+                                relax_factor=relax_factor, stop_threshold=stop_threshold,
+                                max_iterations=max_iterations, num_threads=self.num_threads,
+                                svmbir_lib_path=geometry.svmbir_lib_path, object_name=object_name, verbose=verbose,
+                                geometry_levels=geometry._levels)
+
+        # The Cython interface reconstructs from buffers in the C layout that are kept for the session
+        if hasattr(ci, '_recon_level'):
+            self._c_sino, self._c_weights = ci._c_sino_weights(sino, weights, weight_type, 1.0 / sigma_y**2)
+        else:
+            self._sino, self._weights = sino, weights
+
+        # Keep the system matrix file open for the lifetime of the session, so that it cannot be evicted
+        fd, self._sysmatrix_file = geometry._pin_sysmatrix(num_slices, object_name=object_name, verbose=verbose)
+        self._finalizer = weakref.finalize(self, os.close, fd) if fd is not None else None
+
+    def __repr__(self):
+        return 'svmbir.ProxSession(image_shape={}, sino_shape={})'.format(self.image_shape, self.sino_shape)
+
+    def close(self):
+        "Close the system matrix file and release the sinogram buffers"
+        if self._finalizer is not None:
+            self._finalizer()
+        self._sysmatrix_file = None
+        self._c_sino = self._c_weights = self._sino = self._weights = None
+
+    def prox(self, prox_image, init_image = None, init_proj = None, out = None, return_proj = False):
+        """Compute the proximal map of the forward model at ``prox_image``, as
+        ``svmbir.recon(sino, geometry, prox_image=prox_image, init_image=init_image, init_proj=init_proj)``.
+
+        Args:
+            prox_image (ndarray): Proximal map input image of shape ``image_shape``.
+            init_image (float or ndarray, optional): [Default=None] Initial image. If None, ``prox_image``.
+            init_proj (ndarray, optional): [Default=None] Forward projection of ``init_image`` with shape
+                ``sino_shape``, such as the projection returned by the previous call with ``return_proj=True``.
+            out (ndarray, optional): [Default=None] C-contiguous float32 array of shape ``image_shape`` that the
+                result is computed in. It may be ``init_image``.
+            return_proj (bool, optional): [Default=False] If True, also return the forward projection of the result.
+                It is a view of a buffer in the layout of the C library, so it is not copied when it is passed
+                back as ``init_proj``.
+
+        Returns:
+            ndarray: float32 image of shape ``image_shape``, or a tuple (image, proj) if ``return_proj`` is True.
+        """
+        if self._sysmatrix_file is None:
+            raise Exception("svmbir.ProxSession.prox(): the session is closed")
+        prox_image = utils.test_args_image(prox_image)
+        if prox_image.shape != self.image_shape:
+            raise Exception("Parameter prox_image should have shape (num_slices,num_rows,num_cols).")
+        if init_image is None:
+            init_image = prox_image
+        init_image, _, init_proj, _, _ = utils.test_args_inits(init_image, prox_image, init_proj, None, 'unweighted')
+        if (init_proj is not None) and (init_proj.shape != self.sino_shape):
+            raise Exception("Parameter init_proj should have shape (num_views,num_slices,num_channels).")
+
+        # The C library writes the result over its initial image, so it is always computed in a separate buffer
+        if out is None:
+            out = np.empty(self.image_shape, dtype=np.float32)
+        out = utils.test_args_out(out, self.image_shape)
+        proj = None
+        if return_proj:
+            (num_views, num_slices, num_channels) = self.sino_shape
+            proj = np.swapaxes(np.empty((num_slices, num_views, num_channels), dtype=np.float32), 0, 1)
+
+        os.environ['OMP_NUM_THREADS'] = str(self.num_threads)
+        if hasattr(ci, '_recon_level'):
+            # a projection returned by a previous call is already in the C layout and is not copied
+            c_proj_init = None
+            if init_proj is not None:
+                c_proj_init = np.ascontiguousarray(np.swapaxes(init_proj, 0, 1), dtype=np.single)
+            image = ci._recon_level(self._c_sino, self._c_weights, c_proj_init, self.geometry.angles, init_image,
+                                    prox_image, init_image_value=init_image if np.isscalar(init_image) else 0,
+                                    out=out, sysmatrix_file=self._sysmatrix_file, **self._recon_args)
+            if return_proj:
+                settings = dict(self._settings(), out=proj)
+                ci.project(image, settings)
+        else:
+            image = ci.multires_recon(sino=self._sino, angles=self.geometry.angles, weights=self._weights,
+                                      init_image=init_image, prox_image=prox_image, init_proj=init_proj,
+                                      max_resolutions=0, delete_temps=True, out=out, proj_out=proj, **self._recon_args)
+
+        return (image, proj) if return_proj else image
+
+    def _settings(self):
+        "Return the settings dict passed to the projection functions of the C interface"
+        paths, sinoparams, imgparams = self.geometry._init_geometry(self.image_shape[0], verbose=self.verbose)
+        return dict(paths=paths, imgparams=imgparams, sinoparams=sinoparams, verbose=self.verbose,
+                    num_threads=self.num_threads, delete_temps=True, sysmatrix_file=self._sysmatrix_file)
+
+
+def precompute_sysmatrix(geometries, max_resolutions = 2, num_workers = None,
+                         svmbir_lib_path = __svmbir_lib_path, verbose = 1):
+    """precompute_sysmatrix(geometries, max_resolutions = 2, **kwargs)
+
+    Compute and cache the system matrices of a list of scan geometries in parallel.
+
+    For each geometry, the matrices of the full resolution grid and of every lower resolution grid, with the
+    reduced views and channels of that resolution, used by ``recon`` with the default schedule and the given
+    ``max_resolutions`` are computed, unless they are already cached.
+    Subsequent calls to ``recon``, ``project`` and ``backproject`` with these geometries load the cached matrices.
+
+    Args:
+        geometries (list of dict): Each dict holds the geometry arguments of ``svmbir.recon``:
+            ``angles`` and ``num_channels`` are required; ``geometry``, ``dist_source_detector``, ``magnification``,
+            ``num_rows``, ``num_cols``, ``delta_channel``, ``delta_pixel``, ``center_offset`` and ``roi_radius``
+            are optional and have the same defaults as in ``svmbir.recon``.
+        max_resolutions (int, optional): [Default=2] Number of lower resolutions to precompute, as in ``svmbir.recon``.
+        num_workers (int, optional): [Default=None] Number of worker processes.
+            If None, num_workers is set to the number of cores in the system.
+        svmbir_lib_path (string, optional): [Default='~/.cache/svmbir'] Path to directory containing
+            library of forward projection matrices.
+        verbose (int, optional): [Default=1] Level of printed status output. {0,1,2} Set to 0 for quiet mode.
+
+    Returns:
+        list: Paths of the distinct system matrix files, with the matrices of each geometry listed from finest to coarsest.
+    """
+    if num_workers is None:
+        num_workers = _default_num_threads()
+
+    # Enumerate the matrices of all geometries and resolutions, dropping duplicates. The coarse resolutions use
+    # the decimated sinogram geometry of the default schedule of recon.
+    tasks = dict()
+    for geom in geometries:
+        geom = _geometry_args(**geom)
+        schedule = utils.multires_schedule(1, geom['num_rows'], geom['num_cols'], geom['delta_pixel'], max_resolutions,
+                                           0.02, 100, 1.0)
+        for settings in schedule:
+            sino_geometry = utils.multires_sino_geometry(settings, geom['angles'], geom['num_channels'],
+                                                         geom['delta_channel'], geom['center_offset'],
+                                                         geom['magnification'])
+            task = dict(geom, num_rows=settings['num_rows'], num_cols=settings['num_cols'],
+                        delta_pixel=settings['delta_pixel'], angles=sino_geometry['angles'],
+                        num_channels=sino_geometry['num_channels'], delta_channel=sino_geometry['delta_channel'],
+                        center_offset=sino_geometry['center_offset'])
+            key = (task['angles'].astype(np.single).tobytes(),) + tuple(v for k, v in sorted(task.items()) if k != 'angles')
+            tasks.setdefault(key, task)
+
+    if verbose >= 1:
+        print('Precomputing {} system matrices with {} worker processes.'.format(len(tasks), num_workers))
+
+    # Split the cores between the workers. The workers are fresh processes that read OMP_NUM_THREADS at startup,
+    # so that the OpenMP state of this process is not inherited through fork.
+    omp_num_threads = os.environ.get('OMP_NUM_THREADS')
+    os.environ['OMP_NUM_THREADS'] = str(max(1, _default_num_threads() // num_workers))
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(_precompute_sysmatrix_worker, task, svmbir_lib_path, verbose)
+                       for task in tasks.values()]
+            sysmatrix_files = [future.result() for future in futures]
+    finally:
+        if omp_num_threads is None:
+            del os.environ['OMP_NUM_THREADS']
+        else:
+            os.environ['OMP_NUM_THREADS'] = omp_num_threads
+
+    return sysmatrix_files
+
+
+def _precompute_sysmatrix_worker(task, svmbir_lib_path, verbose):
+    """Compute one system matrix for precompute_sysmatrix() in a worker process.
+    """
+    object_name = 'precompute_pid{}'.format(os.getpid())
+    paths, sinoparams, imgparams = ci._init_geometry(num_views=len(task['angles']), num_slices=1, verbose=verbose,
+                                                     svmbir_lib_path=svmbir_lib_path, object_name=object_name,
+                                                     **task)
+
+    # Remove the parameter files written by the command line interface
+    for key in ['sinoparams_fname', 'imgparams_fname', 'view_angle_list_fname']:
+        if key in paths and os.path.exists(paths[key]):
+            os.remove(paths[key])
+
+    return paths['sysmatrix_name'] + '.2Dsvmatrix'
+
+
+def _geometry_args(angles, num_channels, geometry = 'parallel', dist_source_detector = None, magnification = None,
+                   num_rows = None, num_cols = None, delta_channel = 1.0, delta_pixel = None, center_offset = 0.0,
+                   roi_radius = None):
+    """Validate geometry arguments and fill in their default values as done in svmbir.recon().
+
+    Returns:
+        dict: Geometry arguments of ``_init_geometry``, except num_views and num_slices.
+    """
+    angles = utils.test_args_angles(np.asarray(angles, dtype=np.float64))
+    num_rows, num_cols, delta_pixel, roi_radius, delta_channel, center_offset = utils.test_args_geom(
+        num_rows, num_cols, delta_pixel, roi_radius, delta_channel, center_offset)
+
+    if geometry == 'fan':
         geometry = 'fan-curved'
         warnings.warn("'fan' geometry will be removed in a future release. Fan beam geometry is now specified as either 'fan-curved' or 'fan-flat'. Defaulting to 'fan-curved'.",FutureWarning)
 
-    # Geometry dependent settings
     if geometry == 'parallel':
         dist_source_detector = 0.0
         magnification = 1.0
@@ -700,26 +2058,10 @@ def backproject(sino, angles, num_rows=None, num_cols=None,
     if roi_radius is None:
         roi_radius = auto_roi_radius(delta_pixel, num_rows, num_cols)
 
-    paths, sinoparams, imgparams = ci._init_geometry(angles, center_offset=center_offset,
-                                                     geometry=geometry, dist_source_detector=dist_source_detector,
-                                                     magnification=magnification,
-                                                     num_channels=num_channels, num_views=num_views, num_slices=num_slices,
-                                                     num_rows=num_rows, num_cols=num_cols,
-                                                     delta_channel=delta_channel, delta_pixel=delta_pixel,
-                                                     roi_radius=roi_radius,
-                                                     svmbir_lib_path=svmbir_lib_path, object_name=object_name,
-                                                     verbose=verbose)
-
-    # Collect settings to pass to C
-    settings = dict()
-    settings['paths'] = paths
-    settings['imgparams'] = imgparams
-    settings['sinoparams'] = sinoparams
-    settings['verbose'] = verbose
-    settings['num_threads'] = num_threads
-    settings['delete_temps'] = delete_temps
-
-    return ci.backproject(sino, settings)
+    return dict(angles=angles, num_channels=num_channels, geometry=geometry,
+                dist_source_detector=dist_source_detector, magnification=magnification,
+                num_rows=num_rows, num_cols=num_cols, delta_channel=delta_channel, delta_pixel=delta_pixel,
+                center_offset=center_offset, roi_radius=roi_radius)
 
 
 def _sino_indicator(sino):
@@ -0,0 +1,97 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+import multiprocessing
+import svmbir._utils as utils
+
+
+def _write_sysmatrix(log_file, sysmatrix_name):
+    # Stand-in for the C library: record the call and write a small matrix file
+    with open(log_file, 'a') as fileID:
+        fileID.write('{}\n'.format(os.getpid()))
+    time.sleep(0.5)
+    with open(sysmatrix_name + '.2Dsvmatrix', 'wb') as fileID:
+        fileID.write(b'\0' * 1000)
+
+
+def _get_sysmatrix(sysmatrix_name, log_file):
+    return utils.get_sysmatrix(sysmatrix_name, lambda name: _write_sysmatrix(log_file, name))
+
+
+class Test_cache():
+
+    def test_lru_eviction(self, tmp_path):
+        # Three matrices of 1000 bytes, accessed in the order b, c, a
+        for age, name in [(30, 'b'), (20, 'c'), (10, 'a')]:
+            fname = os.path.join(tmp_path, name + '.2Dsvmatrix')
+            with open(fname, 'wb') as fileID:
+                fileID.write(b'\0' * 1000)
+            os.utime(fname, (time.time() - age, time.time() - age))
+
+        evicted = utils.evict_sysmatrix_cache(tmp_path, 2000)
+
+        assert [os.path.basename(f) for f in evicted] == ['b.2Dsvmatrix']
+        assert utils.sysmatrix_cache_size(tmp_path) == 2000
+
+    def test_concurrent_generation(self, tmp_path):
+        sysmatrix_name = os.path.join(tmp_path, 'matrix')
+        log_file = os.path.join(tmp_path, 'calls.txt')
+
+        with multiprocessing.Pool(4) as pool:
+            results = pool.starmap(_get_sysmatrix, [(sysmatrix_name, log_file)] * 4)
+
+        # All processes return the same matrix, which was computed only once
+        assert results == [sysmatrix_name + '.2Dsvmatrix'] * 4
+        with open(log_file, 'r') as fileID:
+            assert len(fileID.read().split()) == 1
+        assert not os.path.exists(sysmatrix_name + '.lock')
+
+    def test_stale_lock(self, tmp_path):
+        sysmatrix_name = os.path.join(tmp_path, 'matrix')
+        log_file = os.path.join(tmp_path, 'calls.txt')
+
+        # Lock left behind by a process that has exited
+        dead_process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead_process.wait()
+        with open(sysmatrix_name + '.lock', 'w') as fileID:
+            fileID.write('{} {}\n'.format(socket.gethostname(), dead_process.pid))
+
+        assert _get_sysmatrix(sysmatrix_name, log_file) == sysmatrix_name + '.2Dsvmatrix'
+        assert os.path.exists(log_file)
+
+    def test_stale_lock_replaced(self, tmp_path):
+        lock_file = os.path.join(tmp_path, 'matrix.lock')
+        dead_process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead_process.wait()
+        with open(lock_file, 'w') as fileID:
+            fileID.write('{} {}\n'.format(socket.gethostname(), dead_process.pid))
+        lock_stat = utils._sysmatrix_lock_is_stale(lock_file)
+        assert lock_stat is not None
+
+        # Another process removes the stale lock and takes a new one before this process removes it
+        os.remove(lock_file)
+        assert utils._acquire_sysmatrix_lock(lock_file)
+        assert utils._sysmatrix_lock_is_stale(lock_file) is None
+
+        utils._remove_stale_sysmatrix_lock(lock_file, lock_stat)
+        with open(lock_file, 'r') as fileID:
+            assert fileID.read().split() == [socket.gethostname(), str(os.getpid())]
+        assert os.listdir(tmp_path) == ['matrix.lock']
+
+    def test_pin_evicted(self, tmp_path):
+        sysmatrix_name = os.path.join(tmp_path, 'matrix')
+        assert utils.pin_sysmatrix(sysmatrix_name) == (None, None)
+
+        with open(sysmatrix_name + '.2Dsvmatrix', 'wb') as fileID:
+            fileID.write(b'\1' * 1000)
+        fd, path = utils.pin_sysmatrix(sysmatrix_name)
+
+        # The pinned matrix stays readable after it is evicted from the cache
+        utils.evict_sysmatrix_cache(tmp_path, 0)
+        assert not os.path.exists(sysmatrix_name + '.2Dsvmatrix')
+        with open(path, 'rb') as fileID:
+            assert fileID.read() == b'\1' * 1000
+        if fd is not None:
+            os.close(fd)
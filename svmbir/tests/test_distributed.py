@@ -0,0 +1,146 @@
+import os
+import time
+import multiprocessing
+import numpy as np
+import svmbir
+import svmbir._utils as utils
+from svmbir.distributed import TaskQueue, run_worker
+
+
+def _square(x, object_name):
+    # Stand-in for svmbir.recon: each worker runs its tasks with its own object name
+    assert object_name.startswith('object_node')
+    time.sleep(0.2)
+    return np.full(3, x ** 2, dtype=np.float32)
+
+
+def _exit_once(marker_file):
+    # Simulate a node failure: the first worker to run this task dies without completing it
+    if not os.path.exists(marker_file):
+        open(marker_file, 'w').close()
+        os._exit(1)
+    return np.ones(3, dtype=np.float32)
+
+
+def _double_shared(descriptor):
+    # Worker side of share_array: attach, check the contents and write back in place
+    x, handle = utils.attach_array(descriptor)
+    assert np.all(x == np.arange(x.size, dtype=x.dtype).reshape(x.shape))
+    x *= 2
+    del x
+    if handle is not None:
+        handle.close()
+
+
+def _long_recon(count_file, object_name):
+    # Record every run of the task, then spend about 2 seconds in a single call of the C library
+    with open(count_file, 'a') as f:
+        f.write('run\n')
+    angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+    sino = svmbir.project(np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2), angles, 64, verbose=0)
+    return svmbir.recon(sino, angles, max_resolutions=0, stop_threshold=0.0, max_iterations=300, num_threads=1,
+                        object_name=object_name, verbose=0)
+
+
+def _run_worker(queue_dir, worker_id, heartbeat_timeout=1.0):
+    run_worker(queue_dir, worker_id=worker_id, heartbeat_timeout=heartbeat_timeout, poll_interval=0.1,
+               idle_timeout=3.0, verbose=0)
+
+
+class Test_distributed():
+
+    def test_local_workers(self, tmp_path):
+        queue = TaskQueue(tmp_path)
+        task_ids = ['task{}'.format(k) for k in range(8)]
+        for (k, task_id) in enumerate(task_ids):
+            queue.submit(task_id, dict(function=_square, args=(k,), object_name=True))
+
+        workers = [multiprocessing.Process(target=_run_worker, args=(str(tmp_path), 'node{}'.format(n)))
+                   for n in range(3)]
+        for worker in workers:
+            worker.start()
+        queue.wait(task_ids, timeout=60, poll_interval=0.1)
+        for worker in workers:
+            worker.join()
+
+        # All tasks were completed by the workers
+        for (k, task_id) in enumerate(task_ids):
+            assert np.all(queue.result(task_id) == k ** 2)
+        assert queue.status() == dict(pending=[], claimed=[], done=task_ids, failed=[])
+
+    def test_requeue_failed_worker(self, tmp_path):
+        queue = TaskQueue(tmp_path, heartbeat_timeout=1.0)
+        queue.submit('task', dict(function=_exit_once, args=(os.path.join(tmp_path, 'marker'),)))
+
+        failed_worker = multiprocessing.Process(target=_run_worker, args=(str(tmp_path), 'node0'))
+        failed_worker.start()
+        failed_worker.join()
+        assert failed_worker.exitcode == 1
+        assert queue.status()['claimed'] == ['task']
+
+        # A second worker requeues the task once its heartbeat is stale, and completes it
+        assert run_worker(tmp_path, worker_id='node1', heartbeat_timeout=1.0, poll_interval=0.1,
+                          idle_timeout=3.0, verbose=0) == 1
+        assert np.all(queue.result('task') == 1)
+
+    def test_long_task(self, tmp_path):
+        queue = TaskQueue(tmp_path, heartbeat_timeout=0.5)
+        count_file = os.path.join(tmp_path, 'count')
+        queue.submit('task', dict(function=_long_recon, args=(count_file,), object_name=True))
+
+        # The heartbeat keeps running while the reconstruction is in the C library,
+        # so the idle worker does not requeue the task and it runs once
+        workers = [multiprocessing.Process(target=_run_worker, args=(str(tmp_path), 'node{}'.format(n), 0.5))
+                   for n in range(2)]
+        for worker in workers:
+            worker.start()
+        queue.wait(['task'], timeout=60, poll_interval=0.1)
+        for worker in workers:
+            worker.join()
+
+        assert queue.status()['done'] == ['task']
+        with open(count_file) as f:
+            assert f.read() == 'run\n'
+
+    def test_failed_task(self, tmp_path):
+        queue = TaskQueue(tmp_path)
+        queue.submit('task', dict(function=_square, args=(2,)))
+
+        run_worker(tmp_path, max_tasks=1, verbose=0)
+
+        # _square is called without object_name
+        assert queue.status()['failed'] == ['task']
+        assert 'object_name' in queue.error('task')
+
+    def test_shared_array(self, tmp_path):
+        ctx = multiprocessing.get_context('spawn')
+        memmap = np.memmap(os.path.join(tmp_path, 'array.dat'), dtype=np.float32, mode='w+', shape=(4, 3, 5))
+        memmap[:] = np.arange(60, dtype=np.float32).reshape(memmap.shape)
+        memmap.flush()
+
+        # A memmap is shared by file name and any other array through a shared memory block
+        for x in [np.arange(60, dtype=np.float32).reshape(4, 3, 5), memmap]:
+            # Arrays are shared read-only unless they are shared as writable
+            descriptor, shm = utils.share_array(x)
+            shared, handle = utils.attach_array(descriptor)
+            assert not shared.flags.writeable
+            del shared
+            if shm is not None:
+                handle.close()
+                shm.close()
+                shm.unlink()
+
+            descriptor, shm = utils.share_array(x, writable=True)
+            assert descriptor[0] == ('shm' if shm is not None else 'memmap')
+            worker = ctx.Process(target=_double_shared, args=(descriptor,))
+            worker.start()
+            worker.join()
+            assert worker.exitcode == 0
+
+            shared, handle = utils.attach_array(descriptor)
+            assert np.all(shared == 2 * np.arange(60, dtype=np.float32).reshape(4, 3, 5))
+            del shared
+            if shm is not None:
+                handle.close()
+                shm.close()
+                shm.unlink()
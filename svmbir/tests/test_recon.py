@@ -1,5 +1,9 @@
+import pickle
 import numpy as np
+import pytest
 import svmbir
+import svmbir._utils as utils
+from PIL import Image
 
 
 class Test_recon():
@@ -97,3 +101,377 @@ class Test_recon():
         nrmse = svmbir.phantom.nrmse(mr_recon, recon)
 
         assert nrmse<=threshold
+
+
+    def test_checkpoint_resume(self, tmp_path):
+        num_rows = 64
+        num_slices = 4
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = svmbir.phantom.gen_shepp_logan_3d(num_rows, num_rows, num_slices)
+        sino = svmbir.project(phantom, angles, num_rows, verbose=0)
+        checkpoint_file = str(tmp_path / 'checkpoint.npz')
+
+        # Resuming from the last checkpoint of a finished reconstruction returns the same image
+        recon = svmbir.recon(sino, angles, max_resolutions=1, checkpoint_file=checkpoint_file,
+                             checkpoint_iterations=5, verbose=0)
+        resumed = svmbir.recon(sino, angles, max_resolutions=1, resume_from=checkpoint_file, verbose=0)
+        assert np.array_equal(resumed, recon)
+
+        # A reconstruction interrupted at full resolution resumes from its last checkpoint and runs the same
+        # segments as the uninterrupted one, so the two agree up to the rounding of the parallel updates
+        def interrupt(record):
+            if (record['level'] == 0) and (record['iteration'] == 10):
+                raise KeyboardInterrupt
+        try:
+            svmbir.recon(sino, angles, max_resolutions=1, checkpoint_file=checkpoint_file, checkpoint_iterations=5,
+                         callback=interrupt, callback_iterations=5, verbose=0)
+        except KeyboardInterrupt:
+            pass
+        checkpoint = utils.load_checkpoint(checkpoint_file)
+        assert (checkpoint['level'], checkpoint['iteration'], checkpoint['converged']) == (0, 5, False)
+        resumed = svmbir.recon(sino, angles, max_resolutions=1, checkpoint_file=checkpoint_file,
+                               checkpoint_iterations=5, resume_from=checkpoint_file, verbose=0)
+        assert svmbir.phantom.nrmse(resumed, recon) <= 1e-4
+
+        # Reconstruction interrupted after the coarse resolution continues at full resolution
+        coarse = svmbir.recon(sino, angles, num_rows=32, num_cols=32, delta_pixel=2.0, max_resolutions=0, verbose=0)
+        utils.save_checkpoint(checkpoint_file, coarse, level=1, iteration=100, converged=True, num_levels=2)
+        resumed = svmbir.recon(sino, angles, max_resolutions=1, resume_from=checkpoint_file, verbose=0)
+        assert svmbir.phantom.nrmse(resumed, recon) <= 0.05
+
+
+    def test_callback(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        stats = []
+        svmbir.recon(sino, angles, max_resolutions=1, max_iterations=10, callback=stats.append, callback_cost=True,
+                     verbose=0)
+
+        # One record per iteration, coarse resolution first, and the cost decreases within each resolution
+        assert [record['level'] for record in stats][0] == 1 and stats[-1]['level'] == 0
+        for level in [0, 1]:
+            costs = [record['cost'] for record in stats if record['level'] == level]
+            assert [record['iteration'] for record in stats if record['level'] == level] == list(range(1, len(costs) + 1))
+            assert costs[-1] <= costs[0]
+        assert stats[-1]['converged'] == (stats[-1]['change'] < 0.02)
+
+        # The iterations are those run by the C library, in segments of callback_iterations
+        stats = []
+        svmbir.recon(sino, angles, max_resolutions=0, max_iterations=10, stop_threshold=0.0, callback=stats.append,
+                     callback_iterations=3, verbose=0)
+        assert [record['iteration'] for record in stats] == [3, 6, 9, 10]
+
+
+    def test_return_proj(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        recon, proj = svmbir.recon(sino, angles, return_proj=True, verbose=0)
+
+        assert np.allclose(proj, svmbir.project(recon, angles, 64, verbose=0), atol=1e-4)
+
+
+    def test_schedule(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        schedule = [dict(scale=4, stop_threshold=0.5, max_iterations=5), dict(scale=2, relax_factor=0.9), dict(scale=1)]
+        recon, levels = svmbir.recon(sino, angles, schedule=schedule, return_schedule=True, verbose=0)
+
+        # The resolutions are reconstructed from coarsest to finest with their own settings
+        assert [(level['num_rows'], level['max_iterations'], level['relax_factor']) for level in levels] == \
+               [(16, 5, 1.0), (32, 100, 0.9), (64, 100, 1.0)]
+        assert all(level['time'] > 0 for level in levels)
+        assert svmbir.phantom.nrmse(recon, svmbir.recon(sino, angles, max_resolutions=2, verbose=0)) <= 0.05
+
+
+    def test_coarse_decimation(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        recon, levels = svmbir.recon(sino, angles, max_resolutions=2, return_schedule=True, verbose=0)
+        full = [dict(scale=4, decimate=False), dict(scale=2, decimate=False), dict(scale=1)]
+        reference = svmbir.recon(sino, angles, schedule=full, verbose=0)
+
+        # The quarter resolution uses every other view and bins 4 channels; the full resolution uses all data
+        assert [(level['num_views'], level['num_channels']) for level in levels] == [(32, 16), (64, 32), (64, 64)]
+        assert svmbir.phantom.nrmse(recon, reference) <= 0.05
+
+
+    def test_multires_slices(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = svmbir.phantom.gen_shepp_logan_3d(64, 64, 8)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        recon, levels = svmbir.recon(sino, angles, max_resolutions=2, multires_slices=True, b_interslice=2.0,
+                                     return_schedule=True, verbose=0)
+        reference = svmbir.recon(sino, angles, max_resolutions=2, b_interslice=2.0, verbose=0)
+
+        assert [level['num_slices'] for level in levels] == [2, 4, 8]
+        assert svmbir.phantom.nrmse(recon, reference) <= 0.05
+
+
+    def test_prox_session(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+        geometry = svmbir.Geometry(angles, 64, verbose=0)
+        prox_image = np.float32(0.9) * phantom
+
+        session = svmbir.ProxSession(sino, geometry)
+        image = session.prox(prox_image, init_image=0.0)
+        recon = svmbir.recon(sino, geometry, prox_image=prox_image, sigma_y=session.sigma_y, sigma_p=session.sigma_p,
+                             verbose=0)
+
+        assert svmbir.phantom.nrmse(image, recon) <= 0.01
+
+
+    def test_geometry_pickle(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+        geometry = pickle.loads(pickle.dumps(svmbir.Geometry(angles, 64, verbose=0)))
+
+        # An unpickled Geometry gives the same results as passing the geometry arguments to each call
+        assert np.array_equal(geometry.angles, angles) and geometry.num_rows == 64
+        assert np.allclose(svmbir.project(phantom, geometry, verbose=0), sino, atol=1e-5)
+        recon = svmbir.recon(sino, geometry, num_threads=1, verbose=0)
+        reference = svmbir.recon(sino, angles, num_threads=1, verbose=0)
+        assert np.allclose(recon, reference, atol=1e-5)
+
+
+    def test_projector(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+        projector = svmbir.Projector(svmbir.Geometry(angles, 64, verbose=0), num_slices=2)
+
+        # The operator agrees with project and backproject, also on flattened arrays
+        assert np.allclose(projector.forward(phantom), sino, atol=1e-5)
+        assert np.allclose(projector.matvec(phantom.reshape(-1)), sino.reshape(-1), atol=1e-5)
+        back = svmbir.backproject(sino, angles, num_rows=64, num_cols=64, verbose=0)
+        assert np.allclose(projector.adjoint(sino), back, rtol=1e-5, atol=1e-3)
+        assert np.allclose(projector.rmatvec(sino.reshape(-1)), back.reshape(-1), rtol=1e-5, atol=1e-3)
+        projector.close()
+
+
+    def test_batch_projection(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        images = np.stack([phantom, 0.5 * phantom, phantom[:, ::-1].copy()])
+
+        # A batch is projected and back projected as if each item were passed in its own call
+        sinos = svmbir.project(images, angles, 64, verbose=0)
+        assert sinos.shape == (3, 64, 2, 64)
+        for (image, sino) in zip(images, sinos):
+            assert np.allclose(sino, svmbir.project(image, angles, 64, verbose=0), atol=1e-5)
+
+        backs = svmbir.backproject(sinos, angles, num_rows=64, num_cols=64, verbose=0)
+        assert backs.shape == images.shape
+        for (sino, back) in zip(sinos, backs):
+            assert np.allclose(back, svmbir.backproject(sino, angles, num_rows=64, num_cols=64, verbose=0),
+                               rtol=1e-5, atol=1e-3)
+
+
+    def test_out_buffers(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        # The results written to out, in the C layout or in the (views, slices, channels) layout, are returned
+        for out in [np.empty((2, 64, 64), dtype=np.float32).swapaxes(0, 1), np.empty((64, 2, 64), dtype=np.float32)]:
+            assert svmbir.project(phantom, angles, 64, verbose=0, out=out) is out
+            assert np.allclose(out, sino, atol=1e-5)
+
+        out = np.empty((2, 64, 64), dtype=np.float32)
+        assert svmbir.backproject(sino, angles, num_rows=64, num_cols=64, verbose=0, out=out) is out
+        assert np.allclose(out, svmbir.backproject(sino, angles, num_rows=64, num_cols=64, verbose=0),
+                           rtol=1e-5, atol=1e-3)
+
+        out = np.empty((2, 64, 64), dtype=np.float32)
+        assert svmbir.recon(sino, angles, num_threads=1, verbose=0, out=out) is out
+        assert np.allclose(out, svmbir.recon(sino, angles, num_threads=1, verbose=0), atol=1e-5)
+
+
+    def test_internal_weights(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+        sino += np.float32(0.05) * np.random.randn(*sino.shape).astype(np.float32)
+
+        # Without a weights array the weights are computed internally, by the executable with CLIB=CMD_LINE.
+        # The noise makes some measurements negative, where emission weights are 1/(|y|+0.1).
+        assert np.any(sino < 0)
+        for weight_type in ['unweighted', 'transmission', 'transmission_root', 'emission']:
+            weights = svmbir.calc_weights(sino, weight_type)
+            recon = svmbir.recon(sino, angles, weight_type=weight_type, max_resolutions=0, num_threads=1, verbose=0)
+            reference = svmbir.recon(sino, angles, weights=weights, weight_type=weight_type, max_resolutions=0,
+                                     num_threads=1, verbose=0)
+            assert np.allclose(recon, reference, atol=1e-4)
+
+
+    def test_weight_factors(self):
+        sino = np.random.rand(16, 3, 20).astype(np.float32)
+        view_weights = np.random.rand(16)
+        channel_weights = np.random.rand(20)
+        full_weights = view_weights[:, np.newaxis, np.newaxis] * channel_weights[np.newaxis, np.newaxis, :] * np.ones(sino.shape)
+
+        # The factored weights evaluate to the full weights, whole or view by view
+        weights = utils.test_args_weights((view_weights, channel_weights), sino.shape)
+        assert np.allclose(utils.weights_array(weights, sino.shape), full_weights)
+        view_buffer = np.empty(sino.shape[1:], dtype=np.float32)
+        for view in range(sino.shape[0]):
+            assert np.allclose(utils.weights_view(weights, view, view_buffer), full_weights[view])
+        assert np.isclose(svmbir.auto_sigma_y(sino, (view_weights, channel_weights)),
+                          svmbir.auto_sigma_y(sino, full_weights))
+
+
+    def test_weight_factors_recon(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+        # 1D weights are ambiguous with as many views as channels, so the factors are given as 3D arrays
+        view_weights = np.linspace(0.5, 1.5, 64).reshape(64, 1, 1)
+        channel_weights = np.hanning(66)[1:-1].reshape(1, 1, 64)
+        full_weights = np.broadcast_to(view_weights * channel_weights, sino.shape)
+
+        # Factored weights reconstruct the same image as the full weights array
+        recon = svmbir.recon(sino, angles, weights=(view_weights, channel_weights), num_threads=1, verbose=0)
+        reference = svmbir.recon(sino, angles, weights=np.array(full_weights), num_threads=1, verbose=0)
+        assert np.allclose(recon, reference, atol=1e-5)
+
+
+    def test_zero_weight_views(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+        weights = np.ones(sino.shape)
+        weights[::4] = 0.0
+        view_mask = np.arange(len(angles)) % 4 != 0
+        args = dict(sigma_y=1.0, sigma_x=0.1, num_threads=1, verbose=0)
+
+        # Dropping the views without weight is the same as reconstructing from the remaining views
+        recon, proj = svmbir.recon(sino, angles, weights=weights, drop_zero_weight_views=True, return_proj=True, **args)
+        reference = svmbir.recon(sino[view_mask], angles[view_mask], weights=weights[view_mask], **args)
+        assert np.allclose(recon, reference, atol=1e-6)
+        assert np.allclose(proj[view_mask], svmbir.project(recon, angles[view_mask], 64, verbose=0), atol=1e-4)
+        assert np.allclose(proj[~view_mask], svmbir.project(recon, angles[~view_mask], 64, verbose=0), atol=1e-4)
+
+        # By default all views are kept
+        recon = svmbir.recon(sino, angles, weights=weights, **args)
+        reference = svmbir.recon(sino, svmbir.Geometry(angles, 64, verbose=0), weights=weights, **args)
+        assert np.allclose(recon, reference, atol=1e-6)
+
+
+    def test_recon_slabs(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = svmbir.phantom.gen_shepp_logan_3d(64, 64, 8)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        # Slabs reconstructed with halo slices agree with the reconstruction of the whole volume
+        recon = svmbir.recon_slabs(sino, angles, slab_size=3, slab_halo=2, verbose=0)
+        reference = svmbir.recon(sino, angles, verbose=0)
+        assert recon.shape == reference.shape
+        assert svmbir.phantom.nrmse(recon, reference) <= 0.02
+
+
+    def test_recon_slabs_parallel(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = svmbir.phantom.gen_shepp_logan_3d(64, 64, 8)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        # The process pool reconstructs the same slabs as the serial loop
+        recon = svmbir.recon_slabs(sino, angles, slab_size=3, slab_halo=2, num_workers=2, num_threads=1, verbose=0)
+        reference = svmbir.recon_slabs(sino, angles, slab_size=3, slab_halo=2, num_threads=1, verbose=0)
+        assert np.allclose(recon, reference, atol=1e-5)
+
+        # num_processes splits recon over the same pool
+        recon = svmbir.recon(sino, angles, num_processes=2, num_threads=1, verbose=0)
+        reference = svmbir.recon_slabs(sino, angles, slab_size=4, num_threads=1, verbose=0)
+        assert np.allclose(recon, reference, atol=1e-5)
+
+
+    def test_independent_slice_groups(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = svmbir.phantom.gen_shepp_logan_3d(64, 64, 8)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        # With b_interslice=0, num_processes='auto' reconstructs slice groups in 2 processes of 4 threads
+        recon = svmbir.recon(sino, angles, b_interslice=0.0, num_processes='auto', num_threads=8, verbose=0)
+        reference = svmbir.recon(sino, angles, b_interslice=0.0, num_threads=8, verbose=0)
+        assert svmbir.phantom.nrmse(recon, reference) <= 0.02
+
+        # An invalid num_processes falls back to a single process
+        with pytest.warns(UserWarning, match='num_processes'):
+            recon = svmbir.recon(sino, angles, b_interslice=0.0, num_processes='all', num_threads=8, verbose=0)
+        assert np.array_equal(np.shape(recon), np.shape(reference))
+
+
+    def test_prox_session_proj(self):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+        geometry = svmbir.Geometry(angles, 64, verbose=0)
+
+        # The returned projection is kept in the layout of the C library and can start the next call
+        session = svmbir.ProxSession(sino, geometry, b_interslice=2.0, num_threads=1)
+        image, proj = session.prox(np.float32(0.9) * phantom, init_image=0.0, return_proj=True)
+        assert np.swapaxes(proj, 0, 1).flags['C_CONTIGUOUS']
+        assert np.allclose(proj, svmbir.project(image, geometry, verbose=0), atol=1e-4)
+
+        next_image = session.prox(np.float32(0.8) * phantom, init_image=image, init_proj=proj)
+        recon = svmbir.recon(sino, geometry, prox_image=np.float32(0.8) * phantom, init_image=image, init_proj=proj,
+                             sigma_y=session.sigma_y, sigma_p=session.sigma_p, b_interslice=2.0, max_resolutions=0,
+                             num_threads=1, verbose=0)
+        assert svmbir.phantom.nrmse(next_image, recon) <= 0.01
+
+
+    def test_recon_resize(self):
+        recon = np.random.rand(5, 17, 23).astype(np.float32)
+
+        # Whole-stack resizing in threads gives the same result as resizing each slice with PIL
+        for output_shape in [(34, 46), (9, 12), (17, 46), (8, 23)]:
+            reference = np.stack([np.asarray(Image.fromarray(x).resize((output_shape[1], output_shape[0]),
+                                  resample=Image.Resampling.BILINEAR)) for x in recon])
+            out = np.empty((5,) + output_shape, dtype=np.float32)
+            assert utils.recon_resize(recon, output_shape, out=out, num_threads=3) is out
+            assert np.array_equal(out, reference)
+            assert np.array_equal(utils.recon_resize(recon, output_shape, num_threads=1), reference)
+
+
+    def test_multires_sino_geometry(self):
+        angles = np.random.permutation(np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False))
+        sino = np.random.rand(64, 2, 63).astype(np.float32)
+        weights = np.random.rand(64, 2, 63).astype(np.float32)
+
+        # The geometry of each resolution is that of the sinogram reduced by decimate_sino
+        for settings in utils.multires_schedule(2, 64, 64, 1.0, 2, 0.02, 100, 1.0):
+            sino_geometry = utils.multires_sino_geometry(settings, angles, 63, 1.0, 0.5, 1.0)
+            assert sino_geometry['decimate'] == (settings['scale'] == 4)
+            if not sino_geometry['decimate']:
+                assert sino_geometry['angles'] is angles
+                continue
+            lr_sino, _, lr_angles, lr_center_offset = utils.decimate_sino(
+                sino, weights, angles, 0.5, sino_geometry['view_step'], sino_geometry['channel_bin'],
+                sino_geometry['slice_bin'])
+            assert np.array_equal(sino_geometry['angles'], lr_angles)
+            assert (sino_geometry['num_views'], sino_geometry['num_channels']) == (lr_sino.shape[0], lr_sino.shape[2])
+            assert sino_geometry['center_offset'] == lr_center_offset
+
+
+    def test_precompute_sysmatrix(self, tmp_path):
+        angles = np.linspace(-np.pi/2.0, np.pi/2.0, 64, endpoint=False)
+        phantom = np.stack([svmbir.phantom.gen_shepp_logan(64, 64)] * 2)
+        sino = svmbir.project(phantom, angles, 64, verbose=0)
+
+        # recon with the default schedule finds all of its matrices in the cache, including the decimated ones
+        svmbir.precompute_sysmatrix([dict(angles=angles, num_channels=64)], max_resolutions=2, num_workers=2,
+                                    svmbir_lib_path=str(tmp_path), verbose=0)
+        misses = svmbir._cache_stats(str(tmp_path))['misses']
+        svmbir.recon(sino, angles, max_resolutions=2, svmbir_lib_path=str(tmp_path), verbose=0)
+        assert svmbir._cache_stats(str(tmp_path))['misses'] == misses